@@ -1,428 +1,395 @@
 from langchain.agents import create_agent
 from langchain.agents.structured_output import ToolStrategy
 from langchain.tools import tool
-from app.config import get_model_for_agent, get_temperature_for_agent, get_top_p_for_agent, get_api_key
-from app.llm_providers import get_llm
-from app.models import FightAnalysis, Card, CardAnalysis
-from typing import List, Dict, Any, Optional
-import requests
+from app.config import get_model_for_agent, get_temperature_for_agent, get_top_p_for_agent, get_api_key, batch_mode_enabled, SYNC_EXECUTOR_MAX_WORKERS
+from app.llm_providers import get_llm_registry, provider_for_model, PROVIDER_LABELS
+from app.models import AgentSettingsRecord, FightAnalysis, Card, CardAnalysis, CardReview
+from app.cache import agent_cache_key, normalize_fights
+from app.search import get_search_client, format_results, SearchBudgetExceeded
+from app.rendering import render_card
+from app.research import research_gaps
+from app.metrics import current_call
+from app.prompt_cache import build_messages, prompt_cache_key, record_usage, record_gemini_usage, gemini_cached_content, usage_tokens
+from app.scheduler import provider_slot, estimate_call_tokens
+from app.resilience import ProviderNotConfigured, call_with_resilience
+from app.provider_batch import BatchedChatModel, supports_batch
+from app.post_rules import ReviewPlan, apply_consistency_rules, apply_reviews, apply_risk_rules
+from app.engine import Node
+from typing import List, Dict, Any, Awaitable, Callable, Optional, Sequence, Type
+from pydantic import BaseModel
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextvars
+import functools
 from loguru import logger
 from app.prompts import *
 
-# LangChain model imports
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
-from langchain_google_genai import ChatGoogleGenerativeAI
-
 # Gemini imports for direct API usage
-from google import genai
 from google.genai.types import GenerateContentConfig, GoogleSearch, Tool
 
 
-def create_llm_with_params(model_name: str, temperature: Optional[float] = None, top_p: Optional[float] = None, api_keys: Optional[Dict[str, str]] = None):
-    """Create the appropriate LangChain model instance with temperature and top_p parameters"""
-    # Get API key based on model type
-    if model_name.startswith("gpt"):
-        api_key = get_api_key("openai", api_keys)
-        if not api_key:
-            raise ValueError(f"OpenAI API key is required for model {model_name}, but none provided in api_keys or environment")
-        model = ChatOpenAI(
-            model=model_name,
-            api_key=api_key,
-            temperature=temperature if temperature is not None else 0.7,
-            # top_p=top_p if top_p is not None else 1.0
-        )
-    elif model_name.startswith("claude") or model_name.startswith("anthropic"):
-        api_key = get_api_key("anthropic", api_keys)
-        if not api_key:
-            raise ValueError(f"Anthropic API key is required for model {model_name}, but none provided in api_keys or environment")
-        model = ChatAnthropic(
-            model=model_name,
-            api_key=api_key,
-            temperature=temperature if temperature is not None else 0.7,
-            top_p=top_p if top_p is not None else 0.9
-        )
-    elif model_name.startswith("gemini"):
-        api_key = get_api_key("google", api_keys)
-        if not api_key:
-            raise ValueError(f"Google API key is required for model {model_name}, but none provided in api_keys or environment")
-        model = ChatGoogleGenerativeAI(
-            model=model_name,
-            api_key=api_key,
-            temperature=temperature if temperature is not None else 0.7,
-            top_p=top_p if top_p is not None else 0.9
-        )
-    else:
-        # Default to ChatOpenAI for unknown models
-        api_key = get_api_key("openai", api_keys)
-        if not api_key:
-            raise ValueError(f"OpenAI API key is required for model {model_name}, but none provided in api_keys or environment")
-        model = ChatOpenAI(
-            model=model_name,
-            api_key=api_key,
-            temperature=temperature if temperature is not None else 0.7,
-            top_p=top_p if top_p is not None else 1.0
-        )
-
+def create_llm_with_params(model_name: str, temperature: Optional[float] = None, top_p: Optional[float] = None, api_keys: Optional[Dict[str, str]] = None, prompt_cache_key: Optional[str] = None):
+    """Get the pooled LangChain model instance for the model with temperature and top_p parameters"""
+    provider = provider_for_model(model_name)
+    # The offline fake provider needs no key
+    api_key = get_api_key(provider, api_keys) if provider != "fake" else "fake"
+    if not api_key:
+        raise ProviderNotConfigured(f"{PROVIDER_LABELS[provider]} API key is required for model {model_name}, but none provided in api_keys or environment")
+    model = get_llm_registry().chat_model(provider, model_name, api_key, temperature, top_p, prompt_cache_key)
+    if batch_mode_enabled() and supports_batch(provider):
+        return BatchedChatModel(inner=model, provider=provider, batch_key=f"{model_name}:{hash(api_key)}")
     return model
 
 
+def install_sync_executor(loop: asyncio.AbstractEventLoop) -> None:
+    """Bound the loop's default executor used for sync-only providers and tools"""
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=SYNC_EXECUTOR_MAX_WORKERS, thread_name_prefix="ufc-agent"))
+
+
+def build_agent(model: Any, tools: List[Any], schema: Optional[Type[BaseModel]] = None) -> Any:
+    """LangChain agent for a model, tools and structured output schema (free text without one)"""
+    build = functools.partial(create_agent, model=model, tools=tools, response_format=ToolStrategy(schema) if schema else None)
+    if isinstance(model, BatchedChatModel):
+        # Batch wrappers are made per call, and batched calls are not CPU-bound anyway
+        return build()
+    # Compiling the agent graph costs more CPU than a fast LLM call; pooled models reuse theirs
+    return get_llm_registry().compiled_agent(model, (tuple(tool.name for tool in tools), schema), build)
+
+
+async def invoke_agent(agent: Any, model_name: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Invoke an agent within its provider's limits, natively async or on the loop's executor for sync-only agents"""
+    recorder = current_call()
+    config = {"callbacks": [recorder.callback_handler()]} if recorder else None
+    provider = provider_for_model(model_name)
+    if batch_mode_enabled() and supports_batch(provider):
+        # Batch APIs have their own quotas; holding a live slot while a batch runs would cap its size
+        return await _invoke(agent, payload, config)
+    prompt = "".join(str(message.get("content", "")) for message in payload.get("messages", []) if isinstance(message, dict))
+    async with provider_slot(provider, estimate_call_tokens(prompt)) as slot:
+        result = await _invoke(agent, payload, config)
+        slot.settle(usage_tokens(result.get("messages", [])))
+    return result
+
+
+async def _invoke(agent: Any, payload: Dict[str, Any], config: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    ainvoke = getattr(agent, "ainvoke", None)
+    if ainvoke is not None:
+        return await ainvoke(payload, config=config)
+    loop = asyncio.get_running_loop()
+    # Executor threads do not inherit contextvars (request API keys, search budget, metrics)
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(None, functools.partial(context.run, agent.invoke, payload, config=config))
+
+
+def with_research_context(user_content: str, research_context: Optional[str]) -> str:
+    """Append the prefetched research shared by all analysts to an agent prompt"""
+    if not research_context:
+        return user_content
+    return f"{user_content}\n\nShared research context (pre-fetched web search results; rely on it instead of searching again):\n{research_context}"
+
+
+ANALYST_LABELS = (
+    ("tape_study", "Tape Study"),
+    ("stats_trends", "Stats & Trends"),
+    ("news_weighins", "News/Weigh-ins"),
+    ("style_matchup", "Style Matchup"),
+    ("market_odds", "Market/Odds"),
+)
+
+
+def format_analyst_reports(*reports: Optional[str]) -> str:
+    """Analyst reports for the judge prompt; failed analysts are listed as unavailable, never as content"""
+    lines, missing = [], []
+    for (_, label), report in zip(ANALYST_LABELS, reports):
+        if report is None:
+            missing.append(label)
+        else:
+            lines.append(f"{label}: {report}")
+    if missing:
+        lines.append(f"Unavailable analyses (the agent failed or did not finish in time; do not treat their absence as evidence either way): {', '.join(missing)}")
+    return "\n".join(lines)
 
-# Serper Web Search Tool
-@tool
-def serper_search(query: str, api_keys: Optional[Dict[str, str]] = None) -> str:
-    """Search the web for fighter news, injuries, and recent updates using Serper API."""
-    try:
-        logger.info(f"Serper search for: {query}")
-        api_key = get_api_key("serper", api_keys)
-        if not api_key:
-            return "Serper API key not configured"
-
-        url = "https://google.serper.dev/search"
-        payload = {
-            "q": query,
-            "num": 5  # Get top 5 results
-        }
-        headers = {
-            'X-API-KEY': api_key,
-            'Content-Type': 'application/json'
-        }
-
-        response = requests.post(url, json=payload, headers=headers)
-        response.raise_for_status()
-
-        data = response.json()
-        results = data.get("organic", [])
-
-        # Format search results
-        formatted_results = []
-        for i, result in enumerate(results, 1):
-            title = result.get("title", "")
-            link = result.get("link", "")
-            snippet = result.get("snippet", "")
-            formatted_results.append(f"{i}. {title} - {snippet}\n   {link}")
-
-        results_str = "\n\n".join(formatted_results) if formatted_results else "No results found"
-        logger.info(f"Serper search results: {results_str}")
-        return results_str
-
-    except Exception as e:
-        logger.error(f"Serper search error: {e}")
-        return f"Search error: {str(e)}"
-
-async def run_agent(agent_type: str, system_prompt: str, card: Card, model_override: Optional[str] = None) -> str:
-    logger.info(f"Starting {agent_type} agent for {len(card.fights)} fights")
-    try:
-        model_name = model_override if model_override else get_model_for_agent(agent_type)
-
-        # card_info = "\n".join([
-        #     f"Fight {f.fight_id}: {f.fighter1} vs {f.fighter2} ({f.weight_class})"
-        #     for f in card.fights
-        # ])
-
-        # Create agent using the new API
-        agent = create_agent(
-            model=model_name,
-            tools=[],  # No tools for analysis agents
-            response_format=None,  # Text response
-            system_prompt=system_prompt
-        )
-
-        user_content = f"Analyze this UFC card:\n{card}"
-        result = agent.invoke({
-            "messages": [{"role": "user", "content": user_content}]
-        })
-
-        logger.info(f"Completed {agent_type} agent")
-        return result["messages"][-1].content
-    except Exception as e:
-        logger.error(f"Error in {agent_type} agent: {str(e)}")
-        return f"Analysis failed for {agent_type}: {str(e)}"
-
-async def tape_study_agent(card: Card, model_override: Optional[str] = None, use_serper: bool = False, api_keys: Optional[Dict[str, str]] = None, custom_prompt: Optional[str] = None, custom_temperature: Optional[float] = None, custom_top_p: Optional[float] = None) -> str:
-    logger.info(f"Starting tape_study agent (serper: {use_serper})")
-    try:
-        model_name = model_override if model_override else get_model_for_agent("tape_study")
-        system_prompt = custom_prompt if custom_prompt else TAPE_STUDY_PROMPT
-
-        # Get temperature and top_p values
-        temperature = custom_temperature if custom_temperature is not None else get_temperature_for_agent("tape_study")
-        top_p = custom_top_p if custom_top_p is not None else get_top_p_for_agent("tape_study")
 
-        # Create model with temperature and top_p
-        model = create_llm_with_params(model_name, temperature, top_p, api_keys)
+async def text_agent_attempt(agent_type: str, model_name: str, system_prompt: str, temperature: float, top_p: float, api_keys: Optional[Dict[str, str]], tools: List[Any], user_content: str) -> str:
+    """One LLM call of a free-text analyst agent"""
+    # Create model with temperature and top_p
+    model = create_llm_with_params(model_name, temperature, top_p, api_keys, prompt_cache_key(agent_type, system_prompt))
 
-        # Determine tools based on use_serper flag
-        tools = [serper_search] if use_serper else []
+    agent = build_agent(model, tools)
 
-        # Create agent with configured model
-        agent = create_agent(
-            model=model,
-            tools=tools,
-            response_format=None,  # Text response
-            system_prompt=system_prompt
-        )
-        
-        if use_serper:
-            user_content = f"Analyze this UFC card technical analysis:\n{card}\n\nYou can use the serper_search tool to find recent fight footage analysis, technical breakdowns, and expert commentary about fighters."
-        else:
-            user_content = f"Analyze this UFC card technical analysis:\n{card}"
+    result = await invoke_agent(agent, model_name, {
+        "messages": build_messages(model_name, system_prompt, user_content)
+    })
+    record_usage(agent_type, result["messages"])
+    return result["messages"][-1].content
 
-        result = agent.invoke({
-            "messages": [{"role": "user", "content": user_content}]
-        })
 
-        logger.info(f"Completed tape_study agent (serper: {use_serper})")
-        return result["messages"][-1].content
-    except Exception as e:
-        logger.error(f"Error in tape_study agent: {str(e)}")
-        return f"Analysis failed for tape_study: {str(e)}"
+async def run_text_agent(agent_type: str, model_name: str, system_prompt: str, temperature: float, top_p: float, api_keys: Optional[Dict[str, str]], tools: List[Any], user_content: str, failover: bool = True) -> str:
+    """Free-text agent call with retries, hedging and the agent's deadline; raises AgentFailed"""
+    return await call_with_resilience(
+        agent_type, model_name,
+        lambda attempt_model: text_agent_attempt(agent_type, attempt_model, system_prompt, temperature, top_p, api_keys, tools, user_content),
+        failover,
+    )
 
-async def stats_trends_agent(card: Card, model_override: Optional[str] = None, use_serper: bool = False, api_keys: Optional[Dict[str, str]] = None, custom_prompt: Optional[str] = None, custom_temperature: Optional[float] = None, custom_top_p: Optional[float] = None) -> str:
-    logger.info(f"Starting stats_trends agent (serper: {use_serper})")
-    try:
-        model_name = model_override if model_override else get_model_for_agent("stats_trends")
-        system_prompt = custom_prompt if custom_prompt else STATS_TRENDS_PROMPT
 
-        # Get temperature and top_p values
-        temperature = custom_temperature if custom_temperature is not None else get_temperature_for_agent("stats_trends")
-        top_p = custom_top_p if custom_top_p is not None else get_top_p_for_agent("stats_trends")
+async def run_structured_agent(agent_type: str, model_name: str, system_prompt: str, temperature: float, top_p: float, api_keys: Optional[Dict[str, str]], user_content: str, schema: Type[BaseModel] = CardAnalysis, failover: bool = True) -> Any:
+    """Structured agent call (CardAnalysis unless another schema is given) with retries, hedging and the agent's deadline; raises AgentFailed"""
 
+    async def attempt(attempt_model: str) -> Any:
         # Create model with temperature and top_p
-        model = create_llm_with_params(model_name, temperature, top_p, api_keys)
+        model = create_llm_with_params(attempt_model, temperature, top_p, api_keys, prompt_cache_key(agent_type, system_prompt))
 
-        # Determine tools based on use_serper flag
-        tools = [serper_search] if use_serper else []
-
-        # Create agent with configured model
-        agent = create_agent(
-            model=model,
-            tools=tools,
-            response_format=None,  # Text response
-            system_prompt=system_prompt
-        )
+        agent = build_agent(model, [], schema)
 
-        if use_serper:
-            user_content = f"Analyze this UFC card statistical trends:\n{card}\n\nYou can use the serper_search tool to find recent statistical data, performance trends, and fighter statistics updates."
-        else:
-            user_content = f"Analyze this UFC card statistical trends:\n{card}"
-
-        result = agent.invoke({
-            "messages": [{"role": "user", "content": user_content}]
+        result = await invoke_agent(agent, attempt_model, {
+            "messages": build_messages(attempt_model, system_prompt, user_content)
         })
+        record_usage(agent_type, result["messages"])
+        return result["structured_response"]
 
-        logger.info(f"Completed stats_trends agent (serper: {use_serper})")
-        return result["messages"][-1].content
-    except Exception as e:
-        logger.error(f"Error in stats_trends agent: {str(e)}")
-        return f"Analysis failed for stats_trends: {str(e)}"
-
-async def news_weighins_agent(card: Card, model_override: Optional[str] = None, use_serper: bool = False, api_keys: Optional[Dict[str, str]] = None, custom_prompt: Optional[str] = None, custom_temperature: Optional[float] = None, custom_top_p: Optional[float] = None) -> str:
-    logger.info(f"Starting news_weighins agent (serper: {use_serper})")
-    try:
-        model_name = model_override if model_override else get_model_for_agent("news_weighins")
-        system_prompt = custom_prompt if custom_prompt else NEWS_WEIGHINS_PROMPT
-   
-
-        if model_name.startswith("gemini"):
-            logger.info(f"Starting news_weighins agent with Gemini: {model_name}")
-            # Use direct Gemini API with GoogleSearch
-            api_key = get_api_key("google", api_keys)
-            client = genai.Client(api_key=api_key)
-            prompt = f"""{system_prompt}
-
-Analyze this UFC card for news and external factors:
-{card}
-
-Use the Google Search tool to find recent news about fighters, injuries, weigh-in reports, and training camp updates."""
+    return await call_with_resilience(agent_type, model_name, attempt, failover)
 
-            response = client.models.generate_content(
-                model=model_name,
-                contents=prompt,
-                config=GenerateContentConfig(
-                    tools=[Tool(google_search=GoogleSearch())],
-                    temperature=custom_temperature if custom_temperature is not None else get_temperature_for_agent("news_weighins"),
-                    top_p=custom_top_p if custom_top_p is not None else get_top_p_for_agent("news_weighins")
-                
-                )
-            )
-            logger.info(f"Completed news_weighins agent with Gemini")
-            return response.text
-        else:
-            # Use LangChain approach with optional Serper
-            # Get temperature and top_p values
-            temperature = custom_temperature if custom_temperature is not None else get_temperature_for_agent("news_weighins")
-            top_p = custom_top_p if custom_top_p is not None else get_top_p_for_agent("news_weighins")
-
-            # Create model with temperature and top_p
-            model = create_llm_with_params(model_name, temperature, top_p, api_keys)
-
-            # Determine tools based on use_serper flag
-            tools = [serper_search] if use_serper else []
-
-            # Create agent with configured model
-            agent = create_agent(
-                model=model,
-                tools=tools,
-                response_format=None,  # Text response
-                system_prompt=system_prompt
-            )
-
-            if use_serper:
-                user_content = f"Analyze this UFC card for news and external factors:\n{card}\n\nYou can use the serper_search tool to find recent news about fighters, injuries, weigh-in reports, and training camp updates."
-            else:
-                user_content = f"Analyze this UFC card for news and external factors:\n{card}"
 
-            result = agent.invoke({
-                "messages": [{"role": "user", "content": user_content}]
-            })
-
-            logger.info(f"Completed news_weighins agent (serper: {use_serper})")
-            return result["messages"][-1].content
-    except Exception as e:
-        logger.error(f"Error in news_weighins agent: {str(e)}")
-        return f"Analysis failed for news_weighins: {str(e)}"
-
-async def style_matchup_agent(card: Card, model_override: Optional[str] = None, use_serper: bool = False, api_keys: Optional[Dict[str, str]] = None, custom_prompt: Optional[str] = None, custom_temperature: Optional[float] = None, custom_top_p: Optional[float] = None) -> str:
-    logger.info(f"Starting style_matchup agent (serper: {use_serper})")
+# Serper Web Search Tool
+@tool
+async def serper_search(query: str) -> str:
+    """Search the web for fighter news, injuries, and recent updates using Serper API."""
     try:
-        model_name = model_override if model_override else get_model_for_agent("style_matchup")
-        system_prompt = custom_prompt if custom_prompt else STYLE_MATCHUP_PROMPT
-
-        # Get temperature and top_p values
-        temperature = custom_temperature if custom_temperature is not None else get_temperature_for_agent("style_matchup")
-        top_p = custom_top_p if custom_top_p is not None else get_top_p_for_agent("style_matchup")
-
-        # Create model with temperature and top_p
-        model = create_llm_with_params(model_name, temperature, top_p, api_keys)
-
-        # Determine tools based on use_serper flag
-        tools = [serper_search] if use_serper else []
-
-        # Create agent with configured model
-        agent = create_agent(
-            model=model,
-            tools=tools,
-            response_format=None,  # Text response
-            system_prompt=system_prompt
-        )
-
-        if use_serper:
-            user_content = f"Analyze this UFC card fighting styles and matchup dynamics:\n{card}\n\nYou can use the serper_search tool to find recent fighter style analysis, matchup predictions, and expert commentary."
-        else:
-            user_content = f"Analyze this UFC card fighting styles and matchup dynamics:\n{card}"
-
-        result = agent.invoke({
-            "messages": [{"role": "user", "content": user_content}]
-        })
+        logger.info(f"Serper search for: {query}")
+        results = await get_search_client().search(query)
+        results_str = format_results(results)
+        logger.info(f"Serper search results: {results_str}")
+        return results_str
 
-        logger.info(f"Completed style_matchup agent (serper: {use_serper})")
-        return result["messages"][-1].content
+    except SearchBudgetExceeded as e:
+        logger.warning(f"Serper search skipped: {e}")
+        return f"Search unavailable: {str(e)}. Continue with the information you already have."
     except Exception as e:
-        logger.error(f"Error in style_matchup agent: {str(e)}")
-        return f"Analysis failed for style_matchup: {str(e)}"
-
-async def market_odds_agent(card: Card, model_override: Optional[str] = None, use_serper: bool = False, api_keys: Optional[Dict[str, str]] = None, custom_prompt: Optional[str] = None, custom_temperature: Optional[float] = None, custom_top_p: Optional[float] = None) -> str:
-    logger.info(f"Starting market_odds agent (serper: {use_serper})")
-    try:
-        model_name = model_override if model_override else get_model_for_agent("market_odds")
-        system_prompt = custom_prompt if custom_prompt else MARKET_ODDS_PROMPT
-
-        # Get temperature and top_p values
-        temperature = custom_temperature if custom_temperature is not None else get_temperature_for_agent("market_odds")
-        top_p = custom_top_p if custom_top_p is not None else get_top_p_for_agent("market_odds")
+        logger.error(f"Serper search error: {e}")
+        return f"Search error: {str(e)}"
 
-        # Create model with temperature and top_p
-        model = create_llm_with_params(model_name, temperature, top_p, api_keys)
 
-        # Determine tools based on use_serper flag
-        tools = [serper_search] if use_serper else []
+def gemini_search_attempt(agent_type: str, system_prompt: str, temperature: float, top_p: float, api_keys: Optional[Dict[str, str]], prompt: str) -> Callable[[str], Awaitable[str]]:
+    """Attempt function calling Gemini directly with Google Search grounding"""
 
-        # Create agent with configured model
-        agent = create_agent(
-            model=model,
-            tools=tools,
-            response_format=None,  # Text response
-            system_prompt=system_prompt
-        )
+    async def attempt(attempt_model: str) -> str:
+        if not attempt_model.startswith("gemini"):
+            # Non-Gemini hedge models answer without the Google Search tool
+            return await text_agent_attempt(agent_type, attempt_model, system_prompt, temperature, top_p, api_keys, [], prompt)
 
-        if use_serper:
-            user_content = f"Analyze this UFC card betting odds and market movements:\n{card}\n\nYou can use the serper_search tool to find current odds data, line movements, and market analysis."
+        api_key = get_api_key("google", api_keys)
+        if not api_key:
+            raise ProviderNotConfigured(f"{PROVIDER_LABELS['google']} API key is required for model {attempt_model}, but none provided in api_keys or environment")
+        client = get_llm_registry().genai_client(api_key)
+
+        # Static system prompt and tools live in a context cache when the prompt is large enough
+        search_tools = [Tool(google_search=GoogleSearch())]
+        cached_content = await gemini_cached_content(client, attempt_model, api_key, system_prompt, search_tools)
+        if cached_content:
+            config = GenerateContentConfig(cached_content=cached_content, temperature=temperature, top_p=top_p)
         else:
-            user_content = f"Analyze this UFC card betting odds and market movements:\n{card}"
-
-        result = agent.invoke({
-            "messages": [{"role": "user", "content": user_content}]
-        })
-
-        logger.info(f"Completed market_odds agent (serper: {use_serper})")
-        return result["messages"][-1].content
-    except Exception as e:
-        logger.error(f"Error in market_odds agent: {str(e)}")
-        return f"Analysis failed for market_odds: {str(e)}"
-
-async def judge_agent(card: Card, tape: str, stats: str, news: str, style: str, market: str, model_override: Optional[str] = None, api_keys: Optional[Dict[str, str]] = None, custom_prompt: Optional[str] = None, custom_temperature: Optional[float] = None, custom_top_p: Optional[float] = None) -> List[FightAnalysis]:
-    logger.info("Starting judge agent")
-    try:
-        model_name = model_override if model_override else get_model_for_agent("judge")
-
-        system_prompt = custom_prompt if custom_prompt else """
+            config = GenerateContentConfig(system_instruction=system_prompt, tools=search_tools, temperature=temperature, top_p=top_p)
+
+        recorder = current_call()
+        async with provider_slot("google", estimate_call_tokens(prompt if cached_content else system_prompt + prompt)) as slot:
+            if recorder:
+                recorder.llm_started(attempt_model)
+            response = await client.aio.models.generate_content(
+                model=attempt_model,
+                contents=prompt,
+                config=config
+            )
+            if response.usage_metadata:
+                slot.settle(response.usage_metadata.total_token_count or 0)
+        record_gemini_usage(agent_type, response.usage_metadata)
+        if recorder and response.usage_metadata:
+            usage = response.usage_metadata
+            recorder.add_usage(usage.prompt_token_count, usage.candidates_token_count, usage.cached_content_token_count)
+        return response.text
+
+    return attempt
+
+
+class AgentSpec:
+    """Declarative agent definition: default prompt, output schema, search tools and how to build its input"""
+
+    def __init__(self, name: str, system_prompt: str, build_prompt: Callable[[Card, Dict[str, Any], Optional[str]], str],
+                 cache_inputs: Callable[[Card, Dict[str, Any]], Any], schema: Optional[Type[BaseModel]] = None,
+                 parse: Optional[Callable[[Any, Dict[str, Any]], Any]] = None, decode: Optional[Callable[[Any], Any]] = None,
+                 fallback: Optional[Callable[[Dict[str, Any]], Any]] = None, search: bool = False, gemini_search: bool = False):
+        self.name = name
+        self.system_prompt = system_prompt
+        # (card, dependency results, search tool name or None) -> user message
+        self.build_prompt = build_prompt
+        # Everything besides settings and tools that determines the response
+        self.cache_inputs = cache_inputs
+        # Structured output schema; None for free-text agents
+        self.schema = schema
+        self.parse = parse
+        self.decode = decode
+        self.fallback = fallback
+        # Offered serper_search when the card enables it and the prefetched research misses a fight
+        self.search = search
+        # Gemini models search with Google Search grounding instead
+        self.gemini_search = gemini_search
+
+
+class AgentSettings:
+    """An agent's model, system prompt and sampling parameters after per-request overrides"""
+
+    def __init__(self, spec: AgentSpec, card: Card):
+        override = _override(card.agent_models, spec.name)
+        self.model_name = override or get_model_for_agent(spec.name)
+        # A model the request asked for is never swapped for a fallback or hedge model
+        self.failover = not override
+        self.system_prompt = _override(card.custom_prompts, spec.name) or spec.system_prompt
+        temperature = _override(card.custom_temperatures, spec.name)
+        self.temperature = temperature if temperature is not None else get_temperature_for_agent(spec.name)
+        top_p = _override(card.custom_top_ps, spec.name)
+        self.top_p = top_p if top_p is not None else get_top_p_for_agent(spec.name)
+
+
+def _override(overrides: Optional[Any], agent_type: str) -> Optional[Any]:
+    return getattr(overrides, agent_type) if overrides else None
+
+
+def search_tool(spec: AgentSpec, settings: AgentSettings, card: Card, inputs: Dict[str, Any]) -> Optional[str]:
+    """Name of the search tool the agent gets for this request, if any"""
+    if spec.gemini_search and settings.model_name.startswith("gemini"):
+        return "google_search"
+    if spec.search and card.use_serper and research_gaps(card, inputs.get("research_prefetch")):
+        return serper_search.name
+    return None
+
+
+def agent_spec_cache_key(spec: AgentSpec, card: Card, inputs: Dict[str, Any]) -> str:
+    settings = AgentSettings(spec, card)
+    tool_name = search_tool(spec, settings, card, inputs)
+    # After a call, key the answer by the model that gave it, which may be a fallback
+    recorder = current_call()
+    model_name = recorder.answered_by if recorder is not None and recorder.answered_by else settings.model_name
+    return agent_cache_key(spec.name, model_name, settings.system_prompt, settings.temperature, settings.top_p,
+                           [tool_name] if tool_name else [], spec.cache_inputs(card, inputs))
+
+
+async def run_agent_spec(spec: AgentSpec, card: Card, inputs: Dict[str, Any]) -> Any:
+    """Run one agent for a card given its dependencies' results; raises AgentFailed"""
+    settings = AgentSettings(spec, card)
+    tool_name = search_tool(spec, settings, card, inputs)
+    logger.info(f"Starting {spec.name} agent with {settings.model_name} (search: {tool_name})")
+    user_content = with_research_context(spec.build_prompt(card, inputs, tool_name), inputs.get("research_prefetch"))
+    args = (spec.name, settings.model_name, settings.system_prompt, settings.temperature, settings.top_p, card.api_keys)
+
+    if spec.schema is not None:
+        result = spec.parse(await run_structured_agent(*args, user_content, spec.schema, settings.failover), inputs)
+    elif tool_name == "google_search":
+        attempt = gemini_search_attempt(spec.name, settings.system_prompt, settings.temperature, settings.top_p, card.api_keys, user_content)
+        result = await call_with_resilience(spec.name, settings.model_name, attempt, settings.failover)
+    else:
+        result = await run_text_agent(*args, [serper_search] if tool_name else [], user_content, settings.failover)
+    logger.info(f"Completed {spec.name} agent")
+    return result
+
+
+def agent_node(spec: AgentSpec, card: Card, deps: Sequence[str] = (), **options: Any) -> Node:
+    """Pipeline node running an agent spec for a card, cached by its content hash"""
+    return Node(
+        spec.name, functools.partial(run_agent_spec, spec, card), deps,
+        cache_key=functools.partial(agent_spec_cache_key, spec, card), decode=spec.decode,
+        fallback=spec.fallback, **options,
+    )
+
+
+def as_fight_analyses(analyses: List[Any]) -> List[FightAnalysis]:
+    """Normalize agent output (dicts or models) into FightAnalysis instances"""
+    return [FightAnalysis.model_validate(a) if isinstance(a, dict) else a for a in analyses]
+
+
+def _analyst(name: str, system_prompt: str, task: str, search_hint: str, gemini_search: bool = False) -> AgentSpec:
+    def build_prompt(card: Card, inputs: Dict[str, Any], tool_name: Optional[str]) -> str:
+        prompt = f"Analyze this UFC card {task}:\n{render_card(card)}"
+        if tool_name == "google_search":
+            return f"{prompt}\n\nUse the Google Search tool to find {search_hint}."
+        if tool_name:
+            return f"{prompt}\n\nYou can use the {tool_name} tool to find {search_hint}."
+        return prompt
+
+    return AgentSpec(
+        name, system_prompt, build_prompt,
+        cache_inputs=lambda card, inputs: [normalize_fights(card.fights), inputs.get("research_prefetch")],
+        search=True, gemini_search=gemini_search,
+    )
+
+
+ANALYST_SPECS = (
+    _analyst("tape_study", TAPE_STUDY_PROMPT, "technical analysis",
+             "recent fight footage analysis, technical breakdowns, and expert commentary about fighters"),
+    _analyst("stats_trends", STATS_TRENDS_PROMPT, "statistical trends",
+             "recent statistical data, performance trends, and fighter statistics updates"),
+    _analyst("news_weighins", NEWS_WEIGHINS_PROMPT, "for news and external factors",
+             "recent news about fighters, injuries, weigh-in reports, and training camp updates", gemini_search=True),
+    _analyst("style_matchup", STYLE_MATCHUP_PROMPT, "fighting styles and matchup dynamics",
+             "recent fighter style analysis, matchup predictions, and expert commentary"),
+    _analyst("market_odds", MARKET_ODDS_PROMPT, "betting odds and market movements",
+             "current odds data, line movements, and market analysis"),
+)
+
+
+def _analyst_reports(inputs: Dict[str, Any]) -> List[Optional[str]]:
+    return [inputs.get(name) for name, _ in ANALYST_LABELS]
+
+
+JUDGE_SPEC = AgentSpec(
+    "judge",
+    """
 You are the final judge synthesizing all analyses into a definitive prediction.
 
 Synthesize the following analyses from different experts for each fight on the UFC card.
-"""
+""",
+    lambda card, inputs, _: f"""
+Synthesize these analyses into final predictions for these fights (use the exact fight_id values):
 
-        # Get temperature and top_p values
-        temperature = custom_temperature if custom_temperature is not None else get_temperature_for_agent("judge")
-        top_p = custom_top_p if custom_top_p is not None else get_top_p_for_agent("judge")
+{render_card(card)}
 
-        # Create model with temperature and top_p
-        model = create_llm_with_params(model_name, temperature, top_p, api_keys)
-
-        # Create agent with configured model and structured output
-        agent = create_agent(
-            model=model,
-            tools=[],  # No tools for judge
-            response_format=ToolStrategy(CardAnalysis),  # Structured output
-            system_prompt=system_prompt
-        )
+{format_analyst_reports(*_analyst_reports(inputs))}
 
-        user_content = f"""
-Synthesize these analyses into final predictions:
+Provide final analysis for all fights with picks, confidence, path to victory, risk flags, and props.
+""",
+    cache_inputs=lambda card, inputs: {"fights": normalize_fights(card.fights), "analyses": _analyst_reports(inputs)},
+    schema=CardAnalysis,
+    parse=lambda response, inputs: list(response.analyses),
+    decode=as_fight_analyses,
+)
 
-Tape Study: {tape}
-Stats & Trends: {stats}
-News/Weigh-ins: {news}
-Style Matchup: {style}
-Market/Odds: {market}
 
-Provide final analysis for all fights with picks, confidence, path to victory, risk flags, and props.
-"""
+def post_input(inputs: Dict[str, Any]) -> List[FightAnalysis]:
+    """Analyses a post agent reviews: its single dependency's output, or the review share of a ReviewPlan"""
+    value = next(iter(inputs.values()))
+    return value.review if isinstance(value, ReviewPlan) else value
 
-        result = agent.invoke({
-            "messages": [{"role": "user", "content": user_content}]
-        })
 
-        logger.info(f"Judge agent completed with structured response")
-        str_resp_analyses = result["structured_response"].analyses
-        result_json = []
-        for analysis in str_resp_analyses:
-            result_json.append(analysis.dict())
+def _analyses_json(inputs: Dict[str, Any]) -> str:
+    return CardAnalysis(analyses=post_input(inputs)).model_dump_json()
 
-        return result_json
-    except Exception as e:
-        logger.error(f"Error in judge agent: {str(e)}")
-        return []
 
-# Post agents - now using LangChain agents
+def _post_review(name: str, system_prompt: str, instructions: str, risk_flags: bool, confidence: bool,
+                 rules: Callable[[List[FightAnalysis]], List[FightAnalysis]]) -> AgentSpec:
+    return AgentSpec(
+        name, system_prompt,
+        lambda card, inputs, _: instructions.format(analyses_json=_analyses_json(inputs)),
+        cache_inputs=lambda card, inputs: _analyses_json(inputs),
+        schema=CardReview,
+        parse=lambda review, inputs: apply_reviews(post_input(inputs), review.reviews, risk_flags=risk_flags, confidence=confidence),
+        decode=as_fight_analyses,
+        # Rule-based fallbacks edit their input in place
+        fallback=lambda inputs: rules([a.model_copy(deep=True) for a in post_input(inputs)]),
+    )
 
-async def risk_scorer_agent(analyses: List[FightAnalysis], model_override: Optional[str] = None, api_keys: Optional[Dict[str, str]] = None, custom_prompt: Optional[str] = None, custom_temperature: Optional[float] = None, custom_top_p: Optional[float] = None) -> List[FightAnalysis]:
-    """Risk Scorer Agent - enhances risk flags using LLM analysis"""
-    logger.info(f"Starting risk scorer agent for {len(analyses)} analyses")
-    try:
-        model_name = model_override if model_override else get_model_for_agent("risk_scorer")
 
-        system_prompt = custom_prompt if custom_prompt else """
+RISK_SCORER_SPEC = _post_review(
+    "risk_scorer",
+    """
 You are an expert risk assessor for UFC fights. Review the current fight analyses and identify additional risk factors that could affect outcomes.
 
 Consider factors like:
@@ -435,59 +402,21 @@ Consider factors like:
 - Overconfidence indicators
 
 Add relevant risk flags to each analysis while preserving existing ones.
-"""
-
-        # Get temperature and top_p values
-        temperature = custom_temperature if custom_temperature is not None else get_temperature_for_agent("risk_scorer")
-        top_p = custom_top_p if custom_top_p is not None else get_top_p_for_agent("risk_scorer")
-
-        # Create model with temperature and top_p
-        model = create_llm_with_params(model_name, temperature, top_p, api_keys)
-
-        agent = create_agent(
-            model=model,
-            tools=[],  # No tools needed
-            response_format=ToolStrategy(CardAnalysis),  # Structured output
-            system_prompt=system_prompt
-        )
-
-        # Serialize current analyses for input
-        current_card = CardAnalysis(analyses=analyses)
-        analyses_json = current_card.model_dump_json()
-
-        user_content = f"""
+""",
+    """
 Review these fight predictions and enhance the risk flags:
 
 {analyses_json}
 
-Add any additional risk factors you identify. Preserve existing risk flags and add new relevant ones.
-Return the complete updated analysis with enhanced risk assessment.
-"""
-
-        result = agent.invoke({
-            "messages": [{"role": "user", "content": user_content}]
-        })
-
-        logger.info("Risk scorer agent completed")
-        return result["structured_response"].analyses
+Add any additional risk factors you identify. Existing risk flags are kept automatically.
+Return only the changes: for each fight that needs them, its fight_id and the new risk flags. Leave confidence null.
+""",
+    risk_flags=True, confidence=False, rules=apply_risk_rules,
+)
 
-    except Exception as e:
-        logger.error(f"Error in risk scorer agent: {str(e)}")
-        # Fallback to basic risk assessment
-        for analysis in analyses:
-            if analysis.confidence > 90:
-                analysis.risk_flags.append("high confidence may indicate overestimation")
-            if len(analysis.risk_flags) == 0:
-                analysis.risk_flags.append("no major risks identified")
-        return analyses
-
-async def consistency_checker_agent(analyses: List[FightAnalysis], model_override: Optional[str] = None, api_keys: Optional[Dict[str, str]] = None, custom_prompt: Optional[str] = None, custom_temperature: Optional[float] = None, custom_top_p: Optional[float] = None) -> List[FightAnalysis]:
-    """Consistency Checker Agent - validates and adjusts confidence scores"""
-    logger.info(f"Starting consistency checker agent for {len(analyses)} analyses")
-    try:
-        model_name = model_override if model_override else get_model_for_agent("consistency_checker")
-
-        system_prompt = custom_prompt if custom_prompt else """
+CONSISTENCY_CHECKER_SPEC = _post_review(
+    "consistency_checker",
+    """
 You are a consistency checker for UFC fight predictions. Review the analyses for logical consistency and adjust confidence scores as needed.
 
 Consider:
@@ -498,46 +427,59 @@ Consider:
 - Consistency with historical outcomes
 
 Adjust confidence scores (0-100) to better reflect realistic probabilities while maintaining the pick.
-"""
-
-        # Get temperature and top_p values
-        temperature = custom_temperature if custom_temperature is not None else get_temperature_for_agent("consistency_checker")
-        top_p = custom_top_p if custom_top_p is not None else get_top_p_for_agent("consistency_checker")
-
-        # Create model with temperature and top_p
-        model = create_llm_with_params(model_name, temperature, top_p, api_keys)
-
-        agent = create_agent(
-            model=model,
-            tools=[],  # No tools needed
-            response_format=ToolStrategy(CardAnalysis),  # Structured output
-            system_prompt=system_prompt
-        )
-
-        # Serialize current analyses for input
-        current_card = CardAnalysis(analyses=analyses)
-        analyses_json = current_card.model_dump_json()
-
-        user_content = f"""
+""",
+    """
 Review these fight predictions for consistency and adjust confidence scores if needed:
 
 {analyses_json}
 
 Check for logical consistency and adjust confidence scores to reflect realistic probabilities.
-Maintain the same picks but calibrate confidence appropriately.
-"""
+Return only the changes: for each fight whose confidence should move, its fight_id, the new confidence and a short reason. Leave added_risk_flags empty.
+""",
+    risk_flags=False, confidence=True, rules=apply_consistency_rules,
+)
 
-        result = agent.invoke({
-            "messages": [{"role": "user", "content": user_content}]
-        })
+POST_REVIEW_SPEC = _post_review(
+    "post_review",
+    """
+You are an expert risk assessor and consistency checker for UFC fight predictions. Review the current fight analyses in two steps.
+
+1. Risk: identify additional risk factors that could affect outcomes, such as:
+- Fighter form and recent performance
+- Injury history and recovery time
+- Weight cut difficulties
+- Training camp issues
+- Age and experience factors
+- Style matchup concerns
+- Overconfidence indicators
+Add relevant risk flags to each analysis while preserving existing ones.
 
-        logger.info("Consistency checker agent completed")
-        return result["structured_response"].analyses
+2. Consistency: check each analysis for conflicting signals, overconfidence in uncertain matchups, underestimated upset potential and risk factors that should reduce confidence.
+Adjust confidence scores (0-100) to better reflect realistic probabilities, taking the risk flags from step 1 into account, while maintaining the pick.
+""",
+    """
+Review these fight predictions:
 
-    except Exception as e:
-        logger.error(f"Error in consistency checker agent: {str(e)}")
-        # Fallback to basic consistency check
-        for analysis in analyses:
-            if len(analysis.risk_flags) > 1:
-                analysis.confidence = max(50, analysis.confidence - 10)
-        return analyses
+{analyses_json}
+
+Add any additional risk factors you identify (existing risk flags are kept automatically), then calibrate each confidence score to reflect realistic probabilities.
+Return only the changes: for each fight that needs them, its fight_id, any new risk flags, the new confidence (or null to keep it) and a short reason.
+""",
+    risk_flags=True, confidence=True, rules=lambda analyses: apply_consistency_rules(apply_risk_rules(analyses)),
+)
+
+AGENT_SPECS: Dict[str, AgentSpec] = {
+    spec.name: spec for spec in (*ANALYST_SPECS, JUDGE_SPEC, RISK_SCORER_SPEC, CONSISTENCY_CHECKER_SPEC, POST_REVIEW_SPEC)
+}
+
+
+def agent_settings(card: Card) -> Dict[str, AgentSettingsRecord]:
+    """Model and sampling parameters every agent runs with for this card"""
+    records = {}
+    for name, spec in AGENT_SPECS.items():
+        settings = AgentSettings(spec, card)
+        records[name] = AgentSettingsRecord(
+            model=settings.model_name, temperature=settings.temperature, top_p=settings.top_p,
+            custom_prompt=settings.system_prompt != spec.system_prompt,
+        )
+    return records
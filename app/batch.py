@@ -0,0 +1,279 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from loguru import logger
+
+from app.cache import normalize_fights
+from app.config import BATCH_MAX_CONCURRENT_FIGHTS, BATCH_SQLITE_PATH, provider_batch_mode
+from app.models import (
+    BatchCardResult, BatchJobResults, BatchJobStatus, Card, CardAnalysis, CardBatch, Fight, FightAnalysis
+)
+from app.pipeline import analyze_card_pipeline
+from app.scheduler import AdmissionRejected, get_scheduler
+
+# Card settings that do not change a fight's analysis
+_UNIT_IGNORED_FIELDS = {"fights", "api_keys", "include_trace", "shard_by_fight", "card_id", "incremental"}
+
+UNIT_PENDING, UNIT_DONE, UNIT_FAILED = "pending", "done", "failed"
+
+
+def fight_unit_key(card: Card, fight: Fight) -> str:
+    """Identity of one fight analysis: the fight's content (not its id) plus the card settings that shape it"""
+    fight_fields = normalize_fights([fight])[0]
+    fight_fields.pop("fight_id", None)
+    material = json.dumps(
+        {"fight": fight_fields, "settings": card.model_dump(mode="json", exclude=_UNIT_IGNORED_FIELDS)},
+        sort_keys=True,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def plan_units(batch: CardBatch) -> Dict[str, Tuple[int, int]]:
+    """Unique fight analyses in a batch, each mapped to the first (card index, fight index) requesting it"""
+    units: Dict[str, Tuple[int, int]] = {}
+    for card_index, card in enumerate(batch.cards):
+        for fight_index, fight in enumerate(card.fights):
+            units.setdefault(fight_unit_key(card, fight), (card_index, fight_index))
+    return units
+
+
+class BatchJobStore:
+    """Batch jobs and per-fight progress in SQLite, so results survive restarts and unfinished jobs resume"""
+
+    def __init__(self, path: str = BATCH_SQLITE_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS batch_jobs ("
+                "job_id TEXT PRIMARY KEY, status TEXT NOT NULL, request TEXT NOT NULL, cards INTEGER NOT NULL, "
+                "fights INTEGER NOT NULL, unique_fights INTEGER NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL, "
+                "keyed INTEGER NOT NULL DEFAULT 0)"
+            )
+            # Stores created before keyed jobs were tracked lack the column
+            if "keyed" not in {row[1] for row in conn.execute("PRAGMA table_info(batch_jobs)")}:
+                conn.execute("ALTER TABLE batch_jobs ADD COLUMN keyed INTEGER NOT NULL DEFAULT 0")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS batch_units ("
+                "job_id TEXT NOT NULL, unit_key TEXT NOT NULL, card_index INTEGER NOT NULL, fight_index INTEGER NOT NULL, "
+                "status TEXT NOT NULL, analysis TEXT, error TEXT, PRIMARY KEY (job_id, unit_key))"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=5.0)
+
+    def _create(self, job_id: str, batch: CardBatch, units: Dict[str, Tuple[int, int]]) -> None:
+        now = time.time()
+        # API keys stay in memory, so a keyed job cannot resume after a restart
+        request = batch.model_dump_json(exclude={"cards": {"__all__": {"api_keys"}}})
+        keyed = any(card.api_keys for card in batch.cards)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO batch_jobs VALUES (?, 'queued', ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, request, len(batch.cards), sum(len(card.fights) for card in batch.cards), len(units), now, now, keyed),
+            )
+            conn.executemany(
+                "INSERT INTO batch_units (job_id, unit_key, card_index, fight_index, status) VALUES (?, ?, ?, ?, ?)",
+                [(job_id, key, card_index, fight_index, UNIT_PENDING) for key, (card_index, fight_index) in units.items()],
+            )
+
+    def _set_status(self, job_id: str, status: str) -> None:
+        with self._connect() as conn:
+            conn.execute("UPDATE batch_jobs SET status = ?, updated_at = ? WHERE job_id = ?", (status, time.time(), job_id))
+
+    def _finish_unit(self, job_id: str, unit_key: str, analysis: Optional[FightAnalysis], error: Optional[str]) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE batch_units SET status = ?, analysis = ?, error = ? WHERE job_id = ? AND unit_key = ?",
+                (UNIT_DONE if analysis else UNIT_FAILED, analysis.model_dump_json() if analysis else None, error, job_id, unit_key),
+            )
+            conn.execute("UPDATE batch_jobs SET updated_at = ? WHERE job_id = ?", (time.time(), job_id))
+
+    def _fail_pending(self, job_id: str, error: str) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE batch_units SET status = ?, error = ? WHERE job_id = ? AND status = ?", (UNIT_FAILED, error, job_id, UNIT_PENDING)
+            )
+            conn.execute("UPDATE batch_jobs SET status = 'failed', updated_at = ? WHERE job_id = ?", (time.time(), job_id))
+
+    def _status(self, job_id: str) -> Optional[BatchJobStatus]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT status, cards, fights, unique_fights, created_at, updated_at FROM batch_jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM batch_units WHERE job_id = ? GROUP BY status", (job_id,)).fetchall())
+        status, cards, fights, unique_fights, created_at, updated_at = row
+        return BatchJobStatus(
+            job_id=job_id, status=status, cards=cards, fights=fights, unique_fights=unique_fights,
+            completed_fights=counts.get(UNIT_DONE, 0), failed_fights=counts.get(UNIT_FAILED, 0),
+            created_at=created_at, updated_at=updated_at,
+        )
+
+    def _request(self, job_id: str) -> Optional[CardBatch]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT request FROM batch_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return CardBatch.model_validate_json(row[0]) if row else None
+
+    def _units(self, job_id: str) -> Dict[str, Tuple[str, Optional[str], Optional[str]]]:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT unit_key, status, analysis, error FROM batch_units WHERE job_id = ?", (job_id,)).fetchall()
+        return {key: (status, analysis, error) for key, status, analysis, error in rows}
+
+    def _unfinished_jobs(self) -> List[Tuple[str, bool]]:
+        with self._connect() as conn:
+            return [
+                (job_id, bool(keyed)) for job_id, keyed in
+                conn.execute("SELECT job_id, keyed FROM batch_jobs WHERE status IN ('queued', 'running') ORDER BY created_at")
+            ]
+
+    async def create(self, job_id: str, batch: CardBatch, units: Dict[str, Tuple[int, int]]) -> None:
+        await asyncio.to_thread(self._create, job_id, batch, units)
+
+    async def set_status(self, job_id: str, status: str) -> None:
+        await asyncio.to_thread(self._set_status, job_id, status)
+
+    async def finish_unit(self, job_id: str, unit_key: str, analysis: Optional[FightAnalysis], error: Optional[str] = None) -> None:
+        await asyncio.to_thread(self._finish_unit, job_id, unit_key, analysis, error)
+
+    async def fail_pending(self, job_id: str, error: str) -> None:
+        await asyncio.to_thread(self._fail_pending, job_id, error)
+
+    async def status(self, job_id: str) -> Optional[BatchJobStatus]:
+        return await asyncio.to_thread(self._status, job_id)
+
+    async def request(self, job_id: str) -> Optional[CardBatch]:
+        return await asyncio.to_thread(self._request, job_id)
+
+    async def units(self, job_id: str) -> Dict[str, Tuple[str, Optional[str], Optional[str]]]:
+        return await asyncio.to_thread(self._units, job_id)
+
+    async def unfinished_jobs(self) -> List[Tuple[str, bool]]:
+        return await asyncio.to_thread(self._unfinished_jobs)
+
+
+class BatchJobRunner:
+    """Runs batch jobs in the background: each unique fight once, progress persisted as fights finish"""
+
+    def __init__(self, store: BatchJobStore):
+        self.store = store
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    async def submit(self, batch: CardBatch) -> BatchJobStatus:
+        job_id = uuid4().hex
+        units = plan_units(batch)
+        await self.store.create(job_id, batch, units)
+        logger.info(f"Batch job {job_id}: {len(batch.cards)} cards, {len(units)} unique fights")
+        self._start(job_id, batch)
+        return await self.store.status(job_id)
+
+    def _start(self, job_id: str, batch: CardBatch) -> None:
+        task = asyncio.ensure_future(self._run(job_id, batch))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def resume(self) -> None:
+        """Restart jobs left unfinished by a previous process; finished fights are not analyzed again"""
+        for job_id, keyed in await self.store.unfinished_jobs():
+            if job_id in self._tasks:
+                continue
+            if keyed:
+                # The keys were never stored, and the server's own keys must not run a tenant's work
+                logger.warning(f"Batch job {job_id} carried API keys and cannot resume after a restart; failing its unfinished fights")
+                await self.store.fail_pending(job_id, "interrupted by a server restart; batches with api_keys do not resume, resubmit it")
+                continue
+            batch = await self.store.request(job_id)
+            logger.info(f"Resuming batch job {job_id}")
+            self._start(job_id, batch)
+
+    async def _run(self, job_id: str, batch: CardBatch) -> None:
+        await self.store.set_status(job_id, "running")
+        done = await self.store.units(job_id)
+        semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENT_FIGHTS)
+
+        async def analyze(unit_key: str, card_index: int, fight_index: int) -> None:
+            card = batch.cards[card_index]
+            fight = card.fights[fight_index]
+            async with semaphore:
+                try:
+                    result = await self._analyze(card.model_copy(update={
+                        "fights": [fight], "shard_by_fight": False, "include_trace": False
+                    }), batch.provider_batch)
+                    if not result.analyses:
+                        raise ValueError("no analysis produced")
+                    await self.store.finish_unit(job_id, unit_key, result.analyses[0])
+                except Exception as e:
+                    logger.error(f"Batch job {job_id}: fight {fight.fight_id} failed: {e}")
+                    await self.store.finish_unit(job_id, unit_key, None, str(e))
+
+        pending = [
+            (key, card_index, fight_index) for key, (card_index, fight_index) in plan_units(batch).items()
+            if done.get(key, (UNIT_PENDING,))[0] == UNIT_PENDING
+        ]
+        # A job cancelled at shutdown stays "running" and resumes on the next start
+        await asyncio.gather(*(analyze(*unit) for unit in pending))
+        status = await self.store.status(job_id)
+        final = "failed" if status.unique_fights and status.failed_fights == status.unique_fights else "completed"
+        await self.store.set_status(job_id, final)
+        logger.info(f"Batch job {job_id} {final}: {status.completed_fights} fights analyzed, {status.failed_fights} failed")
+
+    async def _analyze(self, card: Card, provider_batch: bool) -> CardAnalysis:
+        with provider_batch_mode(provider_batch):
+            if provider_batch:
+                # Provider batches wait hours in the provider's own queue; an active-card slot held that long would block live cards
+                return await analyze_card_pipeline(card)
+            while True:
+                try:
+                    # Live batch fights take their turn in the fair admission queue like any other card
+                    async with get_scheduler().admit():
+                        return await analyze_card_pipeline(card)
+                except AdmissionRejected as e:
+                    await asyncio.sleep(e.retry_after)
+
+    async def results(self, job_id: str) -> Optional[BatchJobResults]:
+        """Per-card results assembled from the unique fight analyses, partial while the job runs"""
+        status = await self.store.status(job_id)
+        if status is None:
+            return None
+        batch = await self.store.request(job_id)
+        units = await self.store.units(job_id)
+        results = []
+        for card_index, card in enumerate(batch.cards):
+            result = BatchCardResult(card_index=card_index, analyses=[])
+            for fight in card.fights:
+                unit_status, analysis, error = units.get(fight_unit_key(card, fight), (UNIT_PENDING, None, None))
+                if unit_status == UNIT_DONE:
+                    # Shared fights keep the id each card gave them
+                    result.analyses.append(FightAnalysis.model_validate_json(analysis).model_copy(update={"fight_id": fight.fight_id}))
+                elif unit_status == UNIT_FAILED:
+                    result.failed_fights[fight.fight_id] = error or "failed"
+                else:
+                    result.pending_fights.append(fight.fight_id)
+            results.append(result)
+        return BatchJobResults(job=status, results=results)
+
+    async def aclose(self) -> None:
+        for task in list(self._tasks.values()):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+
+_runner: Optional[BatchJobRunner] = None
+
+
+def get_batch_runner() -> BatchJobRunner:
+    global _runner
+    if _runner is None:
+        _runner = BatchJobRunner(BatchJobStore())
+    return _runner
@@ -0,0 +1,245 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from loguru import logger
+from pydantic import BaseModel
+
+from app.config import CACHE_BACKEND, CACHE_MAX_ENTRIES, CACHE_SQLITE_PATH, CACHE_TTL_SECONDS
+from app.metrics import mark_cache_hit
+from app.models import Fight
+from app.redis_client import get_redis, redis_key
+
+# Per-request cache modes (Card.cache_mode)
+CACHE_USE = "use"          # serve hits, store misses
+CACHE_REFRESH = "refresh"  # skip lookup, overwrite with a fresh result
+CACHE_BYPASS = "bypass"    # neither read nor write
+
+
+class CacheBackend(ABC):
+    """Storage for serialized agent responses keyed by content hash"""
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        ...
+
+    @abstractmethod
+    async def clear(self) -> None:
+        ...
+
+
+class MemoryCache(CacheBackend):
+    """In-process LRU cache with per-entry TTL"""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        # Streamlit reruns execute on separate threads
+        self._lock = threading.Lock()
+
+    async def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._entries[key] = (time.time() + (ttl or self.ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteCache(CacheBackend):
+    """On-disk cache that survives restarts and is shared between local processes"""
+
+    def __init__(self, path: str = CACHE_SQLITE_PATH, ttl: float = CACHE_TTL_SECONDS):
+        self.path = path
+        self.ttl = ttl
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS agent_responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_agent_responses_expires ON agent_responses (expires_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=5.0)
+
+    def _get(self, key: str) -> Optional[str]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value FROM agent_responses WHERE key = ? AND expires_at >= ?", (key, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def _set(self, key: str, value: str, ttl: Optional[float]) -> None:
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO agent_responses (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, now + (ttl or self.ttl)),
+            )
+            conn.execute("DELETE FROM agent_responses WHERE expires_at < ?", (now,))
+
+    def _clear(self) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM agent_responses")
+
+    async def get(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        await asyncio.to_thread(self._set, key, value, ttl)
+
+    async def clear(self) -> None:
+        await asyncio.to_thread(self._clear)
+
+
+class RedisCache(CacheBackend):
+    """Cache on a shared Redis-protocol server, so every API replica serves the others' responses"""
+
+    def __init__(self, namespace: str = "cache", ttl: float = CACHE_TTL_SECONDS):
+        self.namespace = namespace
+        self.ttl = ttl
+
+    async def get(self, key: str) -> Optional[str]:
+        return await get_redis().get(redis_key(self.namespace, key))
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        await get_redis().set(redis_key(self.namespace, key), value, px=int((ttl or self.ttl) * 1000))
+
+    async def clear(self) -> None:
+        client = get_redis()
+        batch = []
+        async for key in client.scan_iter(match=redis_key(self.namespace, "*"), count=500):
+            batch.append(key)
+            if len(batch) >= 500:
+                await client.unlink(*batch)
+                batch = []
+        if batch:
+            await client.unlink(*batch)
+
+
+def _jsonable(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    raise TypeError(f"Cannot serialize {type(value).__name__} for caching")
+
+
+def normalize_fights(fights: List[Fight]) -> List[Dict[str, Any]]:
+    """Canonical form of a fight list: unset fields dropped, strings trimmed"""
+    return [
+        {k: v.strip() if isinstance(v, str) else v for k, v in fight.model_dump(exclude_none=True).items()}
+        for fight in fights
+    ]
+
+
+def agent_cache_key(agent_type: str, model_name: str, system_prompt: str, temperature: Optional[float],
+                    top_p: Optional[float], tools: List[str], inputs: Any) -> str:
+    """Content hash of everything that determines an agent's response"""
+    material = json.dumps(
+        {
+            "agent": agent_type,
+            "model": model_name,
+            "system_prompt": system_prompt,
+            "temperature": temperature,
+            "top_p": top_p,
+            "tools": sorted(tools),
+            "inputs": inputs,
+        },
+        sort_keys=True,
+        default=_jsonable,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Agent response cache with hit/miss accounting per agent"""
+
+    def __init__(self, backend: Optional[CacheBackend]):
+        self.backend = backend
+        self.counters: Dict[str, Dict[str, int]] = defaultdict(lambda: {"hits": 0, "misses": 0, "stores": 0, "bypasses": 0})
+
+    async def lookup(self, key: str, agent_type: str, mode: str = CACHE_USE) -> Optional[Any]:
+        """Return the cached response for key, or None when absent or not allowed by mode"""
+        if self.backend is None or mode != CACHE_USE:
+            self.counters[agent_type]["bypasses"] += 1
+            return None
+        try:
+            raw = await self.backend.get(key)
+        except Exception as e:
+            logger.warning(f"Cache lookup failed for {agent_type}: {e}")
+            raw = None
+        if raw is None:
+            self.counters[agent_type]["misses"] += 1
+            return None
+        self.counters[agent_type]["hits"] += 1
+        mark_cache_hit()
+        logger.info(f"Cache hit for {agent_type} agent")
+        return json.loads(raw)
+
+    async def store(self, key: str, agent_type: str, value: Any, mode: str = CACHE_USE) -> None:
+        """Persist a successful response unless the request bypasses the cache"""
+        if self.backend is None or mode == CACHE_BYPASS:
+            return
+        try:
+            await self.backend.set(key, json.dumps(value, default=_jsonable))
+            self.counters[agent_type]["stores"] += 1
+        except Exception as e:
+            logger.warning(f"Cache store failed for {agent_type}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        totals = {"hits": 0, "misses": 0, "stores": 0, "bypasses": 0}
+        for counts in self.counters.values():
+            for name, count in counts.items():
+                totals[name] += count
+        lookups = totals["hits"] + totals["misses"]
+        return {
+            "backend": type(self.backend).__name__ if self.backend else None,
+            "hit_rate": round(totals["hits"] / lookups, 4) if lookups else None,
+            "totals": totals,
+            "agents": dict(self.counters),
+        }
+
+
+def build_cache_backend(kind: str = CACHE_BACKEND) -> Optional[CacheBackend]:
+    if kind == "memory":
+        return MemoryCache()
+    if kind == "sqlite":
+        return SQLiteCache()
+    if kind == "redis":
+        return RedisCache()
+    if kind in ("none", "off", ""):
+        return None
+    raise ValueError(f"Unknown cache backend: {kind}")
+
+
+response_cache = ResponseCache(build_cache_backend())
@@ -1,5 +1,7 @@
 import os
-from typing import Dict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional
 from dotenv import load_dotenv
 from loguru import logger
 
@@ -14,7 +16,21 @@ AGENT_MODELS = {
     "market_odds": "gpt-5-mini",
     "judge": "gpt-5",
     "risk_scorer": "gpt-5-mini",
-    "consistency_checker": "claude-3-5-haiku-20241022"
+    "consistency_checker": "claude-3-5-haiku-20241022",
+    "post_review": "gpt-5-mini"  # risk + consistency in one call (combined post-processing)
+}
+
+# Ordered fallback models tried after an agent's primary model keeps failing transiently or its provider's circuit is open
+AGENT_FALLBACK_MODELS = {
+    "tape_study": ["gpt-5", "gemini-2.5-pro"],
+    "stats_trends": ["claude-3-7-sonnet-20250219", "gemini-2.5-pro"],
+    "news_weighins": ["gpt-5", "claude-3-7-sonnet-20250219"],
+    "style_matchup": ["gpt-5", "gemini-2.5-pro"],
+    "market_odds": ["claude-3-5-haiku-20241022", "gemini-2.5-flash"],
+    "judge": ["claude-3-7-sonnet-20250219", "gemini-2.5-pro"],
+    "risk_scorer": ["claude-3-5-haiku-20241022", "gemini-2.5-flash"],
+    "consistency_checker": ["gpt-5-mini", "gemini-2.5-flash"],
+    "post_review": ["claude-3-5-haiku-20241022", "gemini-2.5-flash"]
 }
 
 # Agent temperature settings for custom control
@@ -26,7 +42,8 @@ AGENT_TEMPERATURES = {
     "market_odds": 0.0,       # GPT-5 mini temperature
     "judge": 0.0,             # GPT-5 Thinking (JSON mode) temperature
     "risk_scorer": 0.0,       # GPT-5 mini temperature
-    "consistency_checker": 0.05  # Claude 3.7 Haiku temperature
+    "consistency_checker": 0.05,  # Claude 3.7 Haiku temperature
+    "post_review": 0.0        # GPT-5 mini temperature
 }
 
 # Agent top-p settings for custom control
@@ -38,8 +55,207 @@ AGENT_TOP_PS = {
     "market_odds": 0.8,       # GPT-5 mini top-p
     "judge": 0.5,             # GPT-5 Thinking (JSON mode) top-p for precision
     "risk_scorer": 0.8,       # GPT-5 mini top-p
-    "consistency_checker": 0.7  # Claude 3.7 Haiku top-p for balanced precision/creativity
+    "consistency_checker": 0.7,  # Claude 3.7 Haiku top-p for balanced precision/creativity
+    "post_review": 0.8        # GPT-5 mini top-p
+}
+
+# Per-agent deadline in seconds covering all retries and hedges of one agent call
+AGENT_TIMEOUTS = {
+    "tape_study": 180.0,
+    "stats_trends": 180.0,
+    "news_weighins": 180.0,
+    "style_matchup": 180.0,
+    "market_odds": 120.0,
+    "judge": 240.0,
+    "risk_scorer": 120.0,
+    "consistency_checker": 120.0,
+    "post_review": 150.0
+}
+
+# Per-agent attempts (first try + retries) on retryable provider errors
+AGENT_MAX_ATTEMPTS = {
+    "tape_study": 3,
+    "stats_trends": 3,
+    "news_weighins": 3,
+    "style_matchup": 3,
+    "market_odds": 3,
+    "judge": 3,
+    "risk_scorer": 2,
+    "consistency_checker": 2,
+    "post_review": 2
+}
+
+# Alternate model raced against a slow primary call (None disables hedging for the agent)
+AGENT_HEDGE_MODELS = {
+    "tape_study": None,
+    "stats_trends": None,
+    "news_weighins": None,
+    "style_matchup": None,
+    "market_odds": None,
+    "judge": None,
+    "risk_scorer": None,
+    "consistency_checker": None,
+    "post_review": None
+}
+
+# Exponential backoff with full jitter between retries
+RETRY_BASE_DELAY_SECONDS = float(os.getenv("RETRY_BASE_DELAY_SECONDS", "1.0"))
+RETRY_MAX_DELAY_SECONDS = float(os.getenv("RETRY_MAX_DELAY_SECONDS", "20.0"))
+# A hedge fires once the primary call is slower than this percentile of the agent's recent latencies
+HEDGE_LATENCY_PERCENTILE = float(os.getenv("HEDGE_LATENCY_PERCENTILE", "90"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+# Hedge delay used until an agent has HEDGE_MIN_SAMPLES latency samples
+HEDGE_DEFAULT_DELAY_SECONDS = float(os.getenv("HEDGE_DEFAULT_DELAY_SECONDS", "60"))
+
+# Per-provider circuit breakers: trip on the error or slow-call rate over a rolling window, then
+# route around the provider for the cooldown before letting a single probe call through
+BREAKER_WINDOW_SECONDS = float(os.getenv("BREAKER_WINDOW_SECONDS", "60"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_CALL_SECONDS = float(os.getenv("BREAKER_SLOW_CALL_SECONDS", "120"))
+BREAKER_SLOW_CALL_RATE = float(os.getenv("BREAKER_SLOW_CALL_RATE", "0.8"))
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("BREAKER_COOLDOWN_SECONDS", "60"))
+
+# Upper bound on worker threads used for providers and tools without native async support
+SYNC_EXECUTOR_MAX_WORKERS = int(os.getenv("SYNC_EXECUTOR_MAX_WORKERS", "16"))
+
+# Global cap on fights analyzed concurrently when cards run in per-fight sharded mode (0 = unlimited;
+# provider calls are already bounded by the per-provider scheduler slots)
+MAX_CONCURRENT_FIGHTS = int(os.getenv("MAX_CONCURRENT_FIGHTS", "0"))
+
+# Per-agent cap on concurrent pipeline stages across all requests (0 = unlimited), e.g. to keep
+# expensive judge calls from piling up when many cards run at once
+AGENT_MAX_CONCURRENCY = {
+    "tape_study": 0,
+    "stats_trends": 0,
+    "news_weighins": 0,
+    "style_matchup": 0,
+    "market_odds": 0,
+    "judge": int(os.getenv("JUDGE_MAX_CONCURRENCY", "0")),
+    "risk_scorer": 0,
+    "consistency_checker": 0,
+    "post_review": 0
+}
+
+# Analyst reports the judge waits for before it may start (0 = wait for all five), and how long
+# stragglers still get once the quorum is in before the judge starts without them
+JUDGE_QUORUM = int(os.getenv("JUDGE_QUORUM", "0"))
+JUDGE_GRACE_SECONDS = float(os.getenv("JUDGE_GRACE_SECONDS", "15"))
+
+# Post-judge review: "sequential" (risk scorer then consistency checker), "combined" (one call doing
+# both) or "concurrent" (both at once on the judge output, merged per fight)
+POST_PROCESSING_MODE = os.getenv("POST_PROCESSING_MODE", "sequential")
+
+# Which fights get the LLM post review: "llm" (all), "rules" (none, deterministic rules only) or
+# "auto" (only fights matching one of POST_REVIEW_RULES; the rest get the deterministic rules)
+POST_REVIEW_POLICY = os.getenv("POST_REVIEW_POLICY", "llm")
+POST_REVIEW_RULES = [r.strip() for r in os.getenv("POST_REVIEW_RULES", "high_confidence,toss_up,low_agreement,missing_analysts,no_risk_flags").split(",") if r.strip()]
+POST_REVIEW_HIGH_CONFIDENCE = int(os.getenv("POST_REVIEW_HIGH_CONFIDENCE", "85"))
+POST_REVIEW_LOW_CONFIDENCE = int(os.getenv("POST_REVIEW_LOW_CONFIDENCE", "55"))
+POST_REVIEW_MIN_AGREEMENT = float(os.getenv("POST_REVIEW_MIN_AGREEMENT", "0.6"))
+POST_REVIEW_MIN_ANALYSTS = int(os.getenv("POST_REVIEW_MIN_ANALYSTS", "4"))
+
+# Deterministic post-processing rules (also the fallback when an LLM review fails)
+RULE_OVERCONFIDENCE_THRESHOLD = int(os.getenv("RULE_OVERCONFIDENCE_THRESHOLD", "90"))
+RULE_RISK_FLAG_PENALTY = int(os.getenv("RULE_RISK_FLAG_PENALTY", "10"))
+RULE_CONFIDENCE_FLOOR = int(os.getenv("RULE_CONFIDENCE_FLOOR", "50"))
+
+# Batch card jobs (/analyze-cards): progress store, and fights analyzed at once per job
+BATCH_SQLITE_PATH = os.getenv("BATCH_SQLITE_PATH", ".cache/batch_jobs.sqlite3")
+BATCH_MAX_CONCURRENT_FIGHTS = int(os.getenv("BATCH_MAX_CONCURRENT_FIGHTS", "32"))
+# Provider batch APIs: calls collected for up to BATCH_FLUSH_SECONDS (or BATCH_MAX_REQUESTS) form one
+# batch, polled every BATCH_POLL_SECONDS; agent deadlines stretch to BATCH_AGENT_TIMEOUT_SECONDS
+BATCH_FLUSH_SECONDS = float(os.getenv("BATCH_FLUSH_SECONDS", "5"))
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "1000"))
+BATCH_POLL_SECONDS = float(os.getenv("BATCH_POLL_SECONDS", "30"))
+BATCH_AGENT_TIMEOUT_SECONDS = float(os.getenv("BATCH_AGENT_TIMEOUT_SECONDS", str(24 * 60 * 60)))
+# Turnaround of the local batch simulator used for the fake provider
+BATCH_SIMULATED_TURNAROUND_SECONDS = float(os.getenv("BATCH_SIMULATED_TURNAROUND_SECONDS", "1"))
+
+# Background card jobs (/analyze-card?background=true): queue backend ("sqlite", "memory" or "redis"), worker tasks
+# per process, queued jobs allowed before 429, and how often idle workers poll a queue shared between processes
+JOB_QUEUE_BACKEND = os.getenv("JOB_QUEUE_BACKEND", "sqlite").lower()
+JOB_SQLITE_PATH = os.getenv("JOB_SQLITE_PATH", ".cache/card_jobs.sqlite3")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", "256"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+# Running jobs hold a lease renewed while their worker lives; an expired lease lets another worker take the job over
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+
+# Every analyzed card is persisted here (with agent outputs, models and parameters) for later lookup
+ANALYSIS_STORE_ENABLED = os.getenv("ANALYSIS_STORE_ENABLED", "true").lower() in ("1", "true", "yes")
+ANALYSIS_STORE_PATH = os.getenv("ANALYSIS_STORE_PATH", ".cache/analyses.sqlite3")
+# Re-analyzing a stored card recomputes only fights and agents whose inputs or configuration changed
+INCREMENTAL_ANALYSIS = os.getenv("INCREMENTAL_ANALYSIS", "true").lower() in ("1", "true", "yes")
+# Upper bound on rows returned by one /analyses query
+ANALYSIS_QUERY_MAX_LIMIT = int(os.getenv("ANALYSIS_QUERY_MAX_LIMIT", "500"))
+
+# Agent response cache: "memory" (LRU + TTL), "sqlite" (on disk), "redis" (shared by all replicas) or "none"
+CACHE_BACKEND = os.getenv("AGENT_CACHE_BACKEND", "memory")
+CACHE_TTL_SECONDS = float(os.getenv("AGENT_CACHE_TTL_SECONDS", str(6 * 60 * 60)))
+CACHE_MAX_ENTRIES = int(os.getenv("AGENT_CACHE_MAX_ENTRIES", "2048"))
+CACHE_SQLITE_PATH = os.getenv("AGENT_CACHE_SQLITE_PATH", ".cache/agent_responses.sqlite3")
+
+# Shared state for running several API replicas: the Redis-protocol server behind the "redis" cache, job queue
+# and rate-limit backends; keys live under REDIS_KEY_PREFIX so deployments can share one server
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "ufc:")
+# Finished jobs in the Redis queue expire after this long
+REDIS_JOB_TTL_SECONDS = float(os.getenv("REDIS_JOB_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+# Provider concurrency and token budgets: "local" (per process) or "redis" (one budget across replicas)
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "local").lower()
+# A shared provider slot held by a replica that died is freed after this long
+RATE_LIMIT_LEASE_SECONDS = float(os.getenv("RATE_LIMIT_LEASE_SECONDS", "120"))
+
+# Shared HTTP connection pool for LLM provider clients
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "100"))
+LLM_HTTP_MAX_KEEPALIVE = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE", "20"))
+LLM_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("LLM_HTTP_KEEPALIVE_EXPIRY", "30"))
+# Pooled client instances unused for this long are dropped from the registry and closed
+LLM_CLIENT_IDLE_TTL_SECONDS = float(os.getenv("LLM_CLIENT_IDLE_TTL_SECONDS", "900"))
+
+# Serper web search client
+SERPER_TIMEOUT_SECONDS = float(os.getenv("SERPER_TIMEOUT_SECONDS", "10"))
+SERPER_MAX_CONNECTIONS = int(os.getenv("SERPER_MAX_CONNECTIONS", "20"))
+SERPER_CACHE_TTL_SECONDS = float(os.getenv("SERPER_CACHE_TTL_SECONDS", str(60 * 60)))
+SERPER_CACHE_MAX_ENTRIES = int(os.getenv("SERPER_CACHE_MAX_ENTRIES", "1024"))
+SERPER_MAX_QUERIES_PER_REQUEST = int(os.getenv("SERPER_MAX_QUERIES_PER_REQUEST", "20"))
+
+# Shared research prefetch (Card.research_prefetch)
+RESEARCH_MAX_SNIPPETS_PER_FIGHT = int(os.getenv("RESEARCH_MAX_SNIPPETS_PER_FIGHT", "12"))
+RESEARCH_MAX_SNIPPET_CHARS = int(os.getenv("RESEARCH_MAX_SNIPPET_CHARS", "280"))
+
+# Lifetime of explicit Gemini context caches holding the static system prompts
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = float(os.getenv("GEMINI_CONTEXT_CACHE_TTL_SECONDS", "3600"))
+
+# Admission control for /analyze-card: cards analyzed at once, and cards allowed to wait before 429
+MAX_ACTIVE_CARDS = int(os.getenv("MAX_ACTIVE_CARDS", "8"))
+MAX_QUEUED_CARDS = int(os.getenv("MAX_QUEUED_CARDS", "32"))
+
+# Per-provider ceilings shared by all requests (0 = unlimited); Serper's per-minute budget counts queries
+PROVIDER_MAX_CONCURRENCY = {
+    "openai": int(os.getenv("OPENAI_MAX_CONCURRENCY", "16")),
+    "anthropic": int(os.getenv("ANTHROPIC_MAX_CONCURRENCY", "8")),
+    "google": int(os.getenv("GOOGLE_MAX_CONCURRENCY", "8")),
+    "serper": int(os.getenv("SERPER_MAX_CONCURRENCY", "10")),
+    "fake": int(os.getenv("FAKE_MAX_CONCURRENCY", "0")),
 }
+PROVIDER_TOKENS_PER_MINUTE = {
+    "openai": int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "500000")),
+    "anthropic": int(os.getenv("ANTHROPIC_TOKENS_PER_MINUTE", "200000")),
+    "google": int(os.getenv("GOOGLE_TOKENS_PER_MINUTE", "1000000")),
+    "serper": int(os.getenv("SERPER_QUERIES_PER_MINUTE", "0")),
+    "fake": int(os.getenv("FAKE_TOKENS_PER_MINUTE", "0")),
+}
+# Output tokens reserved up front per agent call; reconciled against reported usage afterwards
+AGENT_EXPECTED_OUTPUT_TOKENS = int(os.getenv("AGENT_EXPECTED_OUTPUT_TOKENS", "1500"))
+
+# Offline fake provider used by AGENT_MODELS entries starting with "fake" (benchmarks, local runs)
+FAKE_LLM_LATENCY_SECONDS = float(os.getenv("FAKE_LLM_LATENCY_SECONDS", "0.5"))  # median latency
+FAKE_LLM_LATENCY_SIGMA = float(os.getenv("FAKE_LLM_LATENCY_SIGMA", "0.3"))  # log-normal spread, 0 = constant
+FAKE_LLM_FAILURE_RATE = float(os.getenv("FAKE_LLM_FAILURE_RATE", "0.0"))
+FAKE_LLM_OUTPUT_TOKENS = int(os.getenv("FAKE_LLM_OUTPUT_TOKENS", "400"))
+FAKE_LLM_SEED = int(os.getenv("FAKE_LLM_SEED", "0"))
 
 # API Keys
 API_KEYS = {
@@ -60,24 +276,51 @@ def get_temperature_for_agent(agent_type: str) -> float:
 def get_top_p_for_agent(agent_type: str) -> float:
     return AGENT_TOP_PS.get(agent_type, 0.9)  # default top-p
 
+def get_timeout_for_agent(agent_type: str) -> float:
+    return AGENT_TIMEOUTS.get(agent_type, 180.0)  # default deadline
+
+def get_max_attempts_for_agent(agent_type: str) -> int:
+    return AGENT_MAX_ATTEMPTS.get(agent_type, 3)  # default attempts
+
+def get_hedge_model_for_agent(agent_type: str) -> Optional[str]:
+    return AGENT_HEDGE_MODELS.get(agent_type)
+
+def get_fallback_models_for_agent(agent_type: str) -> List[str]:
+    return AGENT_FALLBACK_MODELS.get(agent_type, [])
+
+# Keys supplied with the request being processed; each asyncio task sees its own copy
+_request_api_keys: ContextVar[Optional[Dict[str, str]]] = ContextVar("request_api_keys", default=None)
+
 def get_api_key(provider: str, runtime_keys: Dict[str, str] = None) -> str:
-    """Get API key either from runtime keys or environment variables"""
-    if runtime_keys and provider in runtime_keys:
-        return runtime_keys[provider]
+    """Get API key from explicit runtime keys, then the current request's keys, then environment variables"""
+    for keys in (runtime_keys, _request_api_keys.get()):
+        if keys and keys.get(provider):
+            return keys[provider]
     return API_KEYS.get(provider)
 
 
-def set_runtime_api_keys(runtime_keys: Dict[str, str] = None):
-    """Temporarily set environment variables for runtime API keys"""
-    if runtime_keys:
-        env_mapping = {
-            "openai": "OPENAI_API_KEY",
-            "anthropic": "ANTHROPIC_API_KEY",
-            "google": "GOOGLE_API_KEY",
-            "serper": "SERPER_API_KEY"
-        }
-        for provider, key in runtime_keys.items():
-            env_var = env_mapping.get(provider)
-            if env_var and key:
-                os.environ[env_var] = key
-                logger.info(f"Set runtime API key for {provider}")
+@contextmanager
+def request_api_keys(runtime_keys: Dict[str, str] = None) -> Iterator[None]:
+    """Scope runtime API keys to the current request without touching process-wide state"""
+    token = _request_api_keys.set(dict(runtime_keys) if runtime_keys else None)
+    try:
+        yield
+    finally:
+        _request_api_keys.reset(token)
+
+
+# Set while a batch job routes agent calls through provider batch APIs
+_provider_batch_mode: ContextVar[bool] = ContextVar("provider_batch_mode", default=False)
+
+def batch_mode_enabled() -> bool:
+    return _provider_batch_mode.get()
+
+
+@contextmanager
+def provider_batch_mode(enabled: bool = True) -> Iterator[None]:
+    """Send LLM calls made in this context through provider batch APIs where available"""
+    token = _provider_batch_mode.set(enabled)
+    try:
+        yield
+    finally:
+        _provider_batch_mode.reset(token)
@@ -0,0 +1,262 @@
+import asyncio
+import functools
+import weakref
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Sequence
+
+from loguru import logger
+
+from app.cache import CACHE_USE, response_cache
+from app.metrics import current_call, record_agent_call
+from app.models import AgentOutputRecord, PipelineEvent
+
+# Dependency results by node name; failed, cancelled and skipped dependencies are None
+NodeInputs = Dict[str, Any]
+EventCallback = Callable[[PipelineEvent], None]
+
+
+class Node:
+    """One step of a pipeline graph: an async function of its dependencies' results"""
+
+    def __init__(self, name: str, run: Callable[[NodeInputs], Awaitable[Any]], deps: Sequence[str] = (),
+                 optional: Sequence[str] = (), min_deps: int = 0, quorum: Optional[int] = None, grace: float = 0.0, traced: bool = True,
+                 cache_key: Optional[Callable[[NodeInputs], Optional[str]]] = None,
+                 decode: Optional[Callable[[Any], Any]] = None, store_if: Optional[Callable[[Any], bool]] = None,
+                 fallback: Optional[Callable[[NodeInputs], Any]] = None, run_if: Optional[Callable[[NodeInputs], bool]] = None):
+        self.name = name
+        self.run = run
+        self.deps = list(deps)
+        # Dependencies whose failure the node tolerates, as long as `min_deps` dependencies succeed
+        self.optional = set(optional)
+        self.min_deps = min_deps
+        # Start once this many dependencies succeeded and the rest had `grace` more seconds
+        self.quorum = quorum if quorum and 0 < quorum < len(self.deps) else None
+        self.grace = grace
+        # Traced nodes are agent stages: started/finished events and a trace entry
+        self.traced = traced
+        self.cache_key = cache_key
+        self.decode = decode
+        self.store_if = store_if
+        # Result to use when the node fails (after its hooks saw the failure)
+        self.fallback = fallback
+        # Skipped nodes produce None without running or tracing
+        self.run_if = run_if
+
+
+class NodeHook:
+    """Wraps every node execution; hooks are applied outermost first"""
+
+    async def around(self, node: Node, inputs: NodeInputs, call: Callable[[], Awaitable[Any]]) -> Any:
+        return await call()
+
+    def abandoned(self, node: Node, reason: str) -> None:
+        """A node still running was cancelled because its consumer started without it"""
+
+    def skipped(self, node: Node) -> None:
+        """A node's run_if declined to run it"""
+
+
+class TracingHook(NodeHook):
+    """Stage events and per-call trace entries for agent nodes"""
+
+    def __init__(self, on_event: Optional[EventCallback] = None, fight_id: Optional[str] = None):
+        self.on_event = on_event
+        self.fight_id = fight_id
+
+    def _emit(self, event: str, node: Node, **fields: Any) -> None:
+        if self.on_event:
+            self.on_event(PipelineEvent(event=event, agent=node.name, fight_id=self.fight_id, **fields))
+
+    async def around(self, node: Node, inputs: NodeInputs, call: Callable[[], Awaitable[Any]]) -> Any:
+        if not node.traced:
+            return await call()
+        self._emit("agent_started", node)
+        with record_agent_call(node.name, self.fight_id):
+            try:
+                result = await call()
+            except Exception as e:
+                logger.error(f"Error in {node.name} agent: {e}")
+                self._emit("agent_failed", node, detail=str(e))
+                raise
+        self._emit("agent_finished", node)
+        return result
+
+    def abandoned(self, node: Node, reason: str) -> None:
+        if node.traced:
+            self._emit("agent_failed", node, detail=reason)
+
+
+class RecordingHook(NodeHook):
+    """Collects the outcome of every traced node: its output when it succeeds, cached or not, else how it ended"""
+
+    def __init__(self, sink: List[AgentOutputRecord], fight_id: Optional[str] = None):
+        self.sink = sink
+        self.fight_id = fight_id
+
+    def _record(self, node: Node, status: str, output: Any = None, model: Optional[str] = None) -> None:
+        if node.traced:
+            self.sink.append(AgentOutputRecord(agent=node.name, fight_id=self.fight_id, model=model, status=status, output=output))
+
+    async def around(self, node: Node, inputs: NodeInputs, call: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            result = await call()
+        except Exception:
+            # The engine swaps in the node's fallback once the hooks have seen the failure
+            self._record(node, "failed" if node.fallback is None else "fallback")
+            raise
+        recorder = current_call()
+        self._record(node, "ok", result, recorder.answered_by if recorder is not None else None)
+        return result
+
+    def abandoned(self, node: Node, reason: str) -> None:
+        self._record(node, "failed")
+
+    def skipped(self, node: Node) -> None:
+        self._record(node, "skipped")
+
+
+class CachingHook(NodeHook):
+    """Serves and stores node results in the response cache for nodes that define a cache key"""
+
+    def __init__(self, mode: str = CACHE_USE):
+        self.mode = mode
+
+    async def around(self, node: Node, inputs: NodeInputs, call: Callable[[], Awaitable[Any]]) -> Any:
+        key = node.cache_key(inputs) if node.cache_key else None
+        if key is None:
+            return await call()
+        cached = await response_cache.lookup(key, node.name, self.mode)
+        if cached is not None:
+            return node.decode(cached) if node.decode else cached
+        result = await call()
+        if node.store_if is None or node.store_if(result):
+            # Keys name the model, and a fallback model may have answered instead of the configured one
+            await response_cache.store(node.cache_key(inputs) or key, node.name, result, self.mode)
+        return result
+
+
+class ConcurrencyHook(NodeHook):
+    """Caps how many instances of a node run at once, across all pipelines sharing the hook"""
+
+    def __init__(self, limits: Dict[str, int]):
+        self.limits = limits
+        # Semaphores bind to the loop that first waits on them (Streamlit runs each analysis on a fresh loop)
+        self._semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]]" = weakref.WeakKeyDictionary()
+
+    async def around(self, node: Node, inputs: NodeInputs, call: Callable[[], Awaitable[Any]]) -> Any:
+        limit = self.limits.get(node.name)
+        if not limit:
+            return await call()
+        semaphores = self._semaphores.setdefault(asyncio.get_running_loop(), {})
+        semaphore = semaphores.get(node.name)
+        if semaphore is None:
+            semaphore = semaphores[node.name] = asyncio.Semaphore(limit)
+        async with semaphore:
+            return await call()
+
+
+class PipelineEngine:
+    """Runs a graph of nodes, starting each as soon as its dependencies allow"""
+
+    def __init__(self, nodes: Iterable[Node], hooks: Sequence[NodeHook] = ()):
+        self.nodes: Dict[str, Node] = {}
+        for node in nodes:
+            missing = [dep for dep in node.deps if dep not in self.nodes]
+            if missing:
+                raise ValueError(f"Node {node.name} depends on unknown or later nodes: {', '.join(missing)}")
+            self.nodes[node.name] = node
+        self.hooks = list(hooks)
+        self.consumers: Dict[str, List[str]] = {name: [] for name in self.nodes}
+        for node in self.nodes.values():
+            for dep in node.deps:
+                self.consumers[dep].append(node.name)
+
+    async def run(self, output: str, seeded: Optional[Dict[str, Any]] = None) -> Any:
+        """Run the graph and return the result of the `output` node.
+
+        Seeded nodes take the given result without running; nodes only they depend on never start.
+        """
+        seeded = seeded or {}
+        needed, stack = set(), [output]
+        while stack:
+            name = stack.pop()
+            if name not in needed:
+                needed.add(name)
+                if name not in seeded:
+                    stack.extend(self.nodes[name].deps)
+
+        loop = asyncio.get_running_loop()
+        tasks: Dict[str, asyncio.Future] = {}
+        for node in self.nodes.values():
+            if node.name in seeded:
+                tasks[node.name] = loop.create_future()
+                tasks[node.name].set_result(seeded[node.name])
+            elif node.name in needed:
+                tasks[node.name] = asyncio.ensure_future(self._run_node(node, tasks))
+        try:
+            return await tasks[output]
+        finally:
+            for task in tasks.values():
+                task.cancel()
+            # Retrieve every outcome so failed side branches do not log as unhandled
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    async def _wait_for_deps(self, node: Node, tasks: Dict[str, asyncio.Future]) -> None:
+        deps = {name: tasks[name] for name in node.deps}
+        pending = set(deps.values())
+        if node.quorum is None:
+            await asyncio.wait(pending)
+            return
+        while pending and sum(1 for t in deps.values() if t.done() and not t.cancelled() and t.exception() is None) < node.quorum:
+            _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        if pending and node.grace > 0:
+            _, pending = await asyncio.wait(pending, timeout=node.grace)
+
+        # Slow dependencies must not hold the node hostage once it has enough to go on
+        for name, task in deps.items():
+            needed = any(
+                consumer != node.name and consumer in tasks and name not in self.nodes[consumer].optional
+                for consumer in self.consumers[name]
+            )
+            if task.done() or needed:
+                continue
+            task.cancel()
+            reason = f"still running {node.grace:g}s after {node.name} reached its quorum; {node.name} started without it"
+            for hook in self.hooks:
+                hook.abandoned(self.nodes[name], reason)
+        if pending:
+            await asyncio.wait(pending)
+
+    async def _run_node(self, node: Node, tasks: Dict[str, asyncio.Future]) -> Any:
+        if node.deps:
+            await self._wait_for_deps(node, tasks)
+        inputs: NodeInputs = {}
+        errors: List[BaseException] = []
+        for name in node.deps:
+            task = tasks[name]
+            error = TimeoutError(f"{name} did not finish before {node.name} started") if task.cancelled() else task.exception()
+            if error is None:
+                inputs[name] = task.result()
+                continue
+            if name not in node.optional:
+                raise error
+            errors.append(error)
+            inputs[name] = None
+        if len(node.deps) - len(errors) < node.min_deps:
+            raise errors[0]
+        if errors:
+            logger.info(f"{node.name} starting with {len(node.deps) - len(errors)}/{len(node.deps)} inputs")
+        if node.run_if is not None and not node.run_if(inputs):
+            for hook in self.hooks:
+                hook.skipped(node)
+            return None
+
+        call: Callable[[], Awaitable[Any]] = functools.partial(node.run, inputs)
+        for hook in reversed(self.hooks):
+            call = functools.partial(hook.around, node, inputs, call)
+        try:
+            return await call()
+        except Exception as e:
+            if node.fallback is None:
+                raise
+            logger.warning(f"{node.name} failed ({e}); using its fallback")
+            return node.fallback(inputs)
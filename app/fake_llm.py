@@ -0,0 +1,188 @@
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from pydantic import PrivateAttr
+
+from app.config import (
+    FAKE_LLM_FAILURE_RATE, FAKE_LLM_LATENCY_SECONDS, FAKE_LLM_LATENCY_SIGMA,
+    FAKE_LLM_OUTPUT_TOKENS, FAKE_LLM_SEED
+)
+from app.rendering import estimate_tokens
+
+# "fake-<label>:latency=0.2,sigma=0,fail=0.1,tokens=200" -> model field overrides
+_OPTION_FIELDS = {"latency": "latency", "sigma": "latency_sigma", "fail": "failure_rate", "tokens": "output_tokens", "seed": "seed"}
+
+_FIGHT_ID = re.compile(r"""["']?fight_id["']?\s*:\s*["']?([^"'\n,}]+)""")
+_PICK = re.compile(r"""["']pick["']\s*:\s*["']([^"'\n]+)""")
+_FIGHTER1 = re.compile(r"""fighter1["']?\s*:\s*["']?([^"'\n,}]+)""")
+
+
+class FakeLLMError(RuntimeError):
+    """Simulated provider failure (a transient 503, so callers treat it as retryable)"""
+
+    status_code = 503
+
+
+def parse_fake_model(model_name: str) -> Dict[str, Any]:
+    """Model field overrides encoded after ':' in a fake model name"""
+    _, _, options = model_name.partition(":")
+    overrides: Dict[str, Any] = {}
+    for option in filter(None, options.split(",")):
+        name, _, value = option.partition("=")
+        field = _OPTION_FIELDS.get(name.strip())
+        if field is None:
+            raise ValueError(f"Unknown fake model option '{name}' in {model_name}")
+        overrides[field] = int(value) if field in ("output_tokens", "seed") else float(value)
+    return overrides
+
+
+def _message_text(message: BaseMessage) -> str:
+    if isinstance(message.content, str):
+        return message.content
+    return "\n".join(block.get("text", "") if isinstance(block, dict) else str(block) for block in message.content)
+
+
+def _prompt_fights(prompt: str) -> List[Tuple[str, str]]:
+    """(fight_id, pick) pairs in prompt order, read from rendered cards or analyses JSON"""
+    fights: Dict[str, str] = {}
+    matches = list(_FIGHT_ID.finditer(prompt))
+    for i, match in enumerate(matches):
+        fight_id = match.group(1).strip()
+        if not fight_id or fight_id in fights:
+            continue
+        segment = prompt[match.end():matches[i + 1].start() if i + 1 < len(matches) else len(prompt)]
+        pick = _PICK.search(segment) or _FIGHTER1.search(segment)
+        fights[fight_id] = pick.group(1).strip() if pick else "Fighter 1"
+    return list(fights.items())
+
+
+class FakeChatModel(BaseChatModel):
+    """Offline chat model with deterministic, schema-valid output and simulated latency/failures"""
+
+    model_name: str = "fake"
+    latency: float = FAKE_LLM_LATENCY_SECONDS
+    latency_sigma: float = FAKE_LLM_LATENCY_SIGMA
+    failure_rate: float = FAKE_LLM_FAILURE_RATE
+    output_tokens: int = FAKE_LLM_OUTPUT_TOKENS
+    seed: int = FAKE_LLM_SEED
+
+    # Attempts per prompt, so a retried prompt can succeed after a simulated failure
+    _attempts: Dict[str, int] = PrivateAttr(default_factory=dict)
+
+    @classmethod
+    def from_model_name(cls, model_name: str) -> "FakeChatModel":
+        return cls(model_name=model_name, **parse_fake_model(model_name))
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"model_name": self.model_name}
+
+    def bind_tools(self, tools: Sequence[Any], *, tool_choice: Optional[str] = None, **kwargs: Any) -> Any:
+        return self.bind(tools=[convert_to_openai_tool(t) for t in tools], tool_choice=tool_choice)
+
+    def _plan(self, messages: List[BaseMessage]) -> Tuple[random.Random, float, str]:
+        prompt = "\n".join(_message_text(m) for m in messages)
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+        attempt = self._attempts.get(digest, 0)
+        self._attempts[digest] = attempt + 1
+        rng = random.Random(f"{self.seed}:{self.model_name}:{digest}:{attempt}")
+        delay = self.latency * math.exp(rng.gauss(0, self.latency_sigma)) if self.latency_sigma else self.latency
+        return rng, max(delay, 0.0), prompt
+
+    def _respond(self, messages: List[BaseMessage], rng: random.Random, prompt: str, tools: Optional[List[Dict[str, Any]]], tool_choice: Optional[str]) -> ChatResult:
+        if rng.random() < self.failure_rate:
+            raise FakeLLMError(f"Simulated failure from {self.model_name}")
+
+        fights = _prompt_fights(prompt)
+        answered = bool(messages) and isinstance(messages[-1], ToolMessage)
+        if tools and tool_choice and not answered:
+            # Forced tool use is how structured output is requested; answer with the last bound tool
+            names = [t["function"]["name"] for t in tools]
+            chosen = tools[names.index(tool_choice)] if tool_choice in names else tools[-1]
+            schema = chosen["function"].get("parameters", {})
+            args = _fill_schema(schema, schema.get("$defs", {}), rng, fights, "")
+            message = AIMessage(content="", tool_calls=[{
+                "name": chosen["function"]["name"], "args": args, "id": f"call_{rng.getrandbits(48):012x}", "type": "tool_call"
+            }])
+            output_text = json.dumps(args)
+        else:
+            output_text = _filler_text(self.model_name, fights, self.output_tokens)
+            message = AIMessage(content=output_text)
+
+        input_tokens, output_tokens = estimate_tokens(prompt), estimate_tokens(output_text)
+        message.usage_metadata = {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+        message.response_metadata = {"model_name": self.model_name}
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None,
+                  tools: Optional[List[Dict[str, Any]]] = None, tool_choice: Optional[str] = None, **kwargs: Any) -> ChatResult:
+        rng, delay, prompt = self._plan(messages)
+        time.sleep(delay)
+        return self._respond(messages, rng, prompt, tools, tool_choice)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None,
+                         tools: Optional[List[Dict[str, Any]]] = None, tool_choice: Optional[str] = None, **kwargs: Any) -> ChatResult:
+        rng, delay, prompt = self._plan(messages)
+        await asyncio.sleep(delay)
+        return self._respond(messages, rng, prompt, tools, tool_choice)
+
+
+def _filler_text(model_name: str, fights: List[Tuple[str, str]], output_tokens: int) -> str:
+    subjects = [f"Fight {fight_id}: {pick} holds the edge" for fight_id, pick in fights] or ["No fights found in prompt"]
+    text = f"[{model_name}] " + ". ".join(subjects) + "."
+    # Pad to roughly the configured output size (~4 characters per token)
+    padding = " Offline placeholder analysis."
+    repeats = max(0, (output_tokens * 4 - len(text)) // len(padding))
+    return text + padding * repeats
+
+
+def _fill_schema(schema: Dict[str, Any], defs: Dict[str, Any], rng: random.Random, fights: List[Tuple[str, str]], name: str,
+                 fight: Optional[Tuple[str, str]] = None) -> Any:
+    """Build a value satisfying a JSON schema, one array item per prompt fight where items carry a fight_id"""
+    if "$ref" in schema:
+        return _fill_schema(defs[schema["$ref"].split("/")[-1]], defs, rng, fights, name, fight)
+    if "anyOf" in schema:
+        options = [option for option in schema["anyOf"] if option.get("type") != "null"]
+        return _fill_schema(options[0], defs, rng, fights, name, fight) if options else None
+    if "enum" in schema:
+        return schema["enum"][0]
+
+    kind = schema.get("type")
+    if kind == "object":
+        properties = schema.get("properties", {})
+        return {
+            prop: _fill_schema(properties[prop], defs, rng, fights, prop, fight)
+            for prop in schema.get("required", list(properties))
+        }
+    if kind == "array":
+        items = schema.get("items", {})
+        resolved = defs[items["$ref"].split("/")[-1]] if "$ref" in items else items
+        if "fight_id" in resolved.get("properties", {}):
+            return [_fill_schema(items, defs, rng, fights, name, f) for f in fights]
+        return [_fill_schema(items, defs, rng, fights, name, fight) for _ in range(rng.randint(0, 2))]
+    if kind == "integer":
+        low, high = schema.get("minimum", 50), schema.get("maximum", 90)
+        return rng.randint(int(low), int(high))
+    if kind == "number":
+        return round(rng.uniform(schema.get("minimum", 0.0), schema.get("maximum", 1.0)), 3)
+    if kind == "boolean":
+        return rng.random() < 0.5
+    if name == "fight_id" and fight:
+        return fight[0]
+    if name == "pick" and fight:
+        return fight[1]
+    return f"Offline {name.replace('_', ' ') or 'value'}"
@@ -0,0 +1,154 @@
+import hashlib
+import json
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+
+from app.agents import AGENT_SPECS, ANALYST_SPECS, AgentSettings
+from app.cache import normalize_fights
+from app.config import (
+    POST_PROCESSING_MODE, POST_REVIEW_HIGH_CONFIDENCE, POST_REVIEW_LOW_CONFIDENCE, POST_REVIEW_MIN_AGREEMENT,
+    POST_REVIEW_MIN_ANALYSTS, POST_REVIEW_POLICY, POST_REVIEW_RULES, RULE_CONFIDENCE_FLOOR, RULE_OVERCONFIDENCE_THRESHOLD,
+    RULE_RISK_FLAG_PENALTY
+)
+from app.models import AgentOutputRecord, Card, Fight, FightAnalysis, RunFingerprints, StoredCardAnalysis
+
+_ANALYSTS = [spec.name for spec in ANALYST_SPECS]
+
+
+def _digest(material: Any) -> str:
+    return hashlib.sha256(json.dumps(material, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def card_key(card: Card) -> str:
+    """Identity of a card across runs: its card_id, or the set of its fight_ids"""
+    return card.card_id or _digest(sorted(fight.fight_id for fight in card.fights))
+
+
+def fight_fingerprint(fight: Fight) -> str:
+    return _digest(normalize_fights([fight])[0])
+
+
+def post_fingerprint(card: Card) -> str:
+    """Hash of the post-review policy and the deterministic rules that shape every fight's final analysis"""
+    return _digest({
+        "mode": card.post_processing or POST_PROCESSING_MODE,
+        "policy": card.post_review_policy or POST_REVIEW_POLICY,
+        "review_rules": sorted(POST_REVIEW_RULES),
+        "review_thresholds": [POST_REVIEW_HIGH_CONFIDENCE, POST_REVIEW_LOW_CONFIDENCE, POST_REVIEW_MIN_AGREEMENT, POST_REVIEW_MIN_ANALYSTS],
+        "rules": [RULE_OVERCONFIDENCE_THRESHOLD, RULE_RISK_FLAG_PENALTY, RULE_CONFIDENCE_FLOOR],
+    })
+
+
+def active_agents(card: Card) -> List[str]:
+    """Agents a run of this card calls, given its post-processing mode and review policy"""
+    agents = [*_ANALYSTS, "judge"]
+    if (card.post_review_policy or POST_REVIEW_POLICY) == "rules":
+        return agents
+    mode = card.post_processing or POST_PROCESSING_MODE
+    return agents + (["post_review"] if mode == "combined" else ["risk_scorer", "consistency_checker"])
+
+
+def agent_fingerprints(card: Card) -> Dict[str, str]:
+    """Per-agent hash of everything besides the fights that shapes its output"""
+    fingerprints = {}
+    for name in active_agents(card):
+        settings = AgentSettings(AGENT_SPECS[name], card)
+        material: Dict[str, Any] = {
+            "model": settings.model_name, "system_prompt": settings.system_prompt,
+            "temperature": settings.temperature, "top_p": settings.top_p,
+        }
+        if name in _ANALYSTS:
+            material["search"] = [card.use_serper, card.research_prefetch]
+        elif name != "judge":
+            # Post agents review what the policy lets through, merged as the mode dictates
+            material["post"] = [card.post_processing or POST_PROCESSING_MODE, card.post_review_policy or POST_REVIEW_POLICY]
+        fingerprints[name] = _digest(material)
+    return fingerprints
+
+
+def run_fingerprints(card: Card) -> RunFingerprints:
+    inputs = {fight.fight_id: fight_fingerprint(fight) for fight in card.fights}
+    post = post_fingerprint(card)
+    return RunFingerprints(
+        card_key=card_key(card), sharded=card.shard_by_fight,
+        fights={fight_id: _digest([fingerprint, post]) for fight_id, fingerprint in inputs.items()},
+        inputs=inputs, agents=agent_fingerprints(card),
+    )
+
+
+class IncrementalPlan:
+    """What a run can take from the previous stored run of its card"""
+
+    def __init__(self, previous_id: str):
+        self.previous_id = previous_id
+        # Final analyses of fights whose inputs and agents are all unchanged
+        self.reused: Dict[str, FightAnalysis] = {}
+        # Per-fight node results to seed in sharded mode: fight_id -> agent -> output
+        self.seeds: Dict[str, Dict[str, Any]] = {}
+        # Outputs of reused work, copied into the new record so the next run can build on it
+        self.carried: List[AgentOutputRecord] = []
+
+    def recompute(self, card: Card) -> List[Fight]:
+        return [fight for fight in card.fights if fight.fight_id not in self.reused]
+
+
+def plan_incremental(card: Card, fingerprints: RunFingerprints, previous: StoredCardAnalysis) -> IncrementalPlan:
+    """Diff a card against its previous stored run: whole fights are reused when nothing they depend on
+    changed and every agent answered with its configured model; in sharded mode, unchanged analysts and
+    judges of changed fights are reused as well. Failed, fallback and fallback-model outputs are never reused."""
+    plan = IncrementalPlan(previous.analysis_id)
+    before = previous.fingerprints
+    changed_agents = {name for name, fp in fingerprints.agents.items() if before.agents.get(name) != fp}
+    previous_analyses = {analysis.fight_id: analysis for analysis in previous.result.analyses}
+    agents = active_agents(card)
+    configured = {name: AgentSettings(AGENT_SPECS[name], card).model_name for name in agents}
+
+    def answered(record: AgentOutputRecord) -> bool:
+        return record.status == "ok" and record.model in (None, configured.get(record.agent))
+
+    # Whole-card runs record each agent once for all fights; sharded runs once per fight
+    card_cells: Dict[str, AgentOutputRecord] = {}
+    cells: Dict[str, Dict[str, AgentOutputRecord]] = {}
+    for record in previous.outputs:
+        (card_cells if record.fight_id is None else cells.setdefault(record.fight_id, {}))[record.agent] = record
+
+    for fight in card.fights:
+        # Agent outputs depend on the fight's inputs alone; its final analysis also on the post-review rules.
+        # Runs stored without input fingerprints may hold judge outputs edited by the rules, so they seed nothing.
+        if before.inputs.get(fight.fight_id) != fingerprints.inputs[fight.fight_id]:
+            continue
+        fight_cells = cells.get(fight.fight_id, {})
+        records = {**card_cells, **fight_cells}
+        # A fight analyzed while an agent was down is redone once it is back
+        complete = all(
+            name in records and (answered(records[name]) or records[name].status == "skipped") for name in agents
+        )
+        same_post = before.fights.get(fight.fight_id) == fingerprints.fights[fight.fight_id]
+        if not changed_agents and same_post and complete and fight.fight_id in previous_analyses:
+            plan.reused[fight.fight_id] = previous_analyses[fight.fight_id]
+            plan.carried.extend(fight_cells.values())
+            continue
+        if not card.shard_by_fight:
+            continue
+        seeds = {}
+        for name in _ANALYSTS:
+            if name not in changed_agents and name in fight_cells and answered(fight_cells[name]):
+                seeds[name] = fight_cells[name].output
+        # The judge's answer holds only if it saw exactly the same reports
+        judge = fight_cells.get("judge")
+        if len(seeds) == len(_ANALYSTS) and "judge" not in changed_agents and judge is not None and answered(judge):
+            seeds["judge"] = AGENT_SPECS["judge"].decode(judge.output)
+        if seeds:
+            plan.seeds[fight.fight_id] = seeds
+            plan.carried.extend(fight_cells[name] for name in seeds)
+    # Whole-card records vouch for the reused fights in the next run too
+    if plan.reused:
+        plan.carried.extend(card_cells.values())
+
+    logger.info(
+        f"Incremental run against {previous.analysis_id}: {len(plan.reused)}/{len(card.fights)} fights reused, "
+        f"{sum(len(seeds) for seeds in plan.seeds.values())} agent outputs reused"
+        + (f", changed agents: {', '.join(sorted(changed_agents))}" if changed_agents else "")
+    )
+    return plan
@@ -0,0 +1,587 @@
+import asyncio
+import math
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional, Set, Tuple
+from uuid import uuid4
+
+from loguru import logger
+
+from app.config import (
+    JOB_LEASE_SECONDS, JOB_MAX_QUEUED, JOB_POLL_SECONDS, JOB_QUEUE_BACKEND, JOB_SQLITE_PATH, JOB_WORKERS, REDIS_JOB_TTL_SECONDS
+)
+from app.models import Card, CardAnalysis, CardJobStatus, FightAnalysis, PipelineEvent
+from app.pipeline import analyze_card_pipeline
+from app.redis_client import get_redis, redis_key
+from app.scheduler import AdmissionRejected, get_scheduler
+
+
+class JobQueue(ABC):
+    """Storage for background card jobs: the queue itself, leases on running jobs, partial and final results"""
+
+    @abstractmethod
+    async def enqueue(self, job_id: str, card: Card) -> None:
+        ...
+
+    @abstractmethod
+    async def claim(self, lease: float) -> Optional[Tuple[str, Card, str]]:
+        """Take the oldest queued job (or a running one whose lease expired) and lease it for `lease` seconds.
+
+        Returns the job id, its card and the lease token that renew, release and finish must present.
+        """
+
+    @abstractmethod
+    async def renew(self, job_id: str, lease_token: str, lease: float) -> bool:
+        """Extend the lease; False once another worker has taken the job over"""
+
+    @abstractmethod
+    async def release(self, job_id: str, lease_token: str) -> None:
+        """Put a running job back at the head of the queue"""
+
+    @abstractmethod
+    async def add_partial(self, job_id: str, analysis: FightAnalysis) -> None:
+        ...
+
+    @abstractmethod
+    async def finish(self, job_id: str, lease_token: str, result: Optional[CardAnalysis], error: Optional[str] = None) -> None:
+        """Record the outcome; ignored once another worker has taken the job over"""
+
+    @abstractmethod
+    async def status(self, job_id: str) -> Optional[CardJobStatus]:
+        ...
+
+    @abstractmethod
+    async def queued(self) -> int:
+        ...
+
+
+class MemoryJobQueue(JobQueue):
+    """In-process queue; jobs are lost on restart"""
+
+    def __init__(self):
+        self._jobs: Dict[str, CardJobStatus] = {}
+        self._cards: Dict[str, Card] = {}
+        self._queue: Deque[str] = deque()
+        self._leases: Dict[str, str] = {}
+
+    async def enqueue(self, job_id: str, card: Card) -> None:
+        self._jobs[job_id] = CardJobStatus(job_id=job_id, status="queued", fights=len(card.fights), created_at=time.time())
+        self._cards[job_id] = card
+        self._queue.append(job_id)
+
+    async def claim(self, lease: float) -> Optional[Tuple[str, Card, str]]:
+        # Only this process runs these jobs, so leases never expire
+        while self._queue:
+            job_id = self._queue.popleft()
+            job = self._jobs.get(job_id)
+            if job is not None and job.status == "queued":
+                job.status = "running"
+                job.started_at = job.started_at or time.time()
+                token = self._leases[job_id] = uuid4().hex
+                return job_id, self._cards[job_id], token
+        return None
+
+    async def renew(self, job_id: str, lease_token: str, lease: float) -> bool:
+        return self._leases.get(job_id) == lease_token
+
+    async def release(self, job_id: str, lease_token: str) -> None:
+        job = self._jobs.get(job_id)
+        if job is not None and job.status == "running" and self._leases.get(job_id) == lease_token:
+            job.status = "queued"
+            del self._leases[job_id]
+            self._queue.appendleft(job_id)
+
+    async def add_partial(self, job_id: str, analysis: FightAnalysis) -> None:
+        job = self._jobs.get(job_id)
+        if job is None:
+            return
+        job.partial = [existing for existing in job.partial if existing.fight_id != analysis.fight_id] + [analysis]
+        job.completed_fights = len(job.partial)
+
+    async def finish(self, job_id: str, lease_token: str, result: Optional[CardAnalysis], error: Optional[str] = None) -> None:
+        job = self._jobs.get(job_id)
+        if job is None or self._leases.get(job_id) != lease_token:
+            return
+        del self._leases[job_id]
+        job.status = "completed" if result is not None else "failed"
+        job.result = result
+        job.error = error
+        job.finished_at = time.time()
+        if result is not None:
+            job.completed_fights = len(result.analyses)
+        self._cards.pop(job_id, None)
+
+    async def status(self, job_id: str) -> Optional[CardJobStatus]:
+        job = self._jobs.get(job_id)
+        return job.model_copy(update={"partial": list(job.partial)}) if job else None
+
+    async def queued(self) -> int:
+        return sum(1 for job in self._jobs.values() if job.status == "queued")
+
+
+class SQLiteJobQueue(JobQueue):
+    """On-disk queue that survives restarts and can be shared by the workers of several local processes"""
+
+    def __init__(self, path: str = JOB_SQLITE_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS card_jobs ("
+                "job_id TEXT PRIMARY KEY, status TEXT NOT NULL, card TEXT NOT NULL, fights INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, started_at REAL, finished_at REAL, lease_token TEXT, lease_until REAL, "
+                "result TEXT, error TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS card_jobs_status ON card_jobs (status, created_at)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS card_job_partials ("
+                "job_id TEXT NOT NULL, fight_id TEXT NOT NULL, added_at REAL NOT NULL, analysis TEXT NOT NULL, "
+                "PRIMARY KEY (job_id, fight_id))"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=5.0)
+
+    def _enqueue(self, job_id: str, card: Card) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO card_jobs (job_id, status, card, fights, created_at) VALUES (?, 'queued', ?, ?, ?)",
+                (job_id, card.model_dump_json(exclude={"api_keys"}), len(card.fights), time.time()),
+            )
+
+    def _claim(self, lease: float) -> Optional[Tuple[str, Card, str]]:
+        now = time.time()
+        token = uuid4().hex
+        with self._connect() as conn:
+            # A single UPDATE is atomic, so two processes never claim the same job
+            conn.execute(
+                "UPDATE card_jobs SET status = 'running', started_at = COALESCE(started_at, ?), lease_token = ?, lease_until = ? "
+                "WHERE job_id = (SELECT job_id FROM card_jobs WHERE status = 'queued' "
+                "OR (status = 'running' AND lease_until < ?) ORDER BY created_at LIMIT 1)",
+                (now, token, now + lease, now),
+            )
+            row = conn.execute("SELECT job_id, card FROM card_jobs WHERE lease_token = ?", (token,)).fetchone()
+        return (row[0], Card.model_validate_json(row[1]), token) if row else None
+
+    def _renew(self, job_id: str, lease_token: str, lease: float) -> bool:
+        with self._connect() as conn:
+            # A takeover replaced the token, so a stale worker's renewal matches no row
+            renewed = conn.execute(
+                "UPDATE card_jobs SET lease_until = ? WHERE job_id = ? AND lease_token = ? AND status = 'running'",
+                (time.time() + lease, job_id, lease_token),
+            ).rowcount
+        return renewed > 0
+
+    def _release(self, job_id: str, lease_token: str) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE card_jobs SET status = 'queued', lease_token = NULL, lease_until = NULL "
+                "WHERE job_id = ? AND lease_token = ? AND status = 'running'",
+                (job_id, lease_token),
+            )
+
+    def _add_partial(self, job_id: str, analysis: FightAnalysis) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO card_job_partials VALUES (?, ?, ?, ?)",
+                (job_id, analysis.fight_id, time.time(), analysis.model_dump_json()),
+            )
+
+    def _finish(self, job_id: str, lease_token: str, result: Optional[CardAnalysis], error: Optional[str]) -> None:
+        with self._connect() as conn:
+            finished = conn.execute(
+                "UPDATE card_jobs SET status = ?, result = ?, error = ?, finished_at = ?, lease_token = NULL, lease_until = NULL "
+                "WHERE job_id = ? AND lease_token = ?",
+                ("completed" if result is not None else "failed", result.model_dump_json() if result is not None else None,
+                 error, time.time(), job_id, lease_token),
+            ).rowcount
+        if not finished:
+            logger.warning(f"Card job {job_id}: lease taken over by another worker, result of this run discarded")
+
+    def _status(self, job_id: str) -> Optional[CardJobStatus]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT status, fights, created_at, started_at, finished_at, result, error FROM card_jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            partials = conn.execute(
+                "SELECT analysis FROM card_job_partials WHERE job_id = ? ORDER BY added_at", (job_id,)
+            ).fetchall()
+        status, fights, created_at, started_at, finished_at, result, error = row
+        partial = [FightAnalysis.model_validate_json(analysis) for analysis, in partials]
+        final = CardAnalysis.model_validate_json(result) if result else None
+        return CardJobStatus(
+            job_id=job_id, status=status, fights=fights,
+            completed_fights=len(final.analyses) if final else len(partial),
+            partial=partial, result=final, error=error,
+            created_at=created_at, started_at=started_at, finished_at=finished_at,
+        )
+
+    def _queued(self) -> int:
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM card_jobs WHERE status = 'queued'").fetchone()[0]
+
+    async def enqueue(self, job_id: str, card: Card) -> None:
+        await asyncio.to_thread(self._enqueue, job_id, card)
+
+    async def claim(self, lease: float) -> Optional[Tuple[str, Card, str]]:
+        return await asyncio.to_thread(self._claim, lease)
+
+    async def renew(self, job_id: str, lease_token: str, lease: float) -> bool:
+        return await asyncio.to_thread(self._renew, job_id, lease_token, lease)
+
+    async def release(self, job_id: str, lease_token: str) -> None:
+        await asyncio.to_thread(self._release, job_id, lease_token)
+
+    async def add_partial(self, job_id: str, analysis: FightAnalysis) -> None:
+        await asyncio.to_thread(self._add_partial, job_id, analysis)
+
+    async def finish(self, job_id: str, lease_token: str, result: Optional[CardAnalysis], error: Optional[str] = None) -> None:
+        await asyncio.to_thread(self._finish, job_id, lease_token, result, error)
+
+    async def status(self, job_id: str) -> Optional[CardJobStatus]:
+        return await asyncio.to_thread(self._status, job_id)
+
+    async def queued(self) -> int:
+        return await asyncio.to_thread(self._queued)
+
+
+class RedisJobQueue(JobQueue):
+    """Queue on a shared Redis-protocol server: any replica can take a job or report its status"""
+
+    def __init__(self, ttl: float = REDIS_JOB_TTL_SECONDS):
+        self.ttl = ttl
+        # Queued job ids scored by creation time, and running ones scored by lease expiry
+        self.queued_key = redis_key("jobs", "queued")
+        self.leases_key = redis_key("jobs", "leases")
+
+    @staticmethod
+    def _job_key(job_id: str) -> str:
+        return redis_key("job", job_id)
+
+    @staticmethod
+    def _partial_key(job_id: str) -> str:
+        return redis_key("job", job_id, "partial")
+
+    def _queue_again(self, pipe: Any, job_id: str, created_at: Optional[str]) -> None:
+        pipe.hset(self._job_key(job_id), "status", "queued")
+        pipe.hdel(self._job_key(job_id), "lease_token")
+        pipe.zadd(self.queued_key, {job_id: float(created_at or time.time())})
+
+    async def _while_leased(self, job_id: str, lease_token: str, write: Callable[[Any], None]) -> bool:
+        """Queue write's commands in one transaction that only runs while lease_token still holds the job"""
+        held = False
+
+        async def attempt(pipe: Any) -> None:
+            nonlocal held
+            # WATCH makes a takeover between this read and EXEC retry the attempt
+            held = await pipe.hget(self._job_key(job_id), "lease_token") == lease_token
+            pipe.multi()
+            if held:
+                write(pipe)
+
+        await get_redis().transaction(attempt, self._job_key(job_id))
+        return held
+
+    async def enqueue(self, job_id: str, card: Card) -> None:
+        now = time.time()
+        async with get_redis().pipeline(transaction=True) as pipe:
+            pipe.hset(self._job_key(job_id), mapping={
+                "status": "queued", "card": card.model_dump_json(exclude={"api_keys"}),
+                "fights": len(card.fights), "created_at": now,
+            })
+            pipe.zadd(self.queued_key, {job_id: now})
+            await pipe.execute()
+
+    def _lease(self, pipe: Any, job_id: str, lease_token: str, until: float, now: float) -> None:
+        """Queue the commands that move a job from the queue to the leased set"""
+        pipe.zrem(self.queued_key, job_id)
+        pipe.zadd(self.leases_key, {job_id: until})
+        pipe.hset(self._job_key(job_id), mapping={"status": "running", "lease_token": lease_token})
+        pipe.hsetnx(self._job_key(job_id), "started_at", now)
+
+    async def _take_back_expired(self, client: Any, now: float) -> None:
+        """Requeue jobs whose worker stopped renewing, in one transaction with their removal from the leased set"""
+        expired = []
+
+        async def take_back(pipe: Any) -> None:
+            # WATCH on the leased set: a renewal or another replica's takeover meanwhile retries the attempt
+            expired[:] = await pipe.zrangebyscore(self.leases_key, "-inf", now)
+            created = [await pipe.hget(self._job_key(job_id), "created_at") for job_id in expired]
+            pipe.multi()
+            for job_id, created_at in zip(expired, created):
+                pipe.zrem(self.leases_key, job_id)
+                self._queue_again(pipe, job_id, created_at)
+
+        await client.transaction(take_back, self.leases_key)
+        for job_id in expired:
+            logger.warning(f"Card job {job_id}: lease expired, requeueing")
+
+    async def claim(self, lease: float) -> Optional[Tuple[str, Card, str]]:
+        client = get_redis()
+        now = time.time()
+        await self._take_back_expired(client, now)
+        token = uuid4().hex
+        job_id: Optional[str] = None
+
+        async def take(pipe: Any) -> None:
+            nonlocal job_id
+            # Taking the head and leasing it commit together, so a worker dying in between leaves the job
+            # queued; WATCH makes a replica that lost the race for the same head retry on the next one
+            head = await pipe.zrange(self.queued_key, 0, 0)
+            job_id = head[0] if head else None
+            pipe.multi()
+            if job_id is not None:
+                self._lease(pipe, job_id, token, now + lease, now)
+                pipe.hget(self._job_key(job_id), "card")
+
+        results = await client.transaction(take, self.queued_key)
+        if job_id is None:
+            return None
+        return job_id, Card.model_validate_json(results[-1]), token
+
+    async def renew(self, job_id: str, lease_token: str, lease: float) -> bool:
+        until = time.time() + lease
+        return await self._while_leased(job_id, lease_token, lambda pipe: pipe.zadd(self.leases_key, {job_id: until}, xx=True))
+
+    async def release(self, job_id: str, lease_token: str) -> None:
+        created_at = await get_redis().hget(self._job_key(job_id), "created_at")
+
+        def requeue(pipe: Any) -> None:
+            pipe.zrem(self.leases_key, job_id)
+            self._queue_again(pipe, job_id, created_at)
+
+        await self._while_leased(job_id, lease_token, requeue)
+
+    async def add_partial(self, job_id: str, analysis: FightAnalysis) -> None:
+        await get_redis().rpush(self._partial_key(job_id), analysis.model_dump_json())
+
+    async def finish(self, job_id: str, lease_token: str, result: Optional[CardAnalysis], error: Optional[str] = None) -> None:
+        fields = {"status": "completed" if result is not None else "failed", "finished_at": time.time()}
+        if result is not None:
+            fields["result"] = result.model_dump_json()
+        if error is not None:
+            fields["error"] = error
+
+        def record(pipe: Any) -> None:
+            pipe.hset(self._job_key(job_id), mapping=fields)
+            pipe.hdel(self._job_key(job_id), "card", "lease_token")
+            pipe.zrem(self.leases_key, job_id)
+            pipe.expire(self._job_key(job_id), int(self.ttl))
+            pipe.expire(self._partial_key(job_id), int(self.ttl))
+
+        if not await self._while_leased(job_id, lease_token, record):
+            logger.warning(f"Card job {job_id}: lease taken over by another worker, result of this run discarded")
+
+    async def status(self, job_id: str) -> Optional[CardJobStatus]:
+        async with get_redis().pipeline(transaction=False) as pipe:
+            pipe.hgetall(self._job_key(job_id))
+            pipe.lrange(self._partial_key(job_id), 0, -1)
+            job, partials = await pipe.execute()
+        if not job:
+            return None
+        # A job run again after a takeover reports each fight once, with its latest analysis
+        latest: Dict[str, FightAnalysis] = {}
+        for raw in partials:
+            analysis = FightAnalysis.model_validate_json(raw)
+            latest[analysis.fight_id] = analysis
+        final = CardAnalysis.model_validate_json(job["result"]) if job.get("result") else None
+        return CardJobStatus(
+            job_id=job_id, status=job["status"], fights=int(job["fights"]),
+            completed_fights=len(final.analyses) if final else len(latest),
+            partial=list(latest.values()), result=final, error=job.get("error"),
+            created_at=float(job["created_at"]),
+            started_at=float(job["started_at"]) if job.get("started_at") else None,
+            finished_at=float(job["finished_at"]) if job.get("finished_at") else None,
+        )
+
+    async def queued(self) -> int:
+        return await get_redis().zcard(self.queued_key)
+
+
+def build_job_queue(kind: str = JOB_QUEUE_BACKEND) -> JobQueue:
+    if kind == "memory":
+        return MemoryJobQueue()
+    if kind == "sqlite":
+        return SQLiteJobQueue()
+    if kind == "redis":
+        return RedisJobQueue()
+    raise ValueError(f"Unknown job queue backend: {kind}")
+
+
+class CardJobWorkers:
+    """Pool of asyncio workers running queued card jobs, with fight results recorded as they finish"""
+
+    def __init__(self, queue: JobQueue, workers: int = JOB_WORKERS):
+        self.queue = queue
+        # Cards carrying API keys never reach a shared queue: they wait in memory for this process's workers
+        self.local = queue if isinstance(queue, MemoryJobQueue) else MemoryJobQueue()
+        self.workers = max(workers, 1)
+        self._tasks: Set[asyncio.Task] = set()
+        # Running job id -> its queue and lease token
+        self._running: Dict[str, Tuple[JobQueue, str]] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        # Smoothed job duration drives Retry-After when the queue is full
+        self.job_seconds = 60.0
+
+    async def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        for _ in range(self.workers):
+            task = asyncio.ensure_future(self._work())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        logger.info(f"Started {self.workers} card job workers ({type(self.queue).__name__})")
+
+    async def _queued(self) -> int:
+        return await self.queue.queued() + (await self.local.queued() if self.local is not self.queue else 0)
+
+    async def submit(self, card: Card) -> CardJobStatus:
+        """Queue a card and return its job; raises AdmissionRejected when the queue is full"""
+        queued = await self._queued()
+        if queued >= JOB_MAX_QUEUED:
+            retry_after = int(min(max(math.ceil(self.job_seconds * (queued + 1) / self.workers), 1), 300))
+            raise AdmissionRejected(retry_after)
+        job_id = uuid4().hex
+        queue = self.local if card.api_keys else self.queue
+        await queue.enqueue(job_id, card)
+        logger.info(f"Card job {job_id}: {len(card.fights)} fights queued" + (" (local: carries API keys)" if queue is not self.queue else ""))
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return await queue.status(job_id)
+
+    async def status(self, job_id: str) -> Optional[CardJobStatus]:
+        return await self.local.status(job_id) or await self.queue.status(job_id)
+
+    async def _claim(self) -> Optional[Tuple[JobQueue, str, Card, str]]:
+        for queue in (self.local, self.queue) if self.local is not self.queue else (self.queue,):
+            claimed = await queue.claim(JOB_LEASE_SECONDS)
+            if claimed is not None:
+                return (queue, *claimed)
+        return None
+
+    async def _work(self) -> None:
+        failures = 0
+        while True:
+            claimed = None
+            try:
+                # Cleared before claiming, so a job queued meanwhile still wakes this worker
+                self._wakeup.clear()
+                claimed = await self._claim()
+                if claimed is None:
+                    # Polling picks up jobs queued by other processes sharing the queue
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=JOB_POLL_SECONDS)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self._run(*claimed)
+                failures = 0
+            except Exception as e:
+                # A flaky queue backend must not shrink the pool
+                failures += 1
+                logger.exception(f"Card job worker error: {e}")
+                if claimed is not None:
+                    queue, job_id, _, lease_token = claimed
+                    try:
+                        await queue.finish(job_id, lease_token, None, f"worker error: {e}")
+                    except Exception as finish_error:
+                        # Its lease runs out and another worker picks it up
+                        logger.error(f"Card job {job_id}: failed to mark as failed: {finish_error}")
+                await asyncio.sleep(min(JOB_POLL_SECONDS * 2 ** (failures - 1), 60.0))
+
+    async def _heartbeat(self, queue: JobQueue, job_id: str, lease_token: str) -> None:
+        """Renew the lease until cancelled; returns once another worker has taken the job over"""
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            try:
+                if not await queue.renew(job_id, lease_token, JOB_LEASE_SECONDS):
+                    return
+            except Exception as e:
+                logger.warning(f"Card job {job_id}: lease renewal failed: {e}")
+
+    async def _record_partial(self, queue: JobQueue, job_id: str, analysis: FightAnalysis) -> None:
+        try:
+            await queue.add_partial(job_id, analysis)
+        except Exception as e:
+            # Partial results are a convenience; the final result still lands when the job finishes
+            logger.warning(f"Card job {job_id}: failed to record partial result for {analysis.fight_id}: {e}")
+
+    async def _run(self, queue: JobQueue, job_id: str, card: Card, lease_token: str) -> None:
+        writes: Set[asyncio.Task] = set()
+
+        def on_event(event: PipelineEvent) -> None:
+            if event.event == "fight_result" and event.analysis is not None:
+                task = asyncio.ensure_future(self._record_partial(queue, job_id, event.analysis))
+                writes.add(task)
+                task.add_done_callback(writes.discard)
+
+        self._running[job_id] = (queue, lease_token)
+        heartbeat = asyncio.ensure_future(self._heartbeat(queue, job_id, lease_token))
+        pipeline: Optional[asyncio.Future] = None
+        result: Optional[CardAnalysis] = None
+        error: Optional[str] = None
+        try:
+            try:
+                # Job cards share the active-card slots and their fair queue with interactive requests
+                async with get_scheduler().admit():
+                    logger.info(f"Card job {job_id}: running {len(card.fights)} fights")
+                    started = time.perf_counter()
+                    pipeline = asyncio.ensure_future(analyze_card_pipeline(card, on_event=on_event))
+                    await asyncio.wait({pipeline, heartbeat}, return_when=asyncio.FIRST_COMPLETED)
+                    if not pipeline.done():
+                        # The heartbeat lost the lease: the worker that took the job over runs and finishes it
+                        logger.warning(f"Card job {job_id}: lease taken over by another worker, abandoning this run")
+                        return
+                    result = pipeline.result()
+                    self.job_seconds = 0.8 * self.job_seconds + 0.2 * (time.perf_counter() - started)
+            except AdmissionRejected as e:
+                # Not the job's fault: hand it back and let this worker wait for the admission queue to drain
+                logger.info(f"Card job {job_id}: admission queue full, requeueing for {e.retry_after}s")
+                await queue.release(job_id, lease_token)
+                await asyncio.sleep(e.retry_after)
+                return
+            except Exception as e:
+                logger.error(f"Card job {job_id} failed: {e}")
+                error = str(e)
+            if writes:
+                await asyncio.gather(*writes, return_exceptions=True)
+            await queue.finish(job_id, lease_token, result, error)
+        finally:
+            # A job cancelled at shutdown is released by aclose and runs again on the next start
+            heartbeat.cancel()
+            if pipeline is not None:
+                pipeline.cancel()
+            self._running.pop(job_id, None)
+        if result is not None:
+            logger.info(f"Card job {job_id} completed: {len(result.analyses)} fights analyzed")
+
+    async def aclose(self) -> None:
+        interrupted = dict(self._running)
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        for job_id, (queue, lease_token) in interrupted.items():
+            try:
+                await queue.release(job_id, lease_token)
+                logger.info(f"Card job {job_id} interrupted by shutdown; requeued")
+            except Exception as e:
+                # Its lease runs out and another worker picks it up
+                logger.warning(f"Card job {job_id}: failed to requeue: {e}")
+
+
+_workers: Optional[CardJobWorkers] = None
+
+
+def get_job_workers() -> CardJobWorkers:
+    global _workers
+    if _workers is None:
+        _workers = CardJobWorkers(build_job_queue())
+    return _workers
@@ -1,46 +1,217 @@
-from langchain_openai import ChatOpenAI
+import asyncio
+import hashlib
+import time
+import weakref
+from functools import cached_property
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import anthropic
+import httpx
+from google import genai
+from google.genai.types import HttpOptions
 from langchain_anthropic import ChatAnthropic
 from langchain_google_genai import ChatGoogleGenerativeAI
-from app.config import get_api_key
-from typing import Dict
+from langchain_openai import ChatOpenAI
+from loguru import logger
+from pydantic import Field
+
+from app.fake_llm import FakeChatModel
+from app.config import (
+    LLM_CLIENT_IDLE_TTL_SECONDS, LLM_HTTP_KEEPALIVE_EXPIRY,
+    LLM_HTTP_MAX_CONNECTIONS, LLM_HTTP_MAX_KEEPALIVE
+)
+
+PROVIDER_LABELS = {"openai": "OpenAI", "anthropic": "Anthropic", "google": "Google", "fake": "Fake"}
+
+
+def provider_for_model(model_name: str) -> str:
+    """Map a model name to the provider whose API key and client it uses"""
+    if model_name.startswith("claude") or model_name.startswith("anthropic"):
+        return "anthropic"
+    if model_name.startswith("gemini"):
+        return "google"
+    if model_name.startswith("fake"):
+        return "fake"
+    # gpt-* and unknown models go to OpenAI
+    return "openai"
+
+
+def _key_hash(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
 
-def get_llm(model_name: str, temperature: float = 0.1, top_p: float = None, runtime_keys: Dict[str, str] = None):
-    if model_name.startswith("gpt"):
+class PooledChatAnthropic(ChatAnthropic):
+    """ChatAnthropic whose async client sends through the registry's shared HTTP pool"""
+
+    pooled_http_client: Optional[httpx.AsyncClient] = Field(default=None, exclude=True)
+
+    @cached_property
+    def _async_client(self) -> anthropic.AsyncClient:
+        if self.pooled_http_client is None:
+            return super()._async_client
+        return anthropic.AsyncClient(**self._client_params, http_client=self.pooled_http_client)
+
+
+async def _close_client(client: Any) -> None:
+    """Release what an evicted client owns itself; the shared HTTP pool stays open"""
+    try:
+        if isinstance(client, genai.Client):
+            # Its sync pool is its own; aclose leaves the borrowed async pool alone
+            client.close()
+            await client.aio.aclose()
+        elif isinstance(client, ChatGoogleGenerativeAI):
+            # The Gemini chat model talks gRPC through channels of its own
+            if client.async_client_running is not None:
+                await client.async_client_running.transport.close()
+            client.client.transport.close()
+        # OpenAI and Anthropic models only hold the shared pool and their SDK's process-wide sync client
+    except Exception as e:
+        logger.warning(f"Closing evicted {type(client).__name__} failed: {e}")
+
+
+class LLMClientRegistry:
+    """Long-lived LLM clients sharing one pooled HTTP client per event loop"""
+
+    def __init__(self):
+        self._http_client: Optional[httpx.AsyncClient] = None
+        self._models: Dict[Tuple, Tuple[Any, float]] = {}
+        self._genai_clients: Dict[str, Tuple[genai.Client, float]] = {}
+        # (id of a pooled model, agent shape) -> (model, compiled agent graph)
+        self._agents: Dict[Tuple[int, Any], Tuple[Any, Any]] = {}
+        self._closing: Set[asyncio.Task] = set()
+
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        if self._http_client is None or self._http_client.is_closed:
+            self._http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=LLM_HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=LLM_HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=LLM_HTTP_KEEPALIVE_EXPIRY,
+                ),
+                timeout=httpx.Timeout(600.0, connect=10.0),
+            )
+        return self._http_client
+
+    def _build_chat_model(self, provider: str, model_name: str, api_key: str, temperature: Optional[float], top_p: Optional[float], prompt_cache_key: Optional[str]) -> Any:
+        if provider == "fake":
+            return FakeChatModel.from_model_name(model_name)
+        if provider == "anthropic":
+            return PooledChatAnthropic(
+                model=model_name,
+                api_key=api_key,
+                temperature=temperature if temperature is not None else 0.7,
+                top_p=top_p if top_p is not None else 0.9,
+                pooled_http_client=self.http_client,
+            )
+        if provider == "google":
+            # ChatGoogleGenerativeAI speaks gRPC and takes no HTTP client; its channels are closed on eviction
+            return ChatGoogleGenerativeAI(
+                model=model_name,
+                api_key=api_key,
+                temperature=temperature if temperature is not None else 0.7,
+                top_p=top_p if top_p is not None else 0.9
+            )
         config = {
             "model": model_name,
-            "api_key": get_api_key("openai", runtime_keys),
-            "temperature": temperature,
-            "reasoning": { "effort": "medium" },
-            "verbose": True,
+            "api_key": api_key,
+            "temperature": temperature if temperature is not None else 0.7,
+            "http_async_client": self.http_client,
         }
-        if top_p is not None:
-            config["top_p"] = top_p
+        if prompt_cache_key:
+            # Routes requests sharing a static prefix to the same prompt cache
+            config["model_kwargs"] = {"prompt_cache_key": prompt_cache_key}
+        # GPT reasoning models reject top_p; other OpenAI-compatible models accept it
+        if not model_name.startswith("gpt"):
+            config["top_p"] = top_p if top_p is not None else 1.0
         return ChatOpenAI(**config)
-    elif model_name.startswith("claude"):
-        config = {
-            "model": model_name,
-            "api_key": get_api_key("anthropic", runtime_keys),
-            "temperature": temperature,
-            "max_tokens": 4096  # Ensure adequate response length
-        }
-        if top_p is not None:
-            config["top_p"] = top_p
-        return ChatAnthropic(**config)
-    elif model_name.startswith("gemini"):
-        config = {
-            "model": model_name,
-            "api_key": get_api_key("google", runtime_keys),
-            "temperature": temperature,
-        }
-        if top_p is not None:
-            config["top_p"] = top_p
-        return ChatGoogleGenerativeAI(**config)
-    else:
-        # Default to GPT-4o
-        config = {
-            "model": "gpt-4o",
-            "api_key": get_api_key("openai", runtime_keys),
-            "temperature": temperature,
-        }
-        if top_p is not None:
-            config["top_p"] = top_p
+
+    def chat_model(self, provider: str, model_name: str, api_key: str, temperature: Optional[float] = None, top_p: Optional[float] = None, prompt_cache_key: Optional[str] = None) -> Any:
+        """Return a cached chat model for (provider, model, api key, sampling params)"""
+        self.evict_idle()
+        # prompt_cache_key only affects OpenAI requests; keep one instance per key there
+        cache_key = prompt_cache_key if provider == "openai" else None
+        key = (provider, model_name, _key_hash(api_key), temperature, top_p, cache_key)
+        entry = self._models.get(key)
+        if entry is None:
+            logger.info(f"Creating pooled {provider} client for {model_name}")
+            model = self._build_chat_model(provider, model_name, api_key, temperature, top_p, cache_key)
+        else:
+            model = entry[0]
+        self._models[key] = (model, time.monotonic())
+        return model
+
+    def compiled_agent(self, model: Any, shape: Any, build: Callable[[], Any]) -> Any:
+        """Agent graph built once per pooled model and shape (tools, output schema), dropped with the model"""
+        entry = self._agents.get((id(model), shape))
+        if entry is None or entry[0] is not model:
+            entry = self._agents[(id(model), shape)] = (model, build())
+        return entry[1]
+
+    def genai_client(self, api_key: str) -> genai.Client:
+        """Return a cached Gemini client that reuses the shared HTTP pool"""
+        self.evict_idle()
+        key = _key_hash(api_key)
+        entry = self._genai_clients.get(key)
+        client = entry[0] if entry else genai.Client(
+            api_key=api_key,
+            http_options=HttpOptions(httpx_async_client=self.http_client),
+        )
+        self._genai_clients[key] = (client, time.monotonic())
+        return client
+
+    def evict_idle(self, max_idle: float = LLM_CLIENT_IDLE_TTL_SECONDS) -> None:
+        """Drop clients that have not been used within max_idle seconds and close them in the background"""
+        cutoff = time.monotonic() - max_idle
+        evicted: List[Any] = []
+        for cache in (self._models, self._genai_clients):
+            for key in [k for k, (_, last_used) in cache.items() if last_used < cutoff]:
+                evicted.append(cache.pop(key)[0])
+        if evicted:
+            task = asyncio.get_running_loop().create_task(self._close_all(evicted))
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+        live = {id(model) for model, _ in self._models.values()}
+        for key in [k for k in self._agents if k[0] not in live]:
+            del self._agents[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {"chat_models": len(self._models), "genai_clients": len(self._genai_clients)}
+
+    @staticmethod
+    async def _close_all(clients: List[Any]) -> None:
+        await asyncio.gather(*(_close_client(client) for client in clients))
+
+    async def aclose(self) -> None:
+        """Close all clients, then the shared HTTP pool"""
+        clients = [client for cache in (self._models, self._genai_clients) for client, _ in cache.values()]
+        self._models.clear()
+        self._genai_clients.clear()
+        self._agents.clear()
+        await self._close_all(clients)
+        if self._closing:
+            await asyncio.gather(*self._closing)
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+
+
+# Async HTTP pools are bound to the loop that created them (Streamlit uses a fresh loop per run)
+_registries: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, LLMClientRegistry]" = weakref.WeakKeyDictionary()
+
+
+def get_llm_registry() -> LLMClientRegistry:
+    """Client registry for the running event loop"""
+    loop = asyncio.get_running_loop()
+    registry = _registries.get(loop)
+    if registry is None:
+        registry = LLMClientRegistry()
+        _registries[loop] = registry
+    return registry
+
+
+async def close_llm_registry() -> None:
+    """Close the running loop's clients (FastAPI shutdown / end of a Streamlit run)"""
+    registry = _registries.pop(asyncio.get_running_loop(), None)
+    if registry is not None:
+        await registry.aclose()
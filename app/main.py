@@ -1,58 +1,171 @@
-from fastapi import FastAPI, HTTPException
-from app.models import Card, CardAnalysis
-from app.agents import (
-    tape_study_agent, stats_trends_agent, news_weighins_agent,
-    style_matchup_agent, market_odds_agent, judge_agent,
-    risk_scorer_agent, consistency_checker_agent
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from app.models import (
+    BatchJobResults, BatchJobStatus, Card, CardAnalysis, CardBatch, CardJobStatus, PipelineEvent, StoredCardAnalysis,
+    StoredFightAnalysis
 )
-from app.config import set_runtime_api_keys
+from app.agents import install_sync_executor
+from app.pipeline import analyze_card_pipeline
+from app.cache import response_cache
+from app.prompt_cache import prompt_cache_stats
+from app.metrics import render_prometheus
+from app.llm_providers import close_llm_registry
+from app.search import close_search_client
+from app.redis_client import close_redis
+from app.scheduler import AdmissionRejected, get_scheduler
+from app.resilience import breaker_stats
+from app.batch import get_batch_runner
+from app.jobs import get_job_workers
+from app.store import get_analysis_store
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Literal, Optional
 import asyncio
 from loguru import logger
 
-app = FastAPI(title="UFC Card Analysis API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Keep sync-only providers/tools off the event loop, on a bounded pool
+    install_sync_executor(asyncio.get_running_loop())
+    # Pick up batch jobs interrupted by the last shutdown
+    await get_batch_runner().resume()
+    # Card jobs queued before the last shutdown are picked up by the new workers
+    await get_job_workers().start()
+    yield
+    await get_job_workers().aclose()
+    await get_batch_runner().aclose()
+    # Close pooled LLM clients and their keep-alive connections
+    await close_llm_registry()
+    await close_search_client()
+    await close_redis()
 
-@app.post("/analyze-card", response_model=CardAnalysis)
-async def analyze_card(card: Card):
+app = FastAPI(title="UFC Card Analysis API", version="1.0.0", lifespan=lifespan)
+
+def too_busy(e: AdmissionRejected) -> HTTPException:
+    logger.warning(f"Rejecting card: {e}")
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+@app.post("/analyze-card", response_model=CardAnalysis, responses={202: {"model": CardJobStatus}})
+async def analyze_card(card: Card, background: bool = Query(False, description="Queue the card as a job and return its job_id at once; poll /jobs/{job_id}")):
+    if background:
+        try:
+            job = await get_job_workers().submit(card)
+        except AdmissionRejected as e:
+            raise too_busy(e)
+        return JSONResponse(status_code=202, content=job.model_dump(mode="json"))
     try:
         logger.info(f"Analyzing card with {len(card.fights)} fights")
 
-        # Extract model overrides, custom prompts, and API keys from card
-        agent_models = card.agent_models
-        custom_prompts = card.custom_prompts
-        api_keys = card.api_keys
+        async with get_scheduler().admit():
+            return await analyze_card_pipeline(card)
 
-        # Set runtime API keys to environment if provided
-        set_runtime_api_keys(api_keys)
+    except AdmissionRejected as e:
+        raise too_busy(e)
+    except Exception as e:
+        logger.error(f"Error analyzing card: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-        # # Run 5 main agents in parallel
-        tape_task = tape_study_agent(card, agent_models.tape_study if agent_models else None, card.use_serper, api_keys, custom_prompts.tape_study if custom_prompts else None)
-        stats_task = stats_trends_agent(card, agent_models.stats_trends if agent_models else None, card.use_serper, api_keys, custom_prompts.stats_trends if custom_prompts else None)
-        news_task = news_weighins_agent(card, agent_models.news_weighins if agent_models else None, card.use_serper, api_keys, custom_prompts.news_weighins if custom_prompts else None)
-        style_task = style_matchup_agent(card, agent_models.style_matchup if agent_models else None, card.use_serper, api_keys, custom_prompts.style_matchup if custom_prompts else None)
-        market_task = market_odds_agent(card, agent_models.market_odds if agent_models else None, card.use_serper, api_keys, custom_prompts.market_odds if custom_prompts else None)
+async def stream_card_events(card: Card, fmt: str) -> AsyncIterator[str]:
+    """Run the pipeline in the background and yield its stage events as they occur"""
+    queue: asyncio.Queue = asyncio.Queue()
 
-        tape, stats, news, style, market = await asyncio.gather(
-            tape_task, stats_task, news_task, style_task, market_task
-        )
+    async def run():
+        try:
+            async with get_scheduler().admit():
+                await analyze_card_pipeline(card, on_event=queue.put_nowait)
+        except Exception as e:
+            logger.error(f"Error streaming card analysis: {e}")
+            queue.put_nowait(PipelineEvent(event="error", detail=str(e)))
+        finally:
+            queue.put_nowait(None)
 
-        logger.info("Main agents completed")
+    task = asyncio.create_task(run())
+    try:
+        while (event := await queue.get()) is not None:
+            payload = event.model_dump_json(exclude_none=True)
+            yield f"event: {event.event}\ndata: {payload}\n\n" if fmt == "sse" else f"{payload}\n"
+    finally:
+        # Client went away before completion: stop paying for LLM calls
+        if not task.done():
+            task.cancel()
 
-        # Judge agent
-        analyses = await judge_agent(card, tape, stats, news, style, market, agent_models.judge if agent_models else None, api_keys, custom_prompts.judge if custom_prompts else None)
-        logger.info("Judge completed")
+@app.post("/analyze-card/stream")
+async def analyze_card_stream(card: Card, format: Literal["ndjson", "sse"] = "ndjson"):
+    """Stream stage events and per-fight results as newline-delimited JSON or server-sent events"""
+    logger.info(f"Streaming analysis of card with {len(card.fights)} fights ({format})")
+    try:
+        # Reject before the 200 streaming response starts; the card then queues inside the stream
+        get_scheduler().check_admission()
+    except AdmissionRejected as e:
+        raise too_busy(e)
 
-        # Post agents
-        analyses = await risk_scorer_agent(analyses, agent_models.risk_scorer if agent_models else None, api_keys, custom_prompts.risk_scorer if custom_prompts else None)
-        analyses = await consistency_checker_agent(analyses, agent_models.consistency_checker if agent_models else None, api_keys, custom_prompts.consistency_checker if custom_prompts else None)
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(stream_card_events(card, format), media_type=media_type)
 
-        logger.info("Post agents completed")
+@app.post("/analyze-cards", response_model=BatchJobStatus, status_code=202)
+async def analyze_cards(batch: CardBatch):
+    """Queue many cards as one background job; poll its status and fetch results by job_id"""
+    logger.info(f"Queueing batch of {len(batch.cards)} cards (provider batch: {batch.provider_batch})")
+    return await get_batch_runner().submit(batch)
 
-        return CardAnalysis(analyses=analyses)
+@app.get("/analyze-cards/{job_id}", response_model=BatchJobStatus)
+async def batch_job_status(job_id: str):
+    status = await get_batch_runner().store.status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Unknown batch job {job_id}")
+    return status
 
-    except Exception as e:
-        logger.error(f"Error analyzing card: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+@app.get("/analyze-cards/{job_id}/results", response_model=BatchJobResults)
+async def batch_job_results(job_id: str):
+    """Per-card analyses so far; fights still running are listed as pending"""
+    results = await get_batch_runner().results(job_id)
+    if results is None:
+        raise HTTPException(status_code=404, detail=f"Unknown batch job {job_id}")
+    return results
+
+@app.get("/jobs/{job_id}", response_model=CardJobStatus)
+async def card_job_status(job_id: str):
+    """Status of a background card job, its fight analyses so far and, once completed, the full CardAnalysis"""
+    status = await get_job_workers().status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return status
+
+@app.get("/analyses", response_model=List[StoredFightAnalysis])
+async def query_analyses(fight_id: Optional[str] = None, fighter: Optional[str] = None, date_from: Optional[str] = None,
+                         date_to: Optional[str] = None, location: Optional[str] = None, limit: int = Query(50, ge=1)):
+    """Stored fight analyses, newest first, filtered by fight_id, fighter name (either corner), date range (ISO) or location"""
+    return await get_analysis_store().query(fight_id, fighter, date_from, date_to, location, limit)
+
+@app.get("/analyses/{analysis_id}", response_model=StoredCardAnalysis)
+async def get_analysis(analysis_id: str):
+    """A stored card analysis with its agent outputs, models and parameters"""
+    stored = await get_analysis_store().get(analysis_id)
+    if stored is None:
+        raise HTTPException(status_code=404, detail=f"Unknown analysis {analysis_id}")
+    return stored
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Agent response cache hit/miss counters and provider prompt-cache token usage"""
+    return {**response_cache.stats(), "prompt_cache": prompt_cache_stats()}
+
+@app.delete("/cache")
+async def clear_cache():
+    """Drop all cached agent responses"""
+    if response_cache.backend:
+        await response_cache.backend.clear()
+    return {"cleared": True}
+
+@app.get("/scheduler/stats")
+async def scheduler_stats():
+    """Admission queue depth, per-provider in-flight calls, queued calls and token budget, and circuit breaker states"""
+    return {**get_scheduler().stats(), "circuit_breakers": breaker_stats()}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus metrics: per-agent latency, queue time, TTFT, tokens and tool calls"""
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
 
 @app.get("/")
 async def root():
-    return {"message": "UFC Card Analysis API", "endpoint": "/analyze-card"}
+    return {"message": "UFC Card Analysis API", "endpoint": "/analyze-card", "stream_endpoint": "/analyze-card/stream"}
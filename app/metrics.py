@@ -0,0 +1,268 @@
+import asyncio
+import contextvars
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from app.models import AgentCallTrace, RequestTrace
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.values: Dict[Tuple[Tuple[str, str], ...], float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        self.values[tuple(sorted(labels.items()))] += amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[tuple(sorted(labels.items()))] = value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        for labels, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series: Dict[Tuple[Tuple[str, str], ...], Dict[str, Any]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        series = self.series.setdefault(key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series["counts"][i] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self.series.items()):
+            for bound, count in zip(self.buckets, series["counts"]):
+                lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', str(bound)),))} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {series['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {series['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {series['count']}")
+        return lines
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{k}="{_escape(v)}"' for k, v in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+AGENT_CALLS = Counter("ufc_agent_calls_total", "Agent calls by agent, model, status and cache hit")
+AGENT_TOKENS = Counter("ufc_agent_tokens_total", "LLM tokens by agent, model and kind (input/output/cached)")
+AGENT_TOOL_CALLS = Counter("ufc_agent_tool_calls_total", "Tool invocations made by agents")
+AGENT_LATENCY = Histogram("ufc_agent_latency_seconds", "Agent call wall time")
+AGENT_QUEUE = Histogram("ufc_agent_queue_seconds", "Time from scheduling an agent call to its first LLM request")
+AGENT_TTFT = Histogram("ufc_agent_time_to_first_token_seconds", "Time to first streamed token")
+CARD_LATENCY = Histogram("ufc_card_latency_seconds", "End-to-end card analysis time")
+ADMISSION_ACTIVE = Gauge("ufc_admission_active_cards", "Cards currently being analyzed")
+ADMISSION_QUEUED = Gauge("ufc_admission_queued_cards", "Cards waiting for admission")
+ADMISSION_REJECTED = Counter("ufc_admission_rejected_total", "Cards rejected with 429 because the admission queue was full")
+PROVIDER_IN_FLIGHT = Gauge("ufc_provider_in_flight", "Agent calls holding a provider concurrency slot")
+PROVIDER_QUEUED = Gauge("ufc_provider_queued", "Agent calls waiting for a provider concurrency slot or token budget")
+CIRCUIT_STATE = Gauge("ufc_provider_circuit_state", "Provider circuit breaker state (0 closed, 1 half-open, 2 open)")
+PROVIDER_WAIT = Histogram("ufc_provider_wait_seconds", "Time agent calls waited on provider concurrency and token limits")
+_METRICS = (
+    AGENT_CALLS, AGENT_TOKENS, AGENT_TOOL_CALLS, AGENT_LATENCY, AGENT_QUEUE, AGENT_TTFT, CARD_LATENCY,
+    ADMISSION_ACTIVE, ADMISSION_QUEUED, ADMISSION_REJECTED, PROVIDER_IN_FLIGHT, PROVIDER_QUEUED, PROVIDER_WAIT, CIRCUIT_STATE,
+)
+metrics_lock = threading.Lock()
+
+
+def render_prometheus() -> str:
+    """Prometheus text exposition of all collected metrics"""
+    with metrics_lock:
+        lines = [line for metric in _METRICS for line in metric.render()]
+    return "\n".join(lines) + "\n"
+
+
+class AgentCallRecorder:
+    """Collects timing and usage for one agent call"""
+
+    def __init__(self, agent: str, fight_id: Optional[str] = None):
+        self.agent = agent
+        self.fight_id = fight_id
+        self.model: Optional[str] = None
+        # Set by the resilience layer when the call returns; a hedge or fallback model may answer instead
+        self.answered_by: Optional[str] = None
+        self.started = time.perf_counter()
+        self.first_request: Optional[float] = None
+        self.first_token: Optional[float] = None
+        self.llm_calls = 0
+        self.tool_calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cached_tokens = 0
+        self.cache_hit = False
+
+    def llm_started(self, model: Optional[str]) -> None:
+        self.llm_calls += 1
+        self.model = self.model or model
+        if self.first_request is None:
+            self.first_request = time.perf_counter()
+
+    def add_usage(self, input_tokens: int = 0, output_tokens: int = 0, cached_tokens: int = 0) -> None:
+        self.input_tokens += input_tokens or 0
+        self.output_tokens += output_tokens or 0
+        self.cached_tokens += cached_tokens or 0
+
+    def callback_handler(self) -> "MetricsCallbackHandler":
+        return MetricsCallbackHandler(self)
+
+    def finish(self, status: str) -> AgentCallTrace:
+        now = time.perf_counter()
+        return AgentCallTrace(
+            agent=self.agent,
+            fight_id=self.fight_id,
+            model=self.answered_by or self.model,
+            status=status,
+            cache_hit=self.cache_hit,
+            wall_time=round(now - self.started, 4),
+            queue_time=round(self.first_request - self.started, 4) if self.first_request else None,
+            time_to_first_token=round(self.first_token - self.first_request, 4) if self.first_token and self.first_request else None,
+            llm_calls=self.llm_calls,
+            tool_calls=self.tool_calls,
+            input_tokens=self.input_tokens,
+            output_tokens=self.output_tokens,
+            cached_tokens=self.cached_tokens,
+        )
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """LangChain callback feeding LLM and tool events into an AgentCallRecorder"""
+
+    # Cheap bookkeeping only: run on the event loop instead of a worker thread
+    run_inline = True
+
+    def __init__(self, recorder: AgentCallRecorder):
+        self.recorder = recorder
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: Any, **kwargs: Any) -> None:
+        metadata = kwargs.get("metadata") or {}
+        self.recorder.llm_started(metadata.get("ls_model_name"))
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if self.recorder.first_token is None:
+            self.recorder.first_token = time.perf_counter()
+
+    def on_llm_end(self, response: Any, **kwargs: Any) -> None:
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    details = usage.get("input_token_details") or {}
+                    self.recorder.add_usage(usage.get("input_tokens", 0), usage.get("output_tokens", 0), details.get("cache_read") or 0)
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs: Any) -> None:
+        self.recorder.tool_calls += 1
+
+
+_current_call: contextvars.ContextVar[Optional[AgentCallRecorder]] = contextvars.ContextVar("agent_call", default=None)
+_current_trace: contextvars.ContextVar[Optional[List[AgentCallTrace]]] = contextvars.ContextVar("request_trace", default=None)
+
+
+def current_call() -> Optional[AgentCallRecorder]:
+    return _current_call.get()
+
+
+def mark_cache_hit() -> None:
+    recorder = _current_call.get()
+    if recorder is not None:
+        recorder.cache_hit = True
+
+
+def _export(trace: AgentCallTrace) -> None:
+    model = trace.model or "unknown"
+    with metrics_lock:
+        AGENT_CALLS.inc(agent=trace.agent, model=model, status=trace.status, cache_hit=str(trace.cache_hit).lower())
+        AGENT_LATENCY.observe(trace.wall_time, agent=trace.agent, model=model)
+        if trace.queue_time is not None:
+            AGENT_QUEUE.observe(trace.queue_time, agent=trace.agent)
+        if trace.time_to_first_token is not None:
+            AGENT_TTFT.observe(trace.time_to_first_token, agent=trace.agent, model=model)
+        for kind, count in (("input", trace.input_tokens), ("output", trace.output_tokens), ("cached", trace.cached_tokens)):
+            if count:
+                AGENT_TOKENS.inc(count, agent=trace.agent, model=model, kind=kind)
+        if trace.tool_calls:
+            AGENT_TOOL_CALLS.inc(trace.tool_calls, agent=trace.agent)
+
+
+@contextmanager
+def record_agent_call(agent: str, fight_id: Optional[str] = None) -> Iterator[AgentCallRecorder]:
+    """Measure one agent call and add it to the request trace and exported metrics"""
+    recorder = AgentCallRecorder(agent, fight_id)
+    token = _current_call.set(recorder)
+    status = "ok"
+    try:
+        yield recorder
+    except asyncio.CancelledError:
+        status = "cancelled"
+        raise
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        _current_call.reset(token)
+        trace = recorder.finish(status)
+        calls = _current_trace.get()
+        if calls is not None:
+            calls.append(trace)
+        _export(trace)
+
+
+@contextmanager
+def request_trace() -> Iterator[List[AgentCallTrace]]:
+    """Collect the agent calls made while analyzing one card"""
+    calls: List[AgentCallTrace] = []
+    token = _current_trace.set(calls)
+    try:
+        yield calls
+    finally:
+        _current_trace.reset(token)
+
+
+def build_request_trace(calls: List[AgentCallTrace], total_time: float) -> RequestTrace:
+    with metrics_lock:
+        CARD_LATENCY.observe(total_time)
+    return RequestTrace(
+        total_time=round(total_time, 4),
+        calls=list(calls),
+        input_tokens=sum(call.input_tokens for call in calls),
+        output_tokens=sum(call.output_tokens for call in calls),
+        cached_tokens=sum(call.cached_tokens for call in calls),
+    )
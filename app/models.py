@@ -1,5 +1,6 @@
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict
+from pydantic.json_schema import SkipJsonSchema
+from typing import Any, List, Optional, Dict, Literal
 
 class AgentTemperatures(BaseModel):
     """Custom temperature settings for specific agents"""
@@ -11,6 +12,7 @@ class AgentTemperatures(BaseModel):
     judge: Optional[float] = Field(default=None, description="Temperature (0.0-1.0) for judge agent")
     risk_scorer: Optional[float] = Field(default=None, description="Temperature (0.0-1.0) for risk scorer agent")
     consistency_checker: Optional[float] = Field(default=None, description="Temperature (0.0-1.0) for consistency checker agent")
+    post_review: Optional[float] = Field(default=None, description="Temperature (0.0-1.0) for combined post review agent")
 
 class AgentTopPs(BaseModel):
     """Custom top-p settings for specific agents"""
@@ -22,6 +24,7 @@ class AgentTopPs(BaseModel):
     judge: Optional[float] = Field(default=None, description="Top-p (0.0-1.0) for judge agent")
     risk_scorer: Optional[float] = Field(default=None, description="Top-p (0.0-1.0) for risk scorer agent")
     consistency_checker: Optional[float] = Field(default=None, description="Top-p (0.0-1.0) for consistency checker agent")
+    post_review: Optional[float] = Field(default=None, description="Top-p (0.0-1.0) for combined post review agent")
 
 class AgentPrompts(BaseModel):
     """Custom prompts for specific agents"""
@@ -33,6 +36,7 @@ class AgentPrompts(BaseModel):
     judge: Optional[str] = Field(default=None, example="Custom judge prompt...")
     risk_scorer: Optional[str] = Field(default=None, example="Custom risk scorer prompt...")
     consistency_checker: Optional[str] = Field(default=None, example="Custom consistency checker prompt...")
+    post_review: Optional[str] = Field(default=None, example="Custom combined post review prompt...")
 
 class AgentModels(BaseModel):
     """Model overrides for specific agents"""
@@ -44,6 +48,7 @@ class AgentModels(BaseModel):
     judge: Optional[str] = Field(default=None, example="gpt-5")
     risk_scorer: Optional[str] = Field(default=None, example="gpt-5-mini")
     consistency_checker: Optional[str] = Field(default=None, example="claude-3-5-haiku-20241022")
+    post_review: Optional[str] = Field(default=None, example="gpt-5-mini")
 
 class Fight(BaseModel):
     fight_id: str
@@ -80,6 +85,49 @@ class Card(BaseModel):
         default=None,
         description="Optional custom top-p settings for specific agents. If not provided, defaults are used."
     )
+    research_prefetch: bool = Field(
+        default=False,
+        description="Run one deterministic Serper search pass per fight before the analysts and share the compacted results with every analyst prompt instead of letting each agent search on its own."
+    )
+    shard_by_fight: bool = Field(
+        default=False,
+        description="Run the analyst -> judge -> risk -> consistency chain per fight as independent, concurrently scheduled shards instead of one full-card pass."
+    )
+    cache_mode: Literal["use", "refresh", "bypass"] = Field(
+        default="use",
+        description="Agent response cache behaviour: 'use' serves cached responses, 'refresh' recomputes and overwrites them, 'bypass' neither reads nor writes."
+    )
+    judge_quorum: Optional[int] = Field(
+        default=None,
+        ge=1,
+        le=5,
+        description="Start the judge once this many analysts have reported instead of waiting for all five. Defaults to JUDGE_QUORUM (0 = wait for all)."
+    )
+    judge_grace_seconds: Optional[float] = Field(
+        default=None,
+        ge=0,
+        description="Once the quorum is in, how long to keep waiting for the remaining analysts before the judge starts without them. Defaults to JUDGE_GRACE_SECONDS."
+    )
+    post_processing: Optional[Literal["sequential", "combined", "concurrent"]] = Field(
+        default=None,
+        description="How the risk scorer and consistency checker run after the judge: 'sequential' (one after the other), 'combined' (a single structured call doing both) or 'concurrent' (both at once, merging risk_flags from the risk scorer and confidence from the consistency checker). Defaults to POST_PROCESSING_MODE."
+    )
+    post_review_policy: Optional[Literal["llm", "rules", "auto"]] = Field(
+        default=None,
+        description="Which fights get the LLM post review: 'llm' (all), 'rules' (none; deterministic rules only) or 'auto' (only fights flagged by the review rules, e.g. high-confidence picks or low analyst agreement). Defaults to POST_REVIEW_POLICY."
+    )
+    card_id: Optional[str] = Field(
+        default=None,
+        description="Stable id of the card, e.g. an event slug. Incremental re-analysis compares against the last stored run with the same id; defaults to the card's set of fight_ids."
+    )
+    incremental: Optional[bool] = Field(
+        default=None,
+        description="Reuse the last stored run of this card and recompute only fights (and, in sharded mode, agents) whose inputs or configuration changed. Ignored unless cache_mode is 'use'. Defaults to INCREMENTAL_ANALYSIS."
+    )
+    include_trace: bool = Field(
+        default=False,
+        description="Return a per-agent latency and token trace alongside the analyses."
+    )
     api_keys: Optional[Dict[str, str]] = Field(
         default=None,
         description="Optional API keys for LLM providers. If not provided, uses environment variables. Keys: 'openai', 'anthropic', 'serper'"
@@ -123,5 +171,140 @@ class FightAnalysis(BaseModel):
     risk_flags: List[str]
     props: List[str]
 
+class AgentCallTrace(BaseModel):
+    """Timing and token accounting for one agent call"""
+    agent: str
+    fight_id: Optional[str] = None
+    model: Optional[str] = None
+    status: str = "ok"
+    cache_hit: bool = False
+    wall_time: float = Field(description="Seconds from scheduling the call to its result")
+    queue_time: Optional[float] = Field(default=None, description="Seconds before the first LLM request was sent")
+    time_to_first_token: Optional[float] = Field(default=None, description="Seconds to the first streamed token (only when the provider streams)")
+    llm_calls: int = 0
+    tool_calls: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0
+
+class RequestTrace(BaseModel):
+    """Per-request trace of every agent call made while analyzing a card"""
+    total_time: float
+    calls: List[AgentCallTrace]
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0
+
 class CardAnalysis(BaseModel):
     analyses: List[FightAnalysis]
+    analysis_id: SkipJsonSchema[Optional[str]] = Field(
+        default=None,
+        description="Id of the stored analysis (GET /analyses/{analysis_id}) when the analysis store is enabled"
+    )
+    # Hidden from the schema so structured-output agents never try to fill it in
+    trace: SkipJsonSchema[Optional[RequestTrace]] = Field(
+        default=None,
+        description="Per-agent latency and token trace, present when the card requested include_trace"
+    )
+
+class FightReview(BaseModel):
+    """Changes a post-review agent makes to one fight; picks and narrative fields are never rewritten"""
+    fight_id: str
+    added_risk_flags: List[str] = Field(default_factory=list, description="New risk flags only; existing flags are kept automatically")
+    confidence: Optional[int] = Field(default=None, ge=0, le=100, description="Recalibrated confidence, or null to keep the current value")
+    reason: Optional[str] = Field(default=None, description="One short sentence explaining the change")
+
+class CardReview(BaseModel):
+    reviews: List[FightReview] = Field(description="One entry per fight that needs a change; omit fights that stay as they are")
+
+class PipelineEvent(BaseModel):
+    """Stage event emitted while a card is being analyzed (streaming endpoint)"""
+    event: str = Field(description="agent_started, agent_finished, agent_failed, agent_reused, judge_result, review_skipped, fight_reused, fight_result, fight_failed, card_complete or error")
+    agent: Optional[str] = None
+    fight_id: Optional[str] = None
+    analysis: Optional[FightAnalysis] = None
+    result: Optional[CardAnalysis] = None
+    detail: Optional[str] = None
+    elapsed: Optional[float] = Field(default=None, description="Seconds since the card analysis started")
+
+class CardBatch(BaseModel):
+    """Many cards analyzed as one background job (/analyze-cards)"""
+    cards: List[Card] = Field(min_length=1, description="Cards to analyze; fights shared between cards with the same settings are analyzed once")
+    provider_batch: bool = Field(
+        default=True,
+        description="Send agent calls through provider batch APIs (OpenAI, Anthropic) for lower cost at the price of latency; other providers are called directly."
+    )
+
+class BatchJobStatus(BaseModel):
+    job_id: str
+    status: Literal["queued", "running", "completed", "failed"]
+    cards: int
+    fights: int = Field(description="Fights across all cards, counting shared fights once per card")
+    unique_fights: int = Field(description="Fights actually analyzed after deduplication")
+    completed_fights: int
+    failed_fights: int
+    created_at: float
+    updated_at: float
+
+class BatchCardResult(BaseModel):
+    card_index: int
+    analyses: List[FightAnalysis]
+    pending_fights: List[str] = Field(default_factory=list, description="Fights not analyzed yet")
+    failed_fights: Dict[str, str] = Field(default_factory=dict, description="Error per fight that could not be analyzed")
+
+class BatchJobResults(BaseModel):
+    job: BatchJobStatus
+    results: List[BatchCardResult]
+
+class CardJobStatus(BaseModel):
+    """A card analysis running as a background job (/analyze-card?background=true)"""
+    job_id: str
+    status: Literal["queued", "running", "completed", "failed"]
+    fights: int
+    completed_fights: int = Field(default=0, description="Fights with an analysis so far")
+    partial: List[FightAnalysis] = Field(default_factory=list, description="Fight analyses finished so far, in completion order")
+    result: Optional[CardAnalysis] = Field(default=None, description="The final analysis once the job completed")
+    error: Optional[str] = None
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+class AgentOutputRecord(BaseModel):
+    """One agent's output as produced while analyzing a card"""
+    agent: str
+    fight_id: Optional[str] = Field(default=None, description="Fight shard the output belongs to (sharded mode only)")
+    model: Optional[str] = Field(default=None, description="Model that answered, when the call ran rather than coming from the cache")
+    status: str = Field(default="ok", description="ok, failed (no output), fallback (its rule-based fallback was used instead) or skipped (nothing to do)")
+    output: Any
+
+class AgentSettingsRecord(BaseModel):
+    """Model and sampling parameters an agent ran with"""
+    model: str
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    custom_prompt: bool = False
+
+class RunFingerprints(BaseModel):
+    """Content hashes of a run's inputs, compared by incremental re-analysis"""
+    card_key: str
+    sharded: bool
+    fights: Dict[str, str] = Field(description="Fingerprint per fight_id of the fight and the post-review rules applied to it")
+    inputs: Dict[str, str] = Field(default_factory=dict, description="Fingerprint per fight_id of the fight's inputs alone")
+    agents: Dict[str, str] = Field(description="Fingerprint of the configuration of every agent the run used")
+
+class StoredCardAnalysis(BaseModel):
+    """A persisted card analysis with everything needed to audit it"""
+    analysis_id: str
+    created_at: float
+    card: Card
+    result: CardAnalysis
+    settings: Dict[str, AgentSettingsRecord]
+    outputs: List[AgentOutputRecord]
+    fingerprints: Optional[RunFingerprints] = None
+
+class StoredFightAnalysis(BaseModel):
+    """One fight's persisted analysis, as returned by /analyses queries"""
+    analysis_id: str
+    created_at: float
+    fight: Fight
+    analysis: FightAnalysis
@@ -0,0 +1,269 @@
+import asyncio
+import contextlib
+import time
+import weakref
+from contextvars import ContextVar
+from typing import Any, AsyncContextManager, Dict, List, Optional
+
+from loguru import logger
+
+from app.agents import (
+    ANALYST_SPECS, CONSISTENCY_CHECKER_SPEC, JUDGE_SPEC, POST_REVIEW_SPEC, RISK_SCORER_SPEC,
+    agent_node, agent_settings, post_input
+)
+from app.config import (
+    AGENT_MAX_CONCURRENCY, ANALYSIS_STORE_ENABLED, INCREMENTAL_ANALYSIS, JUDGE_GRACE_SECONDS, JUDGE_QUORUM,
+    MAX_CONCURRENT_FIGHTS, POST_PROCESSING_MODE, POST_REVIEW_POLICY, request_api_keys
+)
+from app.cache import CACHE_USE
+from app.engine import (
+    CachingHook, ConcurrencyHook, EventCallback, Node, NodeHook, NodeInputs, PipelineEngine, RecordingHook, TracingHook
+)
+from app.post_rules import ReviewPlan, analyst_signals, apply_consistency_rules, apply_risk_rules, plan_reviews
+from app.rendering import log_prompt_size
+from app.research import prefetch_research
+from app.scheduler import scheduling_owner
+from app.search import search_budget
+from app.metrics import build_request_trace, request_trace
+from app.incremental import IncrementalPlan, plan_incremental, run_fingerprints
+from app.models import AgentOutputRecord, Card, CardAnalysis, Fight, FightAnalysis, PipelineEvent, RunFingerprints
+from app.store import get_analysis_store
+
+# Agent outputs of the card being analyzed, collected for the analysis store
+_agent_outputs: ContextVar[Optional[List[AgentOutputRecord]]] = ContextVar("agent_outputs", default=None)
+
+# One fight semaphore per event loop (Streamlit runs each analysis on a fresh loop)
+_fight_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+
+def _fight_slot() -> AsyncContextManager[Any]:
+    """Global cap on fights being analyzed concurrently across all requests, if one is set"""
+    if MAX_CONCURRENT_FIGHTS <= 0:
+        return contextlib.nullcontext()
+    loop = asyncio.get_running_loop()
+    semaphore = _fight_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_FIGHTS)
+        _fight_semaphores[loop] = semaphore
+    return semaphore
+
+
+# Shared by every pipeline so per-agent caps hold across requests
+_concurrency_hook = ConcurrencyHook(AGENT_MAX_CONCURRENCY)
+
+
+def merge_post_reviews(analyses: List[FightAnalysis], risk: List[FightAnalysis], consistency: List[FightAnalysis]) -> List[FightAnalysis]:
+    """Combine concurrent post reviews per fight: risk_flags from the risk scorer, confidence from the consistency checker"""
+    risk_by_fight = {a.fight_id: a for a in risk}
+    consistency_by_fight = {a.fight_id: a for a in consistency}
+    merged = []
+    for analysis in analyses:
+        update: Dict[str, Any] = {}
+        if analysis.fight_id in risk_by_fight:
+            update["risk_flags"] = risk_by_fight[analysis.fight_id].risk_flags
+        if analysis.fight_id in consistency_by_fight:
+            update["confidence"] = consistency_by_fight[analysis.fight_id].confidence
+        merged.append(analysis.model_copy(update=update))
+    return merged
+
+
+def _emit(on_event: Optional[EventCallback], event: str, **fields: Any) -> None:
+    if on_event:
+        on_event(PipelineEvent(event=event, **fields))
+
+
+def _has_post_input(inputs: NodeInputs) -> bool:
+    return bool(post_input(inputs))
+
+
+def post_review_nodes(card: Card, mode: str) -> List[Node]:
+    """LLM post-review nodes for a post-processing mode, reading the fights to review from post_triage"""
+    if mode == "combined":
+        return [agent_node(POST_REVIEW_SPEC, card, ["post_triage"], run_if=_has_post_input)]
+    if mode == "concurrent":
+        return [
+            agent_node(RISK_SCORER_SPEC, card, ["post_triage"], run_if=_has_post_input),
+            agent_node(CONSISTENCY_CHECKER_SPEC, card, ["post_triage"], run_if=_has_post_input),
+        ]
+    if mode != "sequential":
+        raise ValueError(f"Unknown post-processing mode: {mode}")
+    return [
+        agent_node(RISK_SCORER_SPEC, card, ["post_triage"], run_if=_has_post_input),
+        agent_node(CONSISTENCY_CHECKER_SPEC, card, ["risk_scorer"], run_if=_has_post_input),
+    ]
+
+
+def build_card_graph(card: Card, on_event: Optional[EventCallback] = None, fight_id: Optional[str] = None) -> List[Node]:
+    """Pipeline graph for a card: research -> analysts -> judge -> review triage -> post review -> merged analyses"""
+    nodes: List[Node] = []
+    research_deps: List[str] = []
+    if card.research_prefetch:
+        # One shared search pass replaces per-agent tool-calling loops
+        nodes.append(Node("research_prefetch", lambda inputs: prefetch_research(card)))
+        research_deps = ["research_prefetch"]
+
+    # A failed or late analyst must not take the others down with it; the judge needs just one report
+    nodes.extend(agent_node(spec, card, research_deps) for spec in ANALYST_SPECS)
+    analysts = [spec.name for spec in ANALYST_SPECS]
+    quorum = card.judge_quorum if card.judge_quorum is not None else JUDGE_QUORUM
+    grace = card.judge_grace_seconds if card.judge_grace_seconds is not None else JUDGE_GRACE_SECONDS
+
+    nodes.append(agent_node(JUDGE_SPEC, card, analysts, optional=analysts, min_deps=1, quorum=quorum, grace=grace, store_if=bool))
+
+    async def triage(inputs: NodeInputs) -> ReviewPlan:
+        analyses = inputs["judge"]
+        for analysis in analyses:
+            _emit(on_event, "judge_result", fight_id=analysis.fight_id, analysis=analysis)
+        signals = analyst_signals(card.fights, [inputs[name] for name in analysts], analyses)
+        plan = plan_reviews(analyses, signals, card.post_review_policy or POST_REVIEW_POLICY)
+        for analysis in plan.cleared:
+            _emit(on_event, "review_skipped", fight_id=analysis.fight_id, detail="deterministic rules only")
+        return plan
+
+    # Analyst reports feed the review policy's agreement signals, so failed analysts are tolerated here too
+    nodes.append(Node("post_triage", triage, ["judge", *analysts], optional=analysts, traced=False))
+    mode = card.post_processing or POST_PROCESSING_MODE
+    reviewers = post_review_nodes(card, mode)
+    nodes.extend(reviewers)
+
+    async def merge(inputs: NodeInputs) -> List[FightAnalysis]:
+        plan: ReviewPlan = inputs["post_triage"]
+        # The rules edit in place; the judge's own output (events, stored record, reuse) must stay untouched
+        cleared = [a.model_copy(deep=True) for a in plan.cleared]
+        results = {a.fight_id: a for a in apply_consistency_rules(apply_risk_rules(cleared))}
+        if plan.review:
+            if mode == "concurrent":
+                reviewed = merge_post_reviews(plan.review, inputs["risk_scorer"], inputs["consistency_checker"])
+            else:
+                reviewed = inputs[reviewers[-1].name]
+            results.update((a.fight_id, a) for a in reviewed)
+        logger.info("Post agents completed")
+        return [results[a.fight_id] for a in inputs["judge"] if a.fight_id in results]
+
+    nodes.append(Node("post_merge", merge, ["judge", "post_triage", *(node.name for node in reviewers)], traced=False))
+    return nodes
+
+
+def pipeline_hooks(card: Card, on_event: Optional[EventCallback] = None, fight_id: Optional[str] = None) -> List[NodeHook]:
+    """Hooks every card pipeline runs with: tracing outermost, so cache hits and queueing show in the trace"""
+    hooks: List[NodeHook] = [TracingHook(on_event, fight_id)]
+    outputs = _agent_outputs.get()
+    if outputs is not None:
+        hooks.append(RecordingHook(outputs, fight_id))
+    hooks.append(CachingHook(card.cache_mode))
+    if any(AGENT_MAX_CONCURRENCY.values()):
+        hooks.append(_concurrency_hook)
+    return hooks
+
+
+async def run_card_pipeline(card: Card, on_event: Optional[EventCallback] = None, fight_id: Optional[str] = None,
+                            seeded: Optional[Dict[str, Any]] = None) -> List[FightAnalysis]:
+    """Run analysts -> judge -> post review over the whole card in one pass, taking seeded agent results as given"""
+    engine = PipelineEngine(build_card_graph(card, on_event, fight_id), pipeline_hooks(card, on_event, fight_id))
+    for agent in seeded or {}:
+        _emit(on_event, "agent_reused", agent=agent, fight_id=fight_id, detail="inputs and configuration unchanged")
+    return await engine.run("post_merge", seeded)
+
+
+def _select_fight(analyses: List[FightAnalysis], fight: Fight) -> List[FightAnalysis]:
+    """Keep only the analysis for this shard's fight, tolerating a relabelled fight_id"""
+    matching = [a for a in analyses if a.fight_id == fight.fight_id]
+    if not matching and len(analyses) == 1:
+        # The list may be a seeded or cached node result; relabel a copy
+        matching = [analyses[0].model_copy(update={"fight_id": fight.fight_id})]
+    return matching[:1]
+
+
+async def analyze_fight(card: Card, fight: Fight, on_event: Optional[EventCallback] = None,
+                        seeded: Optional[Dict[str, Any]] = None) -> List[FightAnalysis]:
+    """Run the full agent chain for a single fight as an independent shard"""
+    async with _fight_slot():
+        logger.info(f"Starting shard for fight {fight.fight_id}")
+        fight_card = card.model_copy(update={"fights": [fight]})
+        try:
+            analyses = _select_fight(await run_card_pipeline(fight_card, on_event, fight.fight_id, seeded), fight)
+        except Exception as e:
+            logger.error(f"Shard for fight {fight.fight_id} failed: {e}")
+            _emit(on_event, "fight_failed", fight_id=fight.fight_id, detail=str(e))
+            return []
+        if not analyses:
+            logger.warning(f"No analysis produced for fight {fight.fight_id}")
+            _emit(on_event, "fight_failed", fight_id=fight.fight_id, detail="no analysis produced")
+        for analysis in analyses:
+            _emit(on_event, "fight_result", fight_id=analysis.fight_id, analysis=analysis)
+        logger.info(f"Completed shard for fight {fight.fight_id}")
+        return analyses
+
+
+async def run_sharded_pipeline(card: Card, on_event: Optional[EventCallback] = None,
+                               seeds: Optional[Dict[str, Dict[str, Any]]] = None) -> List[FightAnalysis]:
+    """Run each fight as its own shard concurrently and merge results in card order"""
+    seeds = seeds or {}
+    shards = await asyncio.gather(*(analyze_fight(card, fight, on_event, seeds.get(fight.fight_id)) for fight in card.fights))
+    return [analysis for shard in shards for analysis in shard]
+
+
+async def incremental_plan(card: Card, fingerprints: RunFingerprints) -> Optional[IncrementalPlan]:
+    """Plan against the card's last stored run, when the card allows reuse and one exists"""
+    enabled = card.incremental if card.incremental is not None else INCREMENTAL_ANALYSIS
+    # Refresh and bypass ask for fresh agent calls
+    if not enabled or card.cache_mode != CACHE_USE:
+        return None
+    try:
+        previous = await get_analysis_store().latest(fingerprints.card_key)
+    except Exception as e:
+        logger.warning(f"Could not load the previous run of this card: {e}")
+        return None
+    if previous is None or previous.fingerprints is None:
+        return None
+    return plan_incremental(card, fingerprints, previous)
+
+
+async def analyze_card_pipeline(card: Card, on_event: Optional[EventCallback] = None) -> CardAnalysis:
+    """Analyze a card using the execution mode requested on the card"""
+    logger.info(f"Running card in {'sharded' if card.shard_by_fight else 'full-card'} mode")
+    log_prompt_size(card)
+    started = time.perf_counter()
+
+    def stamped(event: PipelineEvent) -> None:
+        event.elapsed = round(time.perf_counter() - started, 3)
+        on_event(event)
+
+    emit = stamped if on_event else None
+    fingerprints = run_fingerprints(card) if ANALYSIS_STORE_ENABLED else None
+    plan = await incremental_plan(card, fingerprints) if fingerprints else None
+    results: Dict[str, FightAnalysis] = {}
+    work = card
+    if plan is not None:
+        results.update(plan.reused)
+        work = card.model_copy(update={"fights": plan.recompute(card)})
+        for analysis in plan.reused.values():
+            _emit(emit, "fight_reused", fight_id=analysis.fight_id, detail=f"unchanged since analysis {plan.previous_id}")
+            _emit(emit, "fight_result", fight_id=analysis.fight_id, analysis=analysis)
+
+    outputs: List[AgentOutputRecord] = list(plan.carried) if plan else []
+    outputs_token = _agent_outputs.set(outputs)
+    try:
+        with request_api_keys(card.api_keys), scheduling_owner(), search_budget(), request_trace() as calls:
+            if not work.fights:
+                logger.info("Every fight is unchanged since the last run; nothing to recompute")
+            elif work.shard_by_fight:
+                results.update((a.fight_id, a) for a in await run_sharded_pipeline(work, emit, plan.seeds if plan else None))
+            else:
+                for analysis in await run_card_pipeline(work, emit):
+                    results[analysis.fight_id] = analysis
+                    _emit(emit, "fight_result", fight_id=analysis.fight_id, analysis=analysis)
+    finally:
+        _agent_outputs.reset(outputs_token)
+    analyses = [results[fight.fight_id] for fight in card.fights if fight.fight_id in results]
+    trace = build_request_trace(calls, time.perf_counter() - started)
+    logger.info(f"Card analyzed in {trace.total_time}s with {len(trace.calls)} agent calls ({trace.input_tokens} input / {trace.output_tokens} output tokens)")
+    result = CardAnalysis(analyses=analyses, trace=trace if card.include_trace else None)
+    if ANALYSIS_STORE_ENABLED and analyses:
+        try:
+            result.analysis_id = await get_analysis_store().save(card, result, agent_settings(card), outputs, fingerprints)
+        except Exception as e:
+            # The analysis itself succeeded; losing its record must not fail the request
+            logger.error(f"Failed to store card analysis: {e}")
+    _emit(emit, "card_complete", result=result)
+    return result
@@ -0,0 +1,133 @@
+import re
+from typing import Dict, List, Optional, Sequence
+
+from loguru import logger
+
+from app.config import (
+    POST_REVIEW_HIGH_CONFIDENCE, POST_REVIEW_LOW_CONFIDENCE, POST_REVIEW_MIN_AGREEMENT,
+    POST_REVIEW_MIN_ANALYSTS, POST_REVIEW_RULES, RULE_CONFIDENCE_FLOOR, RULE_OVERCONFIDENCE_THRESHOLD,
+    RULE_RISK_FLAG_PENALTY
+)
+from app.models import Fight, FightAnalysis, FightReview
+
+_WORD = re.compile(r"[\w'-]+")
+
+
+class AnalystSignals:
+    """What the analyst reports say about one fight: how many reported and how many lean towards the pick"""
+
+    def __init__(self, available: int, total: int, agreeing: int):
+        self.available = available
+        self.total = total
+        self.agreeing = agreeing
+
+    @property
+    def agreement(self) -> Optional[float]:
+        return self.agreeing / self.available if self.available else None
+
+
+def _surname(name: str) -> str:
+    words = _WORD.findall(name.lower())
+    return words[-1] if words else ""
+
+
+def _mentions(text: str, name: str) -> int:
+    surname = _surname(name)
+    return len(re.findall(rf"\b{re.escape(surname)}\b", text)) if surname else 0
+
+
+def analyst_signals(fights: Sequence[Fight], reports: Sequence[Optional[str]], analyses: Sequence[FightAnalysis]) -> Dict[str, AnalystSignals]:
+    """Per-fight analyst coverage and agreement with the judge's pick.
+
+    A report counts as agreeing when it names the picked fighter more often than the opponent; a cheap
+    lexical proxy, good enough to spot fights where the analysts pull in different directions.
+    """
+    available = [report.lower() for report in reports if report is not None]
+    fights_by_id = {fight.fight_id: fight for fight in fights}
+    signals = {}
+    for analysis in analyses:
+        fight = fights_by_id.get(analysis.fight_id)
+        agreeing = 0
+        if fight is not None:
+            opponent = fight.fighter2 if _surname(analysis.pick) == _surname(fight.fighter1) else fight.fighter1
+            agreeing = sum(1 for report in available if _mentions(report, analysis.pick) > _mentions(report, opponent))
+        signals[analysis.fight_id] = AnalystSignals(len(available), len(reports), agreeing)
+    return signals
+
+
+def review_reasons(analysis: FightAnalysis, signals: Optional[AnalystSignals] = None, rules: Sequence[str] = POST_REVIEW_RULES) -> List[str]:
+    """Enabled rules that call for an LLM review of this fight; an empty list means the deterministic rules suffice"""
+    reasons = []
+    if "high_confidence" in rules and analysis.confidence >= POST_REVIEW_HIGH_CONFIDENCE:
+        reasons.append(f"confidence {analysis.confidence} >= {POST_REVIEW_HIGH_CONFIDENCE}")
+    if "toss_up" in rules and analysis.confidence <= POST_REVIEW_LOW_CONFIDENCE:
+        reasons.append(f"confidence {analysis.confidence} <= {POST_REVIEW_LOW_CONFIDENCE}")
+    if "no_risk_flags" in rules and not analysis.risk_flags:
+        reasons.append("judge raised no risk flags")
+    if signals is not None:
+        if "missing_analysts" in rules and signals.available < POST_REVIEW_MIN_ANALYSTS:
+            reasons.append(f"only {signals.available}/{signals.total} analysts reported")
+        agreement = signals.agreement
+        if "low_agreement" in rules and agreement is not None and agreement < POST_REVIEW_MIN_AGREEMENT:
+            reasons.append(f"analyst agreement {agreement:.0%} < {POST_REVIEW_MIN_AGREEMENT:.0%}")
+    return reasons
+
+
+class ReviewPlan:
+    """Judge output split by the review policy into fights for the LLM post review and fights the rules clear"""
+
+    def __init__(self, review: List[FightAnalysis], cleared: List[FightAnalysis]):
+        self.review = review
+        self.cleared = cleared
+
+
+def plan_reviews(analyses: List[FightAnalysis], signals: Dict[str, AnalystSignals], policy: str) -> ReviewPlan:
+    """Apply a post review policy: "llm" reviews every fight, "rules" none, "auto" only fights a rule flags"""
+    if policy == "llm":
+        return ReviewPlan(list(analyses), [])
+    if policy not in ("rules", "auto"):
+        raise ValueError(f"Unknown post review policy: {policy}")
+    review, cleared = [], []
+    for analysis in analyses:
+        reasons = review_reasons(analysis, signals.get(analysis.fight_id)) if policy == "auto" else []
+        if reasons:
+            logger.info(f"Fight {analysis.fight_id} needs LLM review: {'; '.join(reasons)}")
+            review.append(analysis)
+        else:
+            cleared.append(analysis)
+    logger.info(f"Post review: {len(review)} fights for the LLM, {len(cleared)} by rules")
+    return ReviewPlan(review, cleared)
+
+
+def apply_risk_rules(analyses: List[FightAnalysis]) -> List[FightAnalysis]:
+    """Rule-based risk flags: overconfidence warning, and an explicit note when nothing was flagged"""
+    for analysis in analyses:
+        if analysis.confidence > RULE_OVERCONFIDENCE_THRESHOLD:
+            analysis.risk_flags.append("high confidence may indicate overestimation")
+        if len(analysis.risk_flags) == 0:
+            analysis.risk_flags.append("no major risks identified")
+    return analyses
+
+
+def apply_consistency_rules(analyses: List[FightAnalysis]) -> List[FightAnalysis]:
+    """Rule-based confidence calibration: multiple risk flags lower confidence, never below the floor"""
+    for analysis in analyses:
+        if len(analysis.risk_flags) > 1:
+            analysis.confidence = max(RULE_CONFIDENCE_FLOOR, analysis.confidence - RULE_RISK_FLAG_PENALTY)
+    return analyses
+
+
+def apply_reviews(analyses: List[FightAnalysis], reviews: Sequence[FightReview], risk_flags: bool = True, confidence: bool = True) -> List[FightAnalysis]:
+    """Apply post-review patches to copies of the judge output; reviews for unknown fights are ignored"""
+    by_fight = {review.fight_id: review for review in reviews}
+    patched = []
+    for analysis in analyses:
+        review = by_fight.get(analysis.fight_id)
+        update: Dict[str, object] = {}
+        if review is not None:
+            if risk_flags:
+                update["risk_flags"] = analysis.risk_flags + [f for f in review.added_risk_flags if f not in analysis.risk_flags]
+            if confidence and review.confidence is not None:
+                update["confidence"] = review.confidence
+        patched.append(analysis.model_copy(update=update))
+    return patched
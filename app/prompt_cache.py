@@ -0,0 +1,147 @@
+import asyncio
+import hashlib
+import time
+import weakref
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from google.genai.errors import ClientError
+from google.genai.types import CreateCachedContentConfig
+from loguru import logger
+
+from app.config import GEMINI_CONTEXT_CACHE_TTL_SECONDS
+from app.llm_providers import provider_for_model
+
+# Per-agent prompt cache accounting (input tokens served from provider-side caches)
+_usage: Dict[str, Dict[str, int]] = defaultdict(lambda: {"calls": 0, "input_tokens": 0, "cached_input_tokens": 0, "cache_creation_tokens": 0, "output_tokens": 0})
+
+# (api key hash, model, prompt hash) -> (cached content name or None if uncacheable, expires_at)
+_gemini_caches: Dict[Tuple[str, str, str], Tuple[Optional[str], float]] = {}
+# One create in flight per cache key; asyncio locks are per event loop (Streamlit uses a fresh loop per run)
+# Failed creates per cache key, so callers that waited on a failed create do not each retry it
+_gemini_failures: Dict[Tuple[str, str, str], int] = defaultdict(int)
+_gemini_locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[str, str, str], asyncio.Lock]]" = weakref.WeakKeyDictionary()
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def prompt_cache_key(agent_type: str, system_prompt: str) -> str:
+    """Stable OpenAI prompt_cache_key so identical static prefixes route to the same cache"""
+    return f"ufc-{agent_type}-{_digest(system_prompt)}"
+
+
+def build_messages(model_name: str, system_prompt: str, user_content: str) -> List[Dict[str, Any]]:
+    """Order messages so the static system prompt is always the exact cacheable prefix"""
+    if provider_for_model(model_name) == "anthropic":
+        system_content: Any = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+    else:
+        # OpenAI and Gemini cache identical prefixes automatically
+        system_content = system_prompt
+    return [
+        {"role": "system", "content": system_content},
+        {"role": "user", "content": user_content},
+    ]
+
+
+def record_usage(agent_type: str, messages: List[Any]) -> None:
+    """Accumulate token usage reported on the AI messages of an agent run"""
+    stats = _usage[agent_type]
+    for message in messages:
+        usage = getattr(message, "usage_metadata", None)
+        if not usage:
+            continue
+        details = usage.get("input_token_details") or {}
+        stats["calls"] += 1
+        stats["input_tokens"] += usage.get("input_tokens", 0)
+        stats["output_tokens"] += usage.get("output_tokens", 0)
+        stats["cached_input_tokens"] += details.get("cache_read") or 0
+        stats["cache_creation_tokens"] += details.get("cache_creation") or 0
+
+
+def usage_tokens(messages: List[Any]) -> int:
+    """Total tokens reported on the AI messages of an agent run"""
+    total = 0
+    for message in messages:
+        usage = getattr(message, "usage_metadata", None)
+        if usage:
+            total += usage.get("total_tokens") or usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+    return total
+
+
+def record_gemini_usage(agent_type: str, usage_metadata: Any) -> None:
+    """Accumulate token usage from a direct google-genai response"""
+    if usage_metadata is None:
+        return
+    stats = _usage[agent_type]
+    stats["calls"] += 1
+    stats["input_tokens"] += usage_metadata.prompt_token_count or 0
+    stats["output_tokens"] += usage_metadata.candidates_token_count or 0
+    stats["cached_input_tokens"] += usage_metadata.cached_content_token_count or 0
+
+
+def prompt_cache_stats() -> Dict[str, Any]:
+    agents = {}
+    for agent_type, stats in _usage.items():
+        ratio = stats["cached_input_tokens"] / stats["input_tokens"] if stats["input_tokens"] else None
+        agents[agent_type] = {**stats, "cached_ratio": round(ratio, 4) if ratio is not None else None}
+    return {"agents": agents}
+
+
+def _prefix_too_small(error: Exception) -> bool:
+    """Gemini's rejection of a prompt below the model's minimum cacheable size"""
+    if not isinstance(error, ClientError) or error.code != 400:
+        return False
+    message = (error.message or "").lower()
+    return "too small" in message or "min_total_token_count" in message or "minimum token count" in message
+
+
+def _create_lock(key: Tuple[str, str, str]) -> asyncio.Lock:
+    locks = _gemini_locks.setdefault(asyncio.get_running_loop(), {})
+    return locks.setdefault(key, asyncio.Lock())
+
+
+async def gemini_cached_content(client: Any, model_name: str, api_key: str, system_prompt: str, tools: List[Any]) -> Optional[str]:
+    """Return (creating if needed) a Gemini cached-content handle for the static system prompt.
+
+    Prompts below the model's minimum cacheable size are remembered as uncacheable and
+    sent inline instead, where Gemini's implicit prefix caching still applies. Any other
+    failure sends this prompt inline and tries the create again on the next call.
+    """
+    key = (_digest(api_key), model_name, _digest(system_prompt))
+    entry = _gemini_caches.get(key)
+    if entry and entry[1] > time.time():
+        return entry[0]
+
+    # Concurrent agents sharing the prompt wait for one create instead of each paying for their own
+    failures = _gemini_failures[key]
+    async with _create_lock(key):
+        entry = _gemini_caches.get(key)
+        now = time.time()
+        if entry and entry[1] > now:
+            return entry[0]
+        if _gemini_failures[key] != failures:
+            # The create this call waited on failed: go inline now, the next call tries again
+            return None
+        try:
+            cache = await client.aio.caches.create(
+                model=model_name,
+                config=CreateCachedContentConfig(
+                    system_instruction=system_prompt,
+                    tools=tools,
+                    ttl=f"{int(GEMINI_CONTEXT_CACHE_TTL_SECONDS)}s",
+                ),
+            )
+            name = cache.name
+            logger.info(f"Created Gemini context cache for {model_name}: {name}")
+        except Exception as e:
+            if not _prefix_too_small(e):
+                _gemini_failures[key] += 1
+                logger.warning(f"Gemini context cache creation failed for {model_name}, sending prompt inline: {e}")
+                return None
+            logger.info(f"System prompt too small for a Gemini context cache on {model_name}, sending it inline: {e}")
+            name = None
+        # Refresh slightly before the server-side cache expires
+        _gemini_caches[key] = (name, now + GEMINI_CONTEXT_CACHE_TTL_SECONDS * 0.9)
+        return name
@@ -0,0 +1,266 @@
+import asyncio
+import json
+import time
+import weakref
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import httpx
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatResult
+from loguru import logger
+
+from app.config import (
+    BATCH_FLUSH_SECONDS, BATCH_MAX_REQUESTS, BATCH_POLL_SECONDS, BATCH_SIMULATED_TURNAROUND_SECONDS
+)
+
+# (pooled model that builds the payload and parses the answer, messages, call kwargs)
+BatchItem = Tuple[Any, List[BaseMessage], Dict[str, Any]]
+BatchOutcome = Union[ChatResult, BaseException]
+
+_BATCH_DONE_STATES = {"completed", "failed", "expired", "cancelled"}
+
+
+class BatchRequestFailed(RuntimeError):
+    """One request inside a provider batch came back with an error"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class ProviderBatchClient(ABC):
+    """Submits a list of chat calls as one provider batch and waits for every answer"""
+
+    @abstractmethod
+    async def run(self, items: List[BatchItem]) -> List[BatchOutcome]:
+        ...
+
+
+def _secret(value: Any) -> str:
+    return value.get_secret_value() if hasattr(value, "get_secret_value") else str(value)
+
+
+class OpenAIBatchClient(ProviderBatchClient):
+    """OpenAI Batch API: JSONL upload, /v1/batches job, output file download"""
+
+    async def run(self, items: List[BatchItem]) -> List[BatchOutcome]:
+        model = items[0][0]
+        base_url = (model.openai_api_base or "https://api.openai.com/v1").rstrip("/")
+        headers = {"Authorization": f"Bearer {_secret(model.openai_api_key)}"}
+        lines = []
+        for i, (item_model, messages, kwargs) in enumerate(items):
+            body = item_model._get_request_payload(messages, **kwargs)
+            body.pop("stream", None)
+            lines.append(json.dumps({"custom_id": str(i), "method": "POST", "url": "/v1/chat/completions", "body": body}))
+
+        async with httpx.AsyncClient(timeout=httpx.Timeout(120.0, connect=10.0)) as client:
+            upload = await client.post(f"{base_url}/files", headers=headers, data={"purpose": "batch"},
+                                       files={"file": ("batch.jsonl", "\n".join(lines).encode("utf-8"), "application/jsonl")})
+            upload.raise_for_status()
+            created = await client.post(f"{base_url}/batches", headers=headers, json={
+                "input_file_id": upload.json()["id"], "endpoint": "/v1/chat/completions", "completion_window": "24h"
+            })
+            created.raise_for_status()
+            batch = created.json()
+            logger.info(f"Submitted OpenAI batch {batch['id']} with {len(items)} requests")
+            while batch["status"] not in _BATCH_DONE_STATES:
+                await asyncio.sleep(BATCH_POLL_SECONDS)
+                polled = await client.get(f"{base_url}/batches/{batch['id']}", headers=headers)
+                polled.raise_for_status()
+                batch = polled.json()
+
+            outcomes: List[BatchOutcome] = [BatchRequestFailed(f"OpenAI batch {batch['id']} ended as {batch['status']}", 503)] * len(items)
+            for file_key in ("output_file_id", "error_file_id"):
+                if not batch.get(file_key):
+                    continue
+                content = await client.get(f"{base_url}/files/{batch[file_key]}/content", headers=headers)
+                content.raise_for_status()
+                for line in filter(None, content.text.splitlines()):
+                    record = json.loads(line)
+                    i = int(record["custom_id"])
+                    response = record.get("response") or {}
+                    if response.get("status_code") == 200:
+                        outcomes[i] = items[i][0]._create_chat_result(response["body"])
+                    else:
+                        error = record.get("error") or response.get("body", {}).get("error") or {}
+                        outcomes[i] = BatchRequestFailed(f"OpenAI batch request failed: {error}", response.get("status_code"))
+        return outcomes
+
+
+class AnthropicBatchClient(ProviderBatchClient):
+    """Anthropic Message Batches API"""
+
+    API_URL = "https://api.anthropic.com/v1/messages/batches"
+
+    async def run(self, items: List[BatchItem]) -> List[BatchOutcome]:
+        from anthropic.types import Message
+
+        model = items[0][0]
+        headers = {"x-api-key": _secret(model.anthropic_api_key), "anthropic-version": "2023-06-01"}
+        requests = []
+        for i, (item_model, messages, kwargs) in enumerate(items):
+            params = item_model._get_request_payload(messages, **kwargs)
+            params.pop("stream", None)
+            requests.append({"custom_id": str(i), "params": params})
+
+        async with httpx.AsyncClient(timeout=httpx.Timeout(120.0, connect=10.0)) as client:
+            created = await client.post(self.API_URL, headers=headers, json={"requests": requests})
+            created.raise_for_status()
+            batch = created.json()
+            logger.info(f"Submitted Anthropic batch {batch['id']} with {len(items)} requests")
+            while batch["processing_status"] != "ended":
+                await asyncio.sleep(BATCH_POLL_SECONDS)
+                polled = await client.get(f"{self.API_URL}/{batch['id']}", headers=headers)
+                polled.raise_for_status()
+                batch = polled.json()
+
+            outcomes: List[BatchOutcome] = [BatchRequestFailed(f"Anthropic batch {batch['id']} returned no result", 503)] * len(items)
+            results = await client.get(batch["results_url"], headers=headers)
+            results.raise_for_status()
+            for line in filter(None, results.text.splitlines()):
+                record = json.loads(line)
+                i = int(record["custom_id"])
+                result = record["result"]
+                if result["type"] == "succeeded":
+                    outcomes[i] = items[i][0]._format_output(Message.model_validate(result["message"]))
+                else:
+                    # "errored" requests may be retried; "canceled"/"expired" mean the batch ran out of time
+                    outcomes[i] = BatchRequestFailed(f"Anthropic batch request {result['type']}: {result.get('error')}", 503)
+        return outcomes
+
+
+class SimulatedBatchClient(ProviderBatchClient):
+    """Local stand-in for a provider batch API: waits a turnaround time, then answers every request"""
+
+    def __init__(self, turnaround: float = BATCH_SIMULATED_TURNAROUND_SECONDS):
+        self.turnaround = turnaround
+        self.batches = 0
+        self.requests = 0
+
+    async def run(self, items: List[BatchItem]) -> List[BatchOutcome]:
+        self.batches += 1
+        self.requests += len(items)
+        await asyncio.sleep(self.turnaround)
+        return await asyncio.gather(*(model._agenerate(messages, **kwargs) for model, messages, kwargs in items), return_exceptions=True)
+
+
+# Providers with a batch API; calls to other providers run directly even in batch mode
+BATCH_CLIENTS: Dict[str, ProviderBatchClient] = {
+    "openai": OpenAIBatchClient(),
+    "anthropic": AnthropicBatchClient(),
+    "fake": SimulatedBatchClient(),
+}
+
+
+class BatchCollector:
+    """Groups concurrent calls to one provider model into batches flushed by size or age"""
+
+    def __init__(self, provider: str, client: ProviderBatchClient):
+        self.provider = provider
+        self.client = client
+        self._pending: List[Tuple[BatchItem, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()
+
+    def submit(self, item: BatchItem) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= BATCH_MAX_REQUESTS:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(BATCH_FLUSH_SECONDS, self.flush)
+        return future
+
+    def flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        # Calls abandoned while waiting (deadline, cancelled card) are not worth paying for
+        pending = [(item, future) for item, future in self._pending if not future.done()]
+        self._pending = []
+        if pending:
+            task = asyncio.ensure_future(self._run(pending))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, pending: List[Tuple[BatchItem, asyncio.Future]]) -> None:
+        started = time.perf_counter()
+        try:
+            outcomes = await self.client.run([item for item, _ in pending])
+        except Exception as e:
+            logger.error(f"{self.provider} batch of {len(pending)} requests failed: {e}")
+            outcomes = [e] * len(pending)
+        logger.info(f"{self.provider} batch of {len(pending)} requests finished in {time.perf_counter() - started:.1f}s")
+        for (_, future), outcome in zip(pending, outcomes):
+            if future.done():
+                continue
+            if isinstance(outcome, BaseException):
+                future.set_exception(outcome)
+            else:
+                future.set_result(outcome)
+
+
+# Futures and timers are bound to the loop that created them
+_collectors: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[str, str], BatchCollector]]" = weakref.WeakKeyDictionary()
+
+
+def _collector(provider: str, batch_key: str) -> BatchCollector:
+    loop = asyncio.get_running_loop()
+    collectors = _collectors.setdefault(loop, {})
+    collector = collectors.get((provider, batch_key))
+    if collector is None:
+        collector = collectors[(provider, batch_key)] = BatchCollector(provider, BATCH_CLIENTS[provider])
+    return collector
+
+
+def supports_batch(provider: str) -> bool:
+    return provider in BATCH_CLIENTS
+
+
+class BatchedChatModel(BaseChatModel):
+    """Routes a pooled chat model's calls through its provider's batch API"""
+
+    inner: Any
+    provider: str
+    # Requests in one batch share credentials and model
+    batch_key: str
+
+    @property
+    def _llm_type(self) -> str:
+        return f"batched-{self.provider}"
+
+    def bind_tools(self, tools: Any, *, tool_choice: Optional[Any] = None, **kwargs: Any) -> Any:
+        # Converted per request by the wrapped model, so payloads match its direct calls exactly
+        return self.bind(batch_tools=list(tools), batch_tool_choice=tool_choice, **kwargs)
+
+    def _call_kwargs(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        tools = kwargs.pop("batch_tools", None)
+        tool_choice = kwargs.pop("batch_tool_choice", None)
+        if tools:
+            kwargs = {**self.inner.bind_tools(tools, tool_choice=tool_choice).kwargs, **kwargs}
+        return kwargs
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        """Sync calls (e.g. from executor threads) go to the provider as a batch of their own"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            # Blocking here would stall the loop that must run the batch; the collector needs ainvoke
+            raise RuntimeError(f"{self._llm_type} models cannot be invoked synchronously from a running event loop; use ainvoke")
+        outcome = asyncio.run(BATCH_CLIENTS[self.provider].run([self._item(messages, stop, kwargs)]))[0]
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        return await _collector(self.provider, self.batch_key).submit(self._item(messages, stop, kwargs))
+
+    def _item(self, messages: List[BaseMessage], stop: Optional[List[str]], kwargs: Dict[str, Any]) -> BatchItem:
+        call_kwargs = self._call_kwargs(kwargs)
+        if stop:
+            call_kwargs["stop"] = stop
+        return self.inner, messages, call_kwargs
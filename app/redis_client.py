@@ -0,0 +1,33 @@
+import asyncio
+import weakref
+from typing import Any
+
+from app.config import REDIS_KEY_PREFIX, REDIS_URL
+
+# Connections are bound to the loop that opened them (Streamlit runs each analysis on a fresh loop)
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Any]" = weakref.WeakKeyDictionary()
+
+
+def get_redis() -> Any:
+    """Client for the shared Redis-protocol server at REDIS_URL, one per running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError as e:
+            raise RuntimeError("Redis backends require the redis package (pip install redis)") from e
+        client = _clients[loop] = redis_asyncio.from_url(REDIS_URL, decode_responses=True)
+    return client
+
+
+def redis_key(*parts: str) -> str:
+    """Namespaced key, so several deployments can share one server"""
+    return REDIS_KEY_PREFIX + ":".join(parts)
+
+
+async def close_redis() -> None:
+    """Close the running loop's client and its pooled connections"""
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
@@ -0,0 +1,63 @@
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+from loguru import logger
+
+from app.models import Card, Fight
+
+# Fixed field order keeps rendered prompts byte-stable (and therefore cacheable)
+FIGHT_FIELDS = (
+    "fight_id", "fighter1", "fighter1_record", "fighter2", "fighter2_record",
+    "weight_class", "date", "location", "additional_info",
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (~4 characters per token for English prose)"""
+    return (len(text) + 3) // 4
+
+
+def render_fight(fight: Fight) -> str:
+    """Render only the fight fields as compact 'field: value' lines"""
+    lines = []
+    for field in FIGHT_FIELDS:
+        value = getattr(fight, field)
+        if value is None:
+            continue
+        value = " ".join(str(value).split())
+        if value:
+            lines.append(f"{field}: {value}")
+    return "\n".join(lines)
+
+
+def render_card(card: Union[Card, Iterable[Fight]], fight_ids: Optional[Iterable[str]] = None) -> str:
+    """Render a card's fights for an agent prompt, optionally restricted to some fight_ids.
+
+    Request settings (models, custom prompts, sampling params, API keys) are never included.
+    """
+    fights: List[Fight] = list(card.fights if isinstance(card, Card) else card)
+    if fight_ids is not None:
+        wanted = set(fight_ids)
+        fights = [fight for fight in fights if fight.fight_id in wanted]
+    return "\n\n".join(f"[Fight {i}]\n{render_fight(fight)}" for i, fight in enumerate(fights, 1))
+
+
+def prompt_size_report(card: Card) -> Dict[str, Any]:
+    """Compare the legacy pydantic repr of the card with the compact rendering"""
+    legacy = str(card)
+    compact = render_card(card)
+    legacy_tokens, compact_tokens = estimate_tokens(legacy), estimate_tokens(compact)
+    return {
+        "legacy_chars": len(legacy),
+        "compact_chars": len(compact),
+        "legacy_tokens_est": legacy_tokens,
+        "compact_tokens_est": compact_tokens,
+        "reduction": round(1 - compact_tokens / legacy_tokens, 4) if legacy_tokens else 0.0,
+    }
+
+
+def log_prompt_size(card: Card) -> None:
+    report = prompt_size_report(card)
+    logger.info(
+        f"Card prompt size: ~{report['legacy_tokens_est']} -> ~{report['compact_tokens_est']} tokens "
+        f"per agent ({report['reduction']:.0%} smaller than the pydantic repr)"
+    )
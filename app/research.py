@@ -0,0 +1,86 @@
+import asyncio
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+
+from app.config import RESEARCH_MAX_SNIPPET_CHARS, RESEARCH_MAX_SNIPPETS_PER_FIGHT
+from app.models import Card, Fight
+from app.search import get_search_client, normalize_query, search_budget
+
+
+def research_queries(fight: Fight) -> List[str]:
+    """Deterministic search queries covering what the analyst agents look up for a fight"""
+    matchup = f"{fight.fighter1} vs {fight.fighter2}"
+    queries = [
+        f"{matchup} UFC {fight.weight_class} preview breakdown",
+        f"{matchup} odds line movement",
+        f"{fight.fighter1} UFC injury weigh-in training camp news",
+        f"{fight.fighter2} UFC injury weigh-in training camp news",
+        f"{fight.fighter1} UFC fight stats recent performance",
+        f"{fight.fighter2} UFC fight stats recent performance",
+    ]
+    # Drop duplicates (e.g. fighters sharing a name fragment) while keeping order
+    return list(dict.fromkeys(queries))
+
+
+def compact_results(results: List[Dict[str, Any]], max_snippets: int = RESEARCH_MAX_SNIPPETS_PER_FIGHT) -> List[str]:
+    """Deduplicate results by link and snippet text and trim them to short lines"""
+    seen_links, seen_snippets, lines = set(), set(), []
+    for result in results:
+        link = result.get("link", "")
+        snippet = " ".join(result.get("snippet", "").split())
+        if not snippet or link in seen_links or normalize_query(snippet) in seen_snippets:
+            continue
+        seen_links.add(link)
+        seen_snippets.add(normalize_query(snippet))
+        if len(snippet) > RESEARCH_MAX_SNIPPET_CHARS:
+            snippet = snippet[:RESEARCH_MAX_SNIPPET_CHARS].rsplit(" ", 1)[0] + "..."
+        lines.append(f"- {result.get('title', '').strip()}: {snippet} ({link})")
+        if len(lines) >= max_snippets:
+            break
+    return lines
+
+
+async def _search(query: str) -> List[Dict[str, Any]]:
+    try:
+        return await get_search_client().search(query)
+    except Exception as e:
+        logger.warning(f"Research query failed ({query}): {e}")
+        return []
+
+
+async def prefetch_fight_research(fight: Fight) -> List[str]:
+    """Run every research query for a fight concurrently and compact the snippets"""
+    batches = await asyncio.gather(*(_search(query) for query in research_queries(fight)))
+    return compact_results([result for batch in batches for result in batch])
+
+
+def _section_header(fight: Fight) -> str:
+    return f"Fight {fight.fight_id} ({fight.fighter1} vs {fight.fighter2}):"
+
+
+def research_gaps(card: Card, research_context: Optional[str]) -> List[Fight]:
+    """Fights the prefetched research has nothing on"""
+    return [fight for fight in card.fights if not research_context or _section_header(fight) not in research_context]
+
+
+async def prefetch_research(card: Card) -> Optional[str]:
+    """Build the shared research context injected into every analyst prompt"""
+    queries = sum(len(research_queries(fight)) for fight in card.fights)
+    logger.info(f"Prefetching research for {len(card.fights)} fights ({queries} queries)")
+    # The prefetch is bounded by the card's size; the request budget is left for the agents' own searches
+    with search_budget(queries):
+        per_fight = await asyncio.gather(*(prefetch_fight_research(fight) for fight in card.fights))
+    sections = [
+        f"{_section_header(fight)}\n" + "\n".join(lines)
+        for fight, lines in zip(card.fights, per_fight) if lines
+    ]
+    logger.info(f"Research prefetch collected {sum(len(lines) for lines in per_fight)} snippets")
+    if not sections:
+        return None
+    missing = [fight for fight, lines in zip(card.fights, per_fight) if not lines]
+    if missing:
+        names = ", ".join(f"{fight.fighter1} vs {fight.fighter2}" for fight in missing)
+        logger.warning(f"Research prefetch found nothing for {len(missing)} fights ({names}); analysts may search for them")
+        sections.append(f"No research was found for: {names}. Search for these fights if you have a search tool.")
+    return "\n\n".join(sections)
@@ -0,0 +1,287 @@
+import asyncio
+import math
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple, TypeVar
+
+import httpx
+from loguru import logger
+
+from app.config import (
+    BATCH_AGENT_TIMEOUT_SECONDS, BREAKER_COOLDOWN_SECONDS, BREAKER_ERROR_RATE, BREAKER_MIN_CALLS, BREAKER_SLOW_CALL_RATE,
+    BREAKER_SLOW_CALL_SECONDS, BREAKER_WINDOW_SECONDS,
+    HEDGE_DEFAULT_DELAY_SECONDS, HEDGE_LATENCY_PERCENTILE, HEDGE_MIN_SAMPLES,
+    RETRY_BASE_DELAY_SECONDS, RETRY_MAX_DELAY_SECONDS,
+    batch_mode_enabled, get_fallback_models_for_agent, get_hedge_model_for_agent, get_max_attempts_for_agent,
+    get_timeout_for_agent
+)
+from app.llm_providers import provider_for_model
+from app.metrics import CIRCUIT_STATE, current_call, metrics_lock
+
+T = TypeVar("T")
+
+# Rate limits, timeouts, conflicts and server-side failures are worth another try
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+_RETRYABLE_ERROR_NAMES = ("RateLimit", "Timeout", "Connection", "Overloaded", "ServiceUnavailable", "InternalServer", "ServerError")
+
+# Recent successful call latencies per agent, used to pick the hedge delay
+_latencies: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=200))
+
+
+class AgentFailed(Exception):
+    """An agent produced no usable output after its retries, hedges and deadline"""
+
+    def __init__(self, agent_type: str, reason: str):
+        super().__init__(f"{agent_type} agent failed: {reason}")
+        self.agent_type = agent_type
+        self.reason = reason
+
+
+class ProviderUnavailable(Exception):
+    """The provider's circuit breaker is open"""
+
+
+class ProviderNotConfigured(ValueError):
+    """No API key or client for the model's provider; the next model in the chain may still have one"""
+
+
+class CircuitBreaker:
+    """Per-provider breaker: closed -> open on high error/slow-call rate -> half-open probe -> closed"""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        # (timestamp, failed, slow) per finished call within the rolling window
+        self._calls: Deque[Tuple[float, bool, bool]] = deque()
+        # Streamlit runs analyses on separate threads
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            logger.warning(f"Circuit for {self.provider} {self.state} -> {state}")
+        self.state = state
+        with metrics_lock:
+            CIRCUIT_STATE.set({self.CLOSED: 0, self.HALF_OPEN: 1, self.OPEN: 2}[state], provider=self.provider)
+
+    def allow(self) -> bool:
+        """Whether a call may go to the provider now (in half-open state, only one probe at a time)"""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= BREAKER_COOLDOWN_SECONDS:
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            return False
+
+    def record(self, failed: bool, latency: float) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                self.probe_in_flight = False
+                if failed:
+                    self.opened_at = now
+                    self._set_state(self.OPEN)
+                else:
+                    self._calls.clear()
+                    self._set_state(self.CLOSED)
+                return
+
+            self._calls.append((now, failed, latency >= BREAKER_SLOW_CALL_SECONDS))
+            while self._calls and self._calls[0][0] < now - BREAKER_WINDOW_SECONDS:
+                self._calls.popleft()
+            total = len(self._calls)
+            if self.state != self.CLOSED or total < BREAKER_MIN_CALLS:
+                return
+            failures = sum(1 for _, f, _ in self._calls if f)
+            slow = sum(1 for _, _, s in self._calls if s)
+            if failures / total >= BREAKER_ERROR_RATE or slow / total >= BREAKER_SLOW_CALL_RATE:
+                logger.warning(f"Tripping {self.provider} circuit: {failures}/{total} failed, {slow}/{total} slow in {BREAKER_WINDOW_SECONDS:g}s")
+                self.opened_at = now
+                self._set_state(self.OPEN)
+
+    def release_probe(self) -> None:
+        """Give up a half-open probe that ended without an outcome (cancelled)"""
+        with self._lock:
+            self.probe_in_flight = False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            failures = sum(1 for _, f, _ in self._calls if f)
+            return {"state": self.state, "recent_calls": len(self._calls), "recent_failures": failures}
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def circuit_breaker(provider: str) -> CircuitBreaker:
+    with _breakers_lock:
+        breaker = _breakers.get(provider)
+        if breaker is None:
+            breaker = _breakers[provider] = CircuitBreaker(provider)
+        return breaker
+
+
+def breaker_stats() -> Dict[str, Dict[str, Any]]:
+    return {provider: breaker.stats() for provider, breaker in list(_breakers.items())}
+
+
+def model_chain(agent_type: str, model_name: str) -> List[str]:
+    """The agent's primary model followed by its configured fallbacks, without duplicates"""
+    chain = [model_name]
+    for fallback in get_fallback_models_for_agent(agent_type):
+        if fallback not in chain:
+            chain.append(fallback)
+    return chain
+
+
+def _status_code(error: BaseException) -> Optional[int]:
+    for candidate in (getattr(error, "status_code", None), getattr(error, "code", None),
+                      getattr(getattr(error, "response", None), "status_code", None)):
+        if isinstance(candidate, int):
+            return candidate
+    return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether a provider error is transient (rate limit, timeout, connection or 5xx)"""
+    if isinstance(error, (asyncio.TimeoutError, httpx.TransportError, ConnectionError)):
+        return True
+    status = _status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    return any(name in type(error).__name__ for name in _RETRYABLE_ERROR_NAMES)
+
+
+def backoff_delay(retry: int) -> float:
+    """Exponential backoff with full jitter for the given retry number (0-based)"""
+    return random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** retry))
+
+
+def hedge_delay(agent_type: str) -> float:
+    """Seconds to wait on the primary call before racing the hedge model"""
+    samples = sorted(_latencies[agent_type])
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY_SECONDS
+    rank = max(1, math.ceil(HEDGE_LATENCY_PERCENTILE / 100 * len(samples)))
+    return samples[rank - 1]
+
+
+async def _observed(agent_type: str, model_name: str, attempt: Callable[[str], Awaitable[T]]) -> T:
+    """Run one attempt on a model through its provider's circuit breaker, recording the outcome"""
+    breaker = circuit_breaker(provider_for_model(model_name))
+    if not breaker.allow():
+        raise ProviderUnavailable(f"{breaker.provider} circuit is open")
+    started = time.perf_counter()
+    try:
+        result = await attempt(model_name)
+    except asyncio.CancelledError:
+        breaker.release_probe()
+        raise
+    except Exception as e:
+        # Bad requests and missing keys say nothing about the provider's health
+        if is_retryable(e):
+            breaker.record(True, 0.0 if batch_mode_enabled() else time.perf_counter() - started)
+        else:
+            breaker.release_probe()
+        raise
+    if batch_mode_enabled():
+        # Batch turnaround says nothing about interactive latency
+        breaker.record(False, 0.0)
+        return result
+    latency = time.perf_counter() - started
+    breaker.record(False, latency)
+    _latencies[agent_type].append(latency)
+    return result
+
+
+async def _hedged(agent_type: str, model_name: str, attempt: Callable[[str], Awaitable[T]], hedge: bool = True) -> Tuple[str, T]:
+    """Run one attempt, racing the agent's hedge model if the primary is slower than usual; returns the answering model too"""
+    hedge_model = get_hedge_model_for_agent(agent_type) if hedge else None
+    primary = asyncio.ensure_future(_observed(agent_type, model_name, attempt))
+    models = {primary: model_name}
+    try:
+        if not hedge_model or hedge_model == model_name or batch_mode_enabled():
+            return model_name, await primary
+        delay = hedge_delay(agent_type)
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return model_name, primary.result()
+
+        logger.info(f"Hedging {agent_type}: {model_name} slower than {delay:.1f}s, racing {hedge_model}")
+        models[asyncio.ensure_future(_observed(agent_type, hedge_model, attempt))] = hedge_model
+        pending = set(models)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return models[task], task.result()
+                error = task.exception()
+        raise error
+    finally:
+        # First good answer wins; stop paying for the other call
+        for task in models:
+            if not task.done():
+                task.cancel()
+
+
+async def _with_retries(agent_type: str, model_name: str, attempt: Callable[[str], Awaitable[T]], hedge: bool = True) -> Tuple[str, T]:
+    max_attempts = get_max_attempts_for_agent(agent_type)
+    attempts = 0
+    while True:
+        try:
+            return await _hedged(agent_type, model_name, attempt, hedge)
+        except ProviderUnavailable:
+            raise
+        except Exception as e:
+            attempts += 1
+            if attempts >= max_attempts or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempts - 1)
+            logger.warning(f"{agent_type} attempt {attempts}/{max_attempts} on {model_name} failed ({type(e).__name__}: {e}); retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def call_with_resilience(agent_type: str, model_name: str, attempt: Callable[[str], Awaitable[T]], failover: bool = True) -> T:
+    """Call attempt(model) with retries on transient errors, optional hedging, per-provider circuit breakers
+    and the agent's deadline. With `failover`, the agent's fallback models take over once a model is
+    unavailable, has no provider key, or keeps failing transiently; other errors are final. The answering model is noted on
+    the current agent call.
+
+    Raises AgentFailed when no model succeeds in time.
+    """
+    deadline = BATCH_AGENT_TIMEOUT_SECONDS if batch_mode_enabled() else get_timeout_for_agent(agent_type)
+
+    async def run() -> T:
+        errors = []
+        for candidate in model_chain(agent_type, model_name) if failover else [model_name]:
+            try:
+                answered_by, result = await _with_retries(agent_type, candidate, attempt, hedge=failover)
+            except Exception as e:
+                errors.append(f"{candidate}: {type(e).__name__}: {e}")
+                # A bad request would fail the same way elsewhere, or get answered by a model nobody asked for
+                if not isinstance(e, (ProviderUnavailable, ProviderNotConfigured)) and not is_retryable(e):
+                    raise AgentFailed(agent_type, "; ".join(errors))
+                logger.warning(f"{agent_type} failing over from {candidate} ({type(e).__name__}: {e})")
+                continue
+            if answered_by != model_name:
+                logger.info(f"{agent_type} answered by {answered_by} instead of {model_name}")
+            recorder = current_call()
+            if recorder is not None:
+                recorder.answered_by = answered_by
+            return result
+        raise AgentFailed(agent_type, "; ".join(errors))
+
+    try:
+        return await asyncio.wait_for(run(), timeout=deadline)
+    except asyncio.TimeoutError:
+        raise AgentFailed(agent_type, f"deadline of {deadline:g}s exceeded")
@@ -0,0 +1,422 @@
+import asyncio
+import contextvars
+import math
+import random
+import time
+import weakref
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Iterator, Optional, Set
+from uuid import uuid4
+
+from loguru import logger
+
+from app.config import (
+    AGENT_EXPECTED_OUTPUT_TOKENS, MAX_ACTIVE_CARDS, MAX_QUEUED_CARDS,
+    PROVIDER_MAX_CONCURRENCY, PROVIDER_TOKENS_PER_MINUTE, RATE_LIMIT_BACKEND, RATE_LIMIT_LEASE_SECONDS
+)
+from app.metrics import (
+    ADMISSION_ACTIVE, ADMISSION_QUEUED, ADMISSION_REJECTED,
+    PROVIDER_IN_FLIGHT, PROVIDER_QUEUED, PROVIDER_WAIT, metrics_lock
+)
+from app.redis_client import get_redis, redis_key
+from app.rendering import estimate_tokens
+
+# Initial guess of card duration used for Retry-After until real cards have completed
+DEFAULT_CARD_SECONDS = 30.0
+
+# Requests competing for provider slots; freed slots rotate between them
+_owner: contextvars.ContextVar[str] = contextvars.ContextVar("scheduler_owner", default="default")
+
+
+class AdmissionRejected(Exception):
+    """The admission queue is full; retry after the given number of seconds"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Server is at capacity, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class FairLimiter:
+    """Concurrency limiter that hands freed slots to waiting owners round-robin"""
+
+    def __init__(self, capacity: int, max_waiting: Optional[int] = None, on_change: Optional[Callable[[], None]] = None):
+        self.capacity = capacity
+        self.max_waiting = max_waiting
+        self.in_use = 0
+        self._waiters: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self._on_change = on_change
+
+    def _changed(self) -> None:
+        if self._on_change is not None:
+            self._on_change()
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self._waiters.values())
+
+    @property
+    def waiting_owners(self) -> int:
+        return len(self._waiters)
+
+    def is_full(self) -> bool:
+        """True when a new acquire would be rejected"""
+        if self.capacity <= 0 or self.in_use < self.capacity:
+            return False
+        return self.max_waiting is not None and self.waiting >= self.max_waiting
+
+    async def acquire(self, owner: str) -> None:
+        if self.capacity <= 0 or (self.in_use < self.capacity and not self._waiters):
+            self.in_use += 1
+            self._changed()
+            return
+        if self.max_waiting is not None and self.waiting >= self.max_waiting:
+            raise asyncio.QueueFull()
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(owner, deque()).append(future)
+        self._changed()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as we were cancelled
+                self.release()
+            else:
+                queue = self._waiters.get(owner)
+                if queue is not None and future in queue:
+                    queue.remove(future)
+                    if not queue:
+                        del self._waiters[owner]
+                self._changed()
+            raise
+
+    def release(self) -> None:
+        while self._waiters:
+            owner, queue = next(iter(self._waiters.items()))
+            future = queue.popleft()
+            if queue:
+                # Owner goes to the back of the rotation
+                self._waiters.move_to_end(owner)
+            else:
+                del self._waiters[owner]
+            if not future.done():
+                # Hand the slot over directly; in_use is unchanged
+                future.set_result(None)
+                self._changed()
+                return
+        self.in_use -= 1
+        self._changed()
+
+
+class TokenBucket:
+    """Tokens-per-minute budget refilled continuously; settling actual usage may leave it in debt"""
+
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = float(tokens_per_minute)
+        self.rate = tokens_per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def consume(self, tokens: float) -> None:
+        # One oversized call must not wait forever
+        tokens = min(tokens, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.level >= tokens:
+                    self.level -= tokens
+                    return
+                await asyncio.sleep((tokens - self.level) / self.rate)
+
+    def adjust(self, tokens: float) -> None:
+        self._refill()
+        self.level = min(self.capacity, self.level - tokens)
+
+
+class SharedTokenBucket:
+    """Tokens-per-minute budget kept on the shared Redis server and drawn down by every replica"""
+
+    def __init__(self, provider: str, tokens_per_minute: int):
+        self.provider = provider
+        self.capacity = float(tokens_per_minute)
+        self.rate = tokens_per_minute / 60.0
+        self.key = redis_key("ratelimit", provider, "tokens")
+        # Last level seen on the server, for stats
+        self.level = self.capacity
+        self._adjustments: Set[asyncio.Task] = set()
+
+    async def _update(self, tokens: float, wait_for_tokens: bool) -> float:
+        """Refill the bucket and take `tokens` (only once they are there, with `wait_for_tokens`); returns the seconds still to wait"""
+
+        async def update(pipe: Any) -> float:
+            state = await pipe.hgetall(self.key)
+            now = time.time()
+            level = float(state.get("level", self.capacity))
+            level = min(self.capacity, level + (now - float(state.get("updated", now))) * self.rate)
+            wait = (tokens - level) / self.rate if wait_for_tokens and level < tokens else 0.0
+            if not wait:
+                level = min(self.capacity, level - tokens)
+            pipe.multi()
+            pipe.hset(self.key, mapping={"level": level, "updated": now})
+            # A missing bucket reads as full, so it can go once it would have refilled
+            pipe.expire(self.key, math.ceil((self.capacity - level) / self.rate) + 1)
+            self.level = level
+            return wait
+
+        return await get_redis().transaction(update, self.key, value_from_callable=True)
+
+    async def consume(self, tokens: float) -> None:
+        tokens = min(tokens, self.capacity)
+        while True:
+            try:
+                wait = await self._update(tokens, True)
+            except Exception as e:
+                logger.warning(f"Shared {self.provider} token budget unavailable ({e}); not waiting for it")
+                return
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def adjust(self, tokens: float) -> None:
+        task = asyncio.ensure_future(self._adjust(tokens))
+        self._adjustments.add(task)
+        task.add_done_callback(self._adjustments.discard)
+
+    async def _adjust(self, tokens: float) -> None:
+        try:
+            await self._update(tokens, False)
+        except Exception as e:
+            logger.warning(f"Failed to settle shared {self.provider} token budget: {e}")
+
+
+class SharedSlots:
+    """Concurrency ceiling across replicas: holders are members of a Redis sorted set scored by lease expiry"""
+
+    def __init__(self, provider: str, capacity: int, lease: float = RATE_LIMIT_LEASE_SECONDS):
+        self.provider = provider
+        self.capacity = capacity
+        self.lease = lease
+        self.key = redis_key("ratelimit", provider, "slots")
+
+    async def _try_acquire(self, token: str) -> bool:
+        async def update(pipe: Any) -> bool:
+            now = time.time()
+            if await pipe.zcount(self.key, now, "+inf") >= self.capacity:
+                return False
+            pipe.multi()
+            # Slots of replicas that died without releasing them expire with their lease
+            pipe.zremrangebyscore(self.key, "-inf", now)
+            pipe.zadd(self.key, {token: now + self.lease})
+            return True
+
+        return await get_redis().transaction(update, self.key, value_from_callable=True)
+
+    async def _renew(self, token: str) -> None:
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await get_redis().zadd(self.key, {token: time.time() + self.lease}, xx=True)
+            except Exception as e:
+                logger.warning(f"Failed to renew shared {self.provider} slot: {e}")
+
+    @asynccontextmanager
+    async def hold(self) -> AsyncIterator[None]:
+        """Hold one slot, polling with backoff while every replica's slots are taken"""
+        token = uuid4().hex
+        delay = 0.05
+        try:
+            while not await self._try_acquire(token):
+                await asyncio.sleep(random.uniform(delay / 2, delay))
+                delay = min(delay * 2, 1.0)
+        except Exception as e:
+            # The local ceiling still applies; an unreachable server must not stop every call
+            logger.warning(f"Shared {self.provider} slots unavailable ({e}); using the local limit only")
+            token = None
+        renewal = asyncio.ensure_future(self._renew(token)) if token else None
+        try:
+            yield
+        finally:
+            if renewal is not None:
+                renewal.cancel()
+                try:
+                    await get_redis().zrem(self.key, token)
+                except Exception as e:
+                    logger.warning(f"Failed to release shared {self.provider} slot, it expires with its lease: {e}")
+
+
+class ProviderSlot:
+    """A reserved provider slot; settle() corrects the token reservation with reported usage"""
+
+    def __init__(self, limiter: "ProviderLimiter", reserved: int):
+        self.limiter = limiter
+        self.reserved = reserved
+
+    def settle(self, used_tokens: int) -> None:
+        if self.limiter.tokens is not None and used_tokens:
+            self.limiter.tokens.adjust(used_tokens - self.reserved)
+            self.reserved = used_tokens
+
+
+class ProviderLimiter:
+    """Concurrency and tokens-per-minute ceilings for one provider"""
+
+    def __init__(self, provider: str, max_concurrency: int, tokens_per_minute: int, shared: bool = False):
+        self.provider = provider
+        self.slots = FairLimiter(max_concurrency, on_change=self._publish)
+        # Shared limits hold across replicas; the local limiter still keeps each replica fair between its requests
+        self.shared_slots = SharedSlots(provider, max_concurrency) if shared and max_concurrency > 0 else None
+        self.tokens: Any = None
+        if tokens_per_minute > 0:
+            self.tokens = SharedTokenBucket(provider, tokens_per_minute) if shared else TokenBucket(tokens_per_minute)
+        self.waiting_for_tokens = 0
+
+    def _publish(self) -> None:
+        with metrics_lock:
+            PROVIDER_IN_FLIGHT.set(self.slots.in_use, provider=self.provider)
+            PROVIDER_QUEUED.set(self.slots.waiting + self.waiting_for_tokens, provider=self.provider)
+
+    @asynccontextmanager
+    async def reserve(self, estimated_tokens: int) -> AsyncIterator[ProviderSlot]:
+        started = time.perf_counter()
+        await self.slots.acquire(_owner.get())
+        try:
+            async with (self.shared_slots.hold() if self.shared_slots is not None else nullcontext()):
+                if self.tokens is not None:
+                    self.waiting_for_tokens += 1
+                    self._publish()
+                    try:
+                        await self.tokens.consume(estimated_tokens)
+                    finally:
+                        self.waiting_for_tokens -= 1
+                        self._publish()
+                waited = time.perf_counter() - started
+                with metrics_lock:
+                    PROVIDER_WAIT.observe(waited, provider=self.provider)
+                if waited > 1:
+                    logger.info(f"Waited {waited:.1f}s for {self.provider} capacity")
+                yield ProviderSlot(self, estimated_tokens)
+        finally:
+            self.slots.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.slots.capacity or None,
+            "in_flight": self.slots.in_use,
+            "queued": self.slots.waiting,
+            "queued_requests": self.slots.waiting_owners,
+            "waiting_for_tokens": self.waiting_for_tokens,
+            "tokens_per_minute": int(self.tokens.capacity) if self.tokens else None,
+            "tokens_available": int(self.tokens.level) if self.tokens else None,
+            "shared": self.shared_slots is not None or isinstance(self.tokens, SharedTokenBucket),
+        }
+
+
+class Scheduler:
+    """Card admission plus per-provider limits shared by every request on an event loop"""
+
+    def __init__(self):
+        self.admission = FairLimiter(MAX_ACTIVE_CARDS, MAX_QUEUED_CARDS, on_change=self._publish)
+        self.providers: Dict[str, ProviderLimiter] = {}
+        self.card_seconds = DEFAULT_CARD_SECONDS
+
+    def provider(self, name: str) -> ProviderLimiter:
+        limiter = self.providers.get(name)
+        if limiter is None:
+            limiter = ProviderLimiter(
+                name, PROVIDER_MAX_CONCURRENCY.get(name, 0), PROVIDER_TOKENS_PER_MINUTE.get(name, 0),
+                shared=RATE_LIMIT_BACKEND == "redis",
+            )
+            self.providers[name] = limiter
+        return limiter
+
+    def retry_after(self) -> int:
+        """Seconds until the current queue has likely drained by one slot"""
+        slots = max(self.admission.capacity, 1)
+        estimate = self.card_seconds * (self.admission.waiting + 1) / slots
+        return int(min(max(math.ceil(estimate), 1), 300))
+
+    def _publish(self) -> None:
+        with metrics_lock:
+            ADMISSION_ACTIVE.set(self.admission.in_use)
+            ADMISSION_QUEUED.set(self.admission.waiting)
+
+    def check_admission(self) -> None:
+        """Raise AdmissionRejected without queueing if a new card would be turned away"""
+        if self.admission.is_full():
+            with metrics_lock:
+                ADMISSION_REJECTED.inc()
+            raise AdmissionRejected(self.retry_after())
+
+    @asynccontextmanager
+    async def admit(self) -> AsyncIterator[None]:
+        """Hold one active-card slot, waiting in the bounded admission queue if necessary"""
+        try:
+            # Each card queues as its own owner, so admission is first come, first served
+            await self.admission.acquire(uuid4().hex)
+        except asyncio.QueueFull:
+            with metrics_lock:
+                ADMISSION_REJECTED.inc()
+            raise AdmissionRejected(self.retry_after())
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            # Smoothed card duration drives Retry-After
+            self.card_seconds = 0.8 * self.card_seconds + 0.2 * (time.perf_counter() - started)
+            self.admission.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "admission": {
+                "max_active": self.admission.capacity,
+                "max_queued": self.admission.max_waiting,
+                "active": self.admission.in_use,
+                "queued": self.admission.waiting,
+                "retry_after": self.retry_after(),
+            },
+            "providers": {name: limiter.stats() for name, limiter in self.providers.items()},
+        }
+
+
+# Futures and locks are bound to the loop that created them (Streamlit uses a fresh loop per run)
+_schedulers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Scheduler]" = weakref.WeakKeyDictionary()
+
+
+def get_scheduler() -> Scheduler:
+    """Scheduler for the running event loop"""
+    loop = asyncio.get_running_loop()
+    scheduler = _schedulers.get(loop)
+    if scheduler is None:
+        scheduler = Scheduler()
+        _schedulers[loop] = scheduler
+    return scheduler
+
+
+@contextmanager
+def scheduling_owner(owner: Optional[str] = None) -> Iterator[str]:
+    """Attribute provider calls made in this context to one request for fair queueing"""
+    owner = owner or uuid4().hex
+    token = _owner.set(owner)
+    try:
+        yield owner
+    finally:
+        _owner.reset(token)
+
+
+def estimate_call_tokens(prompt: str) -> int:
+    """Tokens reserved for one agent call: prompt estimate plus the expected output"""
+    return estimate_tokens(prompt) + AGENT_EXPECTED_OUTPUT_TOKENS
+
+
+@asynccontextmanager
+async def provider_slot(provider: str, estimated_tokens: int = 0) -> AsyncIterator[ProviderSlot]:
+    """Wait for a concurrency slot and token budget on the provider, released on exit"""
+    async with get_scheduler().provider(provider).reserve(estimated_tokens) as slot:
+        yield slot
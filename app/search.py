@@ -0,0 +1,166 @@
+import asyncio
+import contextvars
+import hashlib
+import json
+import weakref
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+import httpx
+from loguru import logger
+
+from app.cache import MemoryCache, RedisCache
+from app.scheduler import provider_slot
+from app.config import (
+    CACHE_BACKEND, SERPER_CACHE_MAX_ENTRIES, SERPER_CACHE_TTL_SECONDS, SERPER_MAX_CONNECTIONS,
+    SERPER_MAX_QUERIES_PER_REQUEST, SERPER_TIMEOUT_SECONDS, get_api_key
+)
+
+SERPER_URL = "https://google.serper.dev/search"
+
+
+class SearchBudgetExceeded(Exception):
+    """Raised when a request has used up its Serper query budget"""
+
+
+class _LeaderCancelled(Exception):
+    """The request fetching a coalesced query was cancelled; a waiting request takes the fetch over"""
+
+
+class _Budget:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+
+
+# Per-request query budget; shared by every agent task spawned for the request
+_budget: contextvars.ContextVar[Optional[_Budget]] = contextvars.ContextVar("serper_budget", default=None)
+
+# (API key digest, normalized query) -> organic results, shared across requests and event loops (and replicas, with the redis cache)
+_results_cache = (
+    RedisCache("serper", ttl=SERPER_CACHE_TTL_SECONDS) if CACHE_BACKEND == "redis"
+    else MemoryCache(max_entries=SERPER_CACHE_MAX_ENTRIES, ttl=SERPER_CACHE_TTL_SECONDS)
+)
+
+
+@contextmanager
+def search_budget(limit: int = SERPER_MAX_QUERIES_PER_REQUEST) -> Iterator[None]:
+    """Cap the number of Serper calls made within this context (one card request)"""
+    token = _budget.set(_Budget(limit))
+    try:
+        yield
+    finally:
+        _budget.reset(token)
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def format_results(results: List[Dict[str, Any]]) -> str:
+    formatted_results = []
+    for i, result in enumerate(results, 1):
+        title = result.get("title", "")
+        link = result.get("link", "")
+        snippet = result.get("snippet", "")
+        formatted_results.append(f"{i}. {title} - {snippet}\n   {link}")
+    return "\n\n".join(formatted_results) if formatted_results else "No results found"
+
+
+class SerperClient:
+    """Async Serper client with pooled connections, timeouts, coalescing and a TTL cache"""
+
+    def __init__(self):
+        self._http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=SERPER_MAX_CONNECTIONS, max_keepalive_connections=SERPER_MAX_CONNECTIONS),
+            timeout=httpx.Timeout(SERPER_TIMEOUT_SECONDS),
+        )
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    async def _fetch(self, query: str, num: int, api_key: Optional[str]) -> List[Dict[str, Any]]:
+        if not api_key:
+            raise ValueError("Serper API key not configured")
+        # Serper's per-minute budget counts queries rather than tokens
+        async with provider_slot("serper", 1):
+            response = await self._http.post(
+                SERPER_URL,
+                content=json.dumps({"q": query, "num": num}),
+                headers={"X-API-KEY": api_key, "Content-Type": "application/json"},
+            )
+        response.raise_for_status()
+        return response.json().get("organic", [])
+
+    async def search(self, query: str, num: int = 5) -> List[Dict[str, Any]]:
+        """Return organic results, sharing cached and in-flight lookups of the same query made with the same API key"""
+        api_key = get_api_key("serper")
+        # Results bought with one tenant's key are not handed to another tenant for free
+        key_digest = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16] if api_key else "none"
+        key = f"{key_digest}:{num}:{normalize_query(query)}"
+        try:
+            cached = await _results_cache.get(key)
+        except Exception as e:
+            logger.warning(f"Serper cache lookup failed: {e}")
+            cached = None
+        if cached is not None:
+            logger.info(f"Serper cache hit for: {query}")
+            return json.loads(cached)
+
+        while (in_flight := self._in_flight.get(key)) is not None:
+            logger.info(f"Serper request coalesced for: {query}")
+            try:
+                return await asyncio.shield(in_flight)
+            except _LeaderCancelled:
+                # The leading request went away (e.g. its client disconnected); this one fetches instead
+                continue
+
+        budget = _budget.get()
+        if budget is not None:
+            if budget.used >= budget.limit:
+                raise SearchBudgetExceeded(f"Search budget of {budget.limit} queries exhausted for this request")
+            budget.used += 1
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            results = await self._fetch(query, num, api_key)
+            try:
+                await _results_cache.set(key, json.dumps(results))
+            except Exception as e:
+                logger.warning(f"Serper cache store failed: {e}")
+            future.set_result(results)
+            return results
+        except asyncio.CancelledError:
+            # Cancelling the shared future would cancel every waiting request along with this one
+            future.set_exception(_LeaderCancelled())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark retrieved so failures without waiters don't log "exception never retrieved"
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+
+    async def aclose(self) -> None:
+        await self._http.aclose()
+
+
+# httpx async pools are bound to the loop that created them
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, SerperClient]" = weakref.WeakKeyDictionary()
+
+
+def get_search_client() -> SerperClient:
+    """Serper client for the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = SerperClient()
+        _clients[loop] = client
+    return client
+
+
+async def close_search_client() -> None:
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
@@ -0,0 +1,168 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+from loguru import logger
+
+from app.config import ANALYSIS_QUERY_MAX_LIMIT, ANALYSIS_STORE_PATH
+from app.models import (
+    AgentOutputRecord, AgentSettingsRecord, Card, CardAnalysis, Fight, FightAnalysis, RunFingerprints,
+    StoredCardAnalysis, StoredFightAnalysis
+)
+
+
+def normalize_name(value: Optional[str]) -> Optional[str]:
+    """Lookup key for fighter names and locations: trimmed, case-folded, single-spaced"""
+    return " ".join(value.split()).casefold() if value else None
+
+
+class AnalysisStore:
+    """Analyzed cards in SQLite, with one indexed row per fight for lookups by fight, fighter, date and location"""
+
+    def __init__(self, path: str = ANALYSIS_STORE_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS card_analyses ("
+                "analysis_id TEXT PRIMARY KEY, created_at REAL NOT NULL, card TEXT NOT NULL, result TEXT NOT NULL, "
+                "settings TEXT NOT NULL, outputs TEXT NOT NULL, card_key TEXT, fingerprints TEXT)"
+            )
+            # Stores created before incremental re-analysis lack the fingerprint columns
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(card_analyses)")}
+            for column in ("card_key", "fingerprints"):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE card_analyses ADD COLUMN {column} TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS card_analyses_card_key ON card_analyses (card_key, created_at)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS fight_analyses ("
+                "analysis_id TEXT NOT NULL, fight_id TEXT NOT NULL, created_at REAL NOT NULL, "
+                "fighter1_key TEXT NOT NULL, fighter2_key TEXT NOT NULL, date TEXT, location_key TEXT, "
+                "fight TEXT NOT NULL, analysis TEXT NOT NULL, PRIMARY KEY (analysis_id, fight_id))"
+            )
+            # Each lookup filter has its own index; newest-first ordering comes from the trailing created_at
+            for column in ("fight_id", "fighter1_key", "fighter2_key", "date", "location_key"):
+                conn.execute(f"CREATE INDEX IF NOT EXISTS fight_analyses_{column} ON fight_analyses ({column}, created_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=5.0)
+
+    def _save(self, analysis_id: str, card: Card, result: CardAnalysis, settings: Dict[str, AgentSettingsRecord],
+              outputs: List[AgentOutputRecord], fingerprints: Optional[RunFingerprints]) -> None:
+        now = time.time()
+        fights = {fight.fight_id: fight for fight in card.fights}
+        rows = []
+        for analysis in result.analyses:
+            fight = fights.get(analysis.fight_id)
+            if fight is None:
+                continue
+            rows.append((
+                analysis_id, fight.fight_id, now, normalize_name(fight.fighter1), normalize_name(fight.fighter2),
+                fight.date.strip() if fight.date else None, normalize_name(fight.location),
+                fight.model_dump_json(), analysis.model_dump_json(),
+            ))
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO card_analyses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    analysis_id, now,
+                    # API keys never reach the disk
+                    card.model_dump_json(exclude={"api_keys"}),
+                    result.model_dump_json(exclude={"analysis_id"}),
+                    json.dumps({agent: record.model_dump() for agent, record in settings.items()}),
+                    json.dumps([record.model_dump(mode="json") for record in outputs]),
+                    fingerprints.card_key if fingerprints else None,
+                    fingerprints.model_dump_json() if fingerprints else None,
+                ),
+            )
+            conn.executemany("INSERT INTO fight_analyses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def _load(self, where: str, params: tuple) -> Optional[StoredCardAnalysis]:
+        with self._connect() as conn:
+            row = conn.execute(
+                f"SELECT analysis_id, created_at, card, result, settings, outputs, fingerprints FROM card_analyses {where}", params
+            ).fetchone()
+        if row is None:
+            return None
+        analysis_id, created_at, card, result, settings, outputs, fingerprints = row
+        return StoredCardAnalysis(
+            analysis_id=analysis_id, created_at=created_at,
+            card=Card.model_validate_json(card),
+            result=CardAnalysis.model_validate_json(result).model_copy(update={"analysis_id": analysis_id}),
+            settings=json.loads(settings), outputs=json.loads(outputs),
+            fingerprints=RunFingerprints.model_validate_json(fingerprints) if fingerprints else None,
+        )
+
+    def _get(self, analysis_id: str) -> Optional[StoredCardAnalysis]:
+        return self._load("WHERE analysis_id = ?", (analysis_id,))
+
+    def _latest(self, card_key: str) -> Optional[StoredCardAnalysis]:
+        return self._load("WHERE card_key = ? ORDER BY created_at DESC LIMIT 1", (card_key,))
+
+    def _query(self, fight_id: Optional[str], fighter: Optional[str], date_from: Optional[str], date_to: Optional[str],
+               location: Optional[str], limit: int) -> List[StoredFightAnalysis]:
+        clauses, params = [], []
+        if fight_id:
+            clauses.append("fight_id = ?")
+            params.append(fight_id)
+        if fighter:
+            # Two indexed equality lookups; SQLite unions them for the OR
+            clauses.append("(fighter1_key = ? OR fighter2_key = ?)")
+            params.extend([normalize_name(fighter)] * 2)
+        if date_from:
+            clauses.append("date >= ?")
+            params.append(date_from)
+        if date_to:
+            clauses.append("date <= ?")
+            params.append(date_to)
+        if location:
+            clauses.append("location_key = ?")
+            params.append(normalize_name(location))
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT analysis_id, created_at, fight, analysis FROM fight_analyses {where} ORDER BY created_at DESC LIMIT ?",
+                (*params, min(limit, ANALYSIS_QUERY_MAX_LIMIT)),
+            ).fetchall()
+        return [
+            StoredFightAnalysis(analysis_id=analysis_id, created_at=created_at, fight=Fight.model_validate_json(fight),
+                                analysis=FightAnalysis.model_validate_json(analysis))
+            for analysis_id, created_at, fight, analysis in rows
+        ]
+
+    async def save(self, card: Card, result: CardAnalysis, settings: Dict[str, AgentSettingsRecord],
+                   outputs: List[AgentOutputRecord], fingerprints: Optional[RunFingerprints] = None) -> str:
+        """Persist a card analysis and return its id"""
+        analysis_id = uuid4().hex
+        await asyncio.to_thread(self._save, analysis_id, card, result, settings, outputs, fingerprints)
+        logger.info(f"Stored analysis {analysis_id} ({len(result.analyses)} fights, {len(outputs)} agent outputs)")
+        return analysis_id
+
+    async def get(self, analysis_id: str) -> Optional[StoredCardAnalysis]:
+        return await asyncio.to_thread(self._get, analysis_id)
+
+    async def latest(self, card_key: str) -> Optional[StoredCardAnalysis]:
+        """Most recent stored run of a card, for incremental re-analysis"""
+        return await asyncio.to_thread(self._latest, card_key)
+
+    async def query(self, fight_id: Optional[str] = None, fighter: Optional[str] = None, date_from: Optional[str] = None,
+                    date_to: Optional[str] = None, location: Optional[str] = None, limit: int = 50) -> List[StoredFightAnalysis]:
+        """Stored fight analyses matching every given filter, newest first; dates compare as ISO strings"""
+        return await asyncio.to_thread(self._query, fight_id, fighter, date_from, date_to, location, limit)
+
+
+_store: Optional[AnalysisStore] = None
+
+
+def get_analysis_store() -> AnalysisStore:
+    global _store
+    if _store is None:
+        _store = AnalysisStore()
+    return _store
@@ -0,0 +1,178 @@
+"""End-to-end pipeline benchmark against the offline fake LLM provider.
+
+Drives 1-, 5-, 14- and 50-fight cards through the real pipeline and reports
+p50/p95 card latency, throughput and allocations. No network or API keys needed.
+Sharded cards run every fight at once, so their p50 should stay within a small
+multiple of whole-card p50 at any size rather than growing with the fight count.
+
+    python -m benchmarks.pipeline_benchmark --runs 5 --save baseline.json
+    python -m benchmarks.pipeline_benchmark --compare baseline.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Dict, List
+
+from loguru import logger
+
+# Benchmark cards must not land in the real analysis history (config is read on import)
+os.environ.setdefault("ANALYSIS_STORE_ENABLED", "false")
+
+from app.agents import install_sync_executor
+from app.llm_providers import close_llm_registry
+from app.models import AgentModels, Card, Fight
+from app.pipeline import analyze_card_pipeline
+
+DEFAULT_SIZES = (1, 5, 14, 50)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def build_card(size: int, model: str, shard: bool, post_processing: str = "sequential") -> Card:
+    fights = [
+        Fight(
+            fight_id=f"bench-{i}",
+            fighter1=f"Fighter {i}A",
+            fighter2=f"Fighter {i}B",
+            weight_class="Lightweight",
+            fighter1_record="20-3-0",
+            fighter2_record="18-4-0",
+            date="2025-01-18",
+            location="Benchmark Arena",
+        )
+        for i in range(1, size + 1)
+    ]
+    return Card(
+        fights=fights,
+        agent_models=AgentModels(**{agent: model for agent in AgentModels.model_fields}),
+        # Every run must reach the (fake) provider
+        cache_mode="bypass",
+        include_trace=True,
+        shard_by_fight=shard,
+        post_processing=post_processing,
+    )
+
+
+async def bench_size(size: int, model: str, shard: bool, runs: int, concurrency: int, post_processing: str) -> Dict[str, Any]:
+    latencies: List[float] = []
+    agent_calls = errors = 0
+
+    async def one_run() -> None:
+        nonlocal agent_calls, errors
+        started = time.perf_counter()
+        result = await analyze_card_pipeline(build_card(size, model, shard, post_processing))
+        latencies.append(time.perf_counter() - started)
+        agent_calls += len(result.trace.calls)
+        errors += sum(1 for call in result.trace.calls if call.status != "ok")
+
+    started = time.perf_counter()
+    for batch_start in range(0, runs, concurrency):
+        await asyncio.gather(*(one_run() for _ in range(min(concurrency, runs - batch_start))))
+    elapsed = time.perf_counter() - started
+
+    # Allocation pass kept separate so tracemalloc overhead does not skew latency
+    tracemalloc.start()
+    await analyze_card_pipeline(build_card(size, model, shard, post_processing))
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "fights": size,
+        "mode": "shard" if shard else "card",
+        "runs": runs,
+        "p50_s": round(percentile(latencies, 50), 4),
+        "p95_s": round(percentile(latencies, 95), 4),
+        "fights_per_s": round(size * runs / elapsed, 2),
+        "agent_calls_per_s": round(agent_calls / elapsed, 2),
+        "agent_errors": errors,
+        "peak_alloc_kib": round(peak / 1024, 1),
+        "retained_alloc_kib": round(current / 1024, 1),
+    }
+
+
+async def run_benchmarks(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    install_sync_executor(asyncio.get_running_loop())
+    model = f"fake-bench:latency={args.latency},sigma={args.sigma},fail={args.failure_rate},tokens={args.output_tokens}"
+    results = []
+    try:
+        for mode in args.modes:
+            for size in args.sizes:
+                result = await bench_size(size, model, mode == "shard", args.runs, args.concurrency, args.post_processing)
+                results.append(result)
+                print(format_row(result), flush=True)
+    finally:
+        await close_llm_registry()
+    return results
+
+
+def format_row(result: Dict[str, Any]) -> str:
+    return (
+        f"{result['mode']:>5} {result['fights']:>4} fights | p50 {result['p50_s']:>8.3f}s | p95 {result['p95_s']:>8.3f}s | "
+        f"{result['fights_per_s']:>8.2f} fights/s | {result['agent_calls_per_s']:>8.2f} calls/s | "
+        f"peak {result['peak_alloc_kib']:>10.1f} KiB | errors {result['agent_errors']}"
+    )
+
+
+def compare(results: List[Dict[str, Any]], baseline_path: str, tolerance: float) -> List[str]:
+    """Regressions of p95 latency or peak allocation beyond tolerance versus a saved baseline"""
+    with open(baseline_path) as f:
+        baseline = {(r["mode"], r["fights"]): r for r in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        base = baseline.get((result["mode"], result["fights"]))
+        if base is None:
+            continue
+        for metric in ("p95_s", "peak_alloc_kib"):
+            if base[metric] and result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{result['mode']} {result['fights']} fights: {metric} {result[metric]} vs baseline {base[metric]}"
+                )
+    return regressions
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=lambda v: [int(x) for x in v.split(",")], default=list(DEFAULT_SIZES), help="Comma-separated fight counts")
+    parser.add_argument("--modes", type=lambda v: v.split(","), default=["card", "shard"], help="card (one pipeline per card) and/or shard (one per fight)")
+    parser.add_argument("--post-processing", choices=["sequential", "combined", "concurrent"], default="sequential", help="Post-judge review mode")
+    parser.add_argument("--runs", type=int, default=5, help="Timed runs per card size")
+    parser.add_argument("--concurrency", type=int, default=1, help="Cards analyzed concurrently")
+    parser.add_argument("--latency", type=float, default=0.05, help="Median fake LLM latency in seconds")
+    parser.add_argument("--sigma", type=float, default=0.3, help="Log-normal latency spread (0 = constant)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of fake LLM calls that fail")
+    parser.add_argument("--output-tokens", type=int, default=400, help="Fake text response size")
+    parser.add_argument("--save", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Baseline JSON to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed regression versus the baseline (0.2 = 20%%)")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    results = asyncio.run(run_benchmarks(args))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,259 @@
+"""Checks of the Redis job queue and shared rate limits against an in-process Redis stand-in.
+
+Starts a fakeredis TCP server (pip install fakeredis) and drives the real backends
+through it from several simulated replicas: job claims, a worker killed mid-claim,
+takeover after a crashed worker, the shared token bucket under contention and the
+shared slot ceiling.
+Exits 1 if any check fails.
+
+    python -m benchmarks.redis_check
+    python -m benchmarks.redis_check --url redis://localhost:6379/0   # a real server instead
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+from typing import Any, Awaitable, Callable, List, Tuple
+from uuid import uuid4
+
+from loguru import logger
+
+
+def start_standin() -> Tuple[Any, str]:
+    """fakeredis server on a free local port, served from a daemon thread"""
+    try:
+        from fakeredis import TcpFakeServer
+    except ImportError as e:
+        raise SystemExit("The Redis stand-in requires the fakeredis package (pip install fakeredis), or pass --url") from e
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = TcpFakeServer(("127.0.0.1", port), server_type="redis")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"redis://127.0.0.1:{port}/0"
+
+
+def sample_card(index: int) -> Any:
+    from app.models import Card, Fight
+    return Card(fights=[Fight(
+        fight_id=f"check-{index}", fighter1=f"Fighter {index}A", fighter2=f"Fighter {index}B", weight_class="Lightweight",
+        fighter1_record="20-3-0", fighter2_record="18-4-0", date="2025-01-18", location="Check Arena",
+    )])
+
+
+async def check_job_claims(jobs: int = 40, replicas: int = 4) -> List[str]:
+    """Every queued job is claimed exactly once while replicas race for them"""
+    from app.jobs import RedisJobQueue
+
+    queue = RedisJobQueue()
+    ids = [f"claim-{i}" for i in range(jobs)]
+    for i, job_id in enumerate(ids):
+        await queue.enqueue(job_id, sample_card(i))
+
+    async def replica() -> List[str]:
+        claimed = []
+        # Each replica has its own queue object, as separate processes would
+        own = RedisJobQueue()
+        while (job := await own.claim(60.0)) is not None:
+            claimed.append(job[0])
+            await own.finish(job[0], job[2], None, "check")
+        return claimed
+
+    claimed = [job_id for batch in await asyncio.gather(*(replica() for _ in range(replicas))) for job_id in batch]
+    failures = []
+    if sorted(claimed) != sorted(ids):
+        failures.append(f"{len(claimed)} claims for {jobs} jobs, {len(set(claimed))} distinct")
+    if await queue.queued():
+        failures.append(f"{await queue.queued()} jobs left queued")
+    return failures
+
+
+async def check_crash_recovery(lease: float = 1.0) -> List[str]:
+    """A job whose worker stops renewing its lease is taken over by another replica; a renewed one is not"""
+    from app.jobs import RedisJobQueue
+    from app.models import FightAnalysis
+
+    crashed, survivor = RedisJobQueue(), RedisJobQueue()
+    failures = []
+
+    await crashed.enqueue("renewed", sample_card(0))
+    job = await crashed.claim(lease)
+    for _ in range(3):
+        await asyncio.sleep(lease / 2)
+        if not await crashed.renew(job[0], job[2], lease):
+            failures.append("a held lease could not be renewed")
+        if await survivor.claim(lease) is not None:
+            failures.append("a job with a renewed lease was taken over")
+    await crashed.finish(job[0], job[2], None, "check")
+
+    card = sample_card(1)
+    await crashed.enqueue("orphaned", card)
+    job_id, _, stale_token = await crashed.claim(lease)
+    # The worker reports a fight, then its process dies without finishing or releasing
+    partial = FightAnalysis(fight_id=card.fights[0].fight_id, pick=card.fights[0].fighter1, confidence=60,
+                            path_to_victory="check", risk_flags=[], props=[])
+    await crashed.add_partial(job_id, partial)
+    if await survivor.claim(lease) is not None:
+        failures.append("a job was taken over before its lease expired")
+    await asyncio.sleep(lease * 1.5)
+    taken = await survivor.claim(lease)
+    if taken is None or taken[0] != job_id:
+        failures.append(f"expired job not taken over (got {taken and taken[0]})")
+        return failures
+    if taken[1].fights[0].fight_id != card.fights[0].fight_id:
+        failures.append("takeover returned a different card")
+    status = await survivor.status(job_id)
+    if status.status != "running" or status.completed_fights != 1:
+        failures.append(f"after takeover: status {status.status}, {status.completed_fights} fights kept")
+    # The crashed worker was only stalled: its lease token no longer renews or finishes the job
+    if await crashed.renew(job_id, stale_token, lease):
+        failures.append("a stale worker renewed a lease taken over by another worker")
+    await crashed.finish(job_id, stale_token, None, "stale")
+    if (await survivor.status(job_id)).status != "running":
+        failures.append("a stale worker finished a job taken over by another worker")
+    await survivor.finish(job_id, taken[2], None, "check")
+    if (await survivor.status(job_id)).status != "failed":
+        failures.append("job not finished after takeover")
+    return failures
+
+
+async def check_claim_crash() -> List[str]:
+    """A worker dying halfway through a claim leaves the job queued for another replica"""
+    from app.jobs import RedisJobQueue
+
+    class DyingQueue(RedisJobQueue):
+        def _lease(self, pipe: Any, job_id: str, lease_token: str, until: float, now: float) -> None:
+            # The job is taken off the queue, then the process dies before its lease is recorded
+            pipe.zrem(self.queued_key, job_id)
+            raise SystemExit("worker killed mid-claim")
+
+    dying, survivor = DyingQueue(), RedisJobQueue()
+    await survivor.enqueue("mid-claim", sample_card(2))
+    failures = []
+    try:
+        await dying.claim(60.0)
+        failures.append("the simulated crash did not happen")
+    except SystemExit:
+        pass
+    if (await survivor.status("mid-claim")).status != "queued":
+        failures.append(f"job left {(await survivor.status('mid-claim')).status} by a worker killed mid-claim")
+    taken = await survivor.claim(60.0)
+    if taken is None or taken[0] != "mid-claim":
+        failures.append(f"job lost by a worker killed mid-claim (another replica claimed {taken and taken[0]})")
+    else:
+        await survivor.finish(taken[0], taken[2], None, "check")
+    return failures
+
+
+async def check_token_bucket(consumers: int = 20, tokens: int = 315, tokens_per_minute: int = 6000) -> List[str]:
+    """Concurrent draws from several replicas never spend more than the budget plus its refill"""
+    from app.scheduler import SharedTokenBucket
+
+    provider = f"bucket-{uuid4().hex[:8]}"
+    buckets = [SharedTokenBucket(provider, tokens_per_minute) for _ in range(4)]
+    rate = tokens_per_minute / 60.0
+    started = time.perf_counter()
+    await asyncio.gather(*(buckets[i % len(buckets)].consume(tokens) for i in range(consumers)))
+    elapsed = time.perf_counter() - started
+    # Lost updates would let the draws finish before the refill could have paid for them
+    minimum = (consumers * tokens - tokens_per_minute) / rate
+    failures = []
+    if elapsed < minimum * 0.95:
+        failures.append(f"{consumers * tokens} tokens drawn in {elapsed:.2f}s, the budget allows it in {minimum:.2f}s at the earliest")
+    if elapsed > minimum + 5.0:
+        failures.append(f"draws took {elapsed:.2f}s, expected about {minimum:.2f}s")
+    print(f"token bucket: {consumers * tokens} tokens from a {tokens_per_minute}/min budget in {elapsed:.2f}s (minimum {minimum:.2f}s)")
+    return failures
+
+
+async def check_slots(holders: int = 24, capacity: int = 3, hold: float = 0.1, lease: float = 1.0) -> List[str]:
+    """Holders across replicas never exceed the ceiling, and a dead replica's slot frees with its lease"""
+    from app.scheduler import SharedSlots
+
+    provider = f"slots-{uuid4().hex[:8]}"
+    replicas = [SharedSlots(provider, capacity, lease) for _ in range(4)]
+    active = peak = 0
+
+    async def holder(slots: Any) -> None:
+        nonlocal active, peak
+        async with slots.hold():
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(hold)
+            active -= 1
+
+    await asyncio.gather(*(holder(replicas[i % len(replicas)]) for i in range(holders)))
+    failures = []
+    if peak > capacity:
+        failures.append(f"{peak} concurrent holders with a ceiling of {capacity}")
+    if peak < capacity:
+        failures.append(f"only {peak} of {capacity} slots ever used at once")
+
+    # A replica takes every slot and dies without releasing them
+    dead = SharedSlots(provider, capacity, lease)
+    for _ in range(capacity):
+        await dead._try_acquire(uuid4().hex)
+    started = time.perf_counter()
+    async with replicas[0].hold():
+        waited = time.perf_counter() - started
+    if waited < lease * 0.9:
+        failures.append(f"slot taken after {waited:.2f}s while a dead replica's lease ran {lease:g}s")
+    if waited > lease + 2.0:
+        failures.append(f"dead replica's slot freed only after {waited:.2f}s (lease {lease:g}s)")
+    print(f"slots: peak {peak}/{capacity} holders; dead replica's slots freed after {waited:.2f}s")
+    return failures
+
+
+CHECKS: List[Tuple[str, Callable[[], Awaitable[List[str]]]]] = [
+    ("job claims", check_job_claims),
+    ("crash recovery", check_crash_recovery),
+    ("claim crash", check_claim_crash),
+    ("token bucket", check_token_bucket),
+    ("slots", check_slots),
+]
+
+
+async def run_checks() -> int:
+    from app.redis_client import close_redis
+
+    failed = 0
+    try:
+        for name, check in CHECKS:
+            failures = await check()
+            for failure in failures:
+                print(f"FAIL {name}: {failure}")
+            print(f"{'FAIL' if failures else 'ok'}   {name}", flush=True)
+            failed += bool(failures)
+    finally:
+        await close_redis()
+    return failed
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Check against this Redis server instead of the in-process stand-in")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    logger.remove()
+    logger.add(sys.stderr, level="ERROR")
+
+    server, url = (None, args.url) if args.url else start_standin()
+    # Config is read on import, so the app modules are only imported once these are set
+    os.environ["REDIS_URL"] = url
+    # A fresh namespace, so a real server's other keys are never touched
+    os.environ["REDIS_KEY_PREFIX"] = f"check-{uuid4().hex[:8]}:"
+    try:
+        return 1 if asyncio.run(run_checks()) else 0
+    finally:
+        if server is not None:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,7 @@
 import streamlit as st
 import requests
 import json
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 import csv
 import io
 import time
@@ -9,19 +9,21 @@ import asyncio
 from datetime import datetime
 
 # Direct UFC analysis imports
-from app.models import Card, CardAnalysis, AgentPrompts, AgentTemperatures, AgentTopPs
-from app.agents import (
-    tape_study_agent, stats_trends_agent, news_weighins_agent,
-    style_matchup_agent, market_odds_agent, judge_agent,
-    risk_scorer_agent, consistency_checker_agent
-)
-from app.config import set_runtime_api_keys
+from app.models import Card, CardAnalysis, AgentPrompts, AgentTemperatures, AgentTopPs, PipelineEvent
+from app.agents import install_sync_executor
+from app.pipeline import analyze_card_pipeline, EventCallback
+from app.llm_providers import close_llm_registry
+from app.search import close_search_client
+from app.redis_client import close_redis
 from app.prompts import (
     TAPE_STUDY_PROMPT, STATS_TRENDS_PROMPT, NEWS_WEIGHINS_PROMPT,
     STYLE_MATCHUP_PROMPT, MARKET_ODDS_PROMPT, JUDGE_PROMPT,
     RISK_SCORER_PROMPT, CONSISTENCY_CHECKER_PROMPT
 )
 
+# Analysts the judge waits for when "Start Judge at Quorum" is on
+EARLY_JUDGE_QUORUM = 3
+
 # Page configuration
 st.set_page_config(
     page_title="🥊 UFC Card Analysis Expert",
@@ -134,6 +136,21 @@ with st.sidebar:
     # Web search toggle (must be defined before API key validation)
     use_serper = st.toggle("🔍 Enable Real-Time Web Search", help="Uses Serper API for live news, injuries, and fighter updates", key="use_serper_toggle")
 
+    # One shared search pass feeding every analyst (only meaningful with web search)
+    research_prefetch = st.toggle("📚 Prefetch Shared Research", help="Runs one search pass per fight up front and shares the results with all analysts instead of each agent searching on its own", key="research_prefetch_toggle", disabled=not use_serper)
+
+    # Per-fight sharded execution for large cards
+    shard_by_fight = st.toggle("⚡ Analyze Fights in Parallel", help="Runs every fight as its own concurrent agent pipeline; large cards finish in roughly the time of the slowest fight", key="shard_by_fight_toggle")
+
+    # Judge starts on a quorum of analysts instead of waiting for the slowest one
+    judge_early = st.toggle("⏱️ Start Judge at Quorum", help=f"The judge starts once {EARLY_JUDGE_QUORUM} of the 5 analysts have reported; late analysts are dropped after a short grace period", key="judge_early_toggle")
+
+    # How the risk and consistency reviews run after the judge
+    post_processing = st.selectbox("🧮 Post-Judge Review", ["sequential", "combined", "concurrent"], help="sequential: risk scorer then consistency checker; combined: one call doing both; concurrent: both at once, merged per fight", key="post_processing_select")
+
+    # Which fights get the LLM risk/consistency review
+    post_review_policy = st.selectbox("🧠 LLM Post Review", ["llm", "auto", "rules"], help="llm: review every fight; auto: only fights the rules flag (high confidence, toss-ups, low analyst agreement, missing analysts); rules: deterministic rules only", key="post_review_policy_select")
+
     # API keys input section
     st.markdown("🔐 API Keys Configuration")
     with st.expander("🔑 Enter API Keys"):
@@ -526,43 +543,15 @@ def validate_fight(fight_data: Dict[str, Any]) -> List[str]:
     return errors
 
 # Extract and modify analyze_card function for direct usage
-async def analyze_card_direct(card: Card):
+async def analyze_card_direct(card: Card, on_event: Optional[EventCallback] = None):
     """Direct analysis function (extracted from app/main.py)"""
     try:
-        # Extract model overrides, custom prompts, and API keys from card
-        agent_models = card.agent_models
-        custom_prompts = card.custom_prompts
-        custom_temperatures = card.custom_temperatures
-        custom_top_ps = card.custom_top_ps
-        api_keys = card.api_keys
-
-        # Set runtime API keys to environment if provided
-        set_runtime_api_keys(api_keys)
-
-        # Run 5 main agents in parallel
-        tape_task = tape_study_agent(card, agent_models.tape_study if agent_models else None, card.use_serper, api_keys, custom_prompts.tape_study if custom_prompts else None, custom_temperatures.tape_study if custom_temperatures else None, custom_top_ps.tape_study if custom_top_ps else None)
-        stats_task = stats_trends_agent(card, agent_models.stats_trends if agent_models else None, card.use_serper, api_keys, custom_prompts.stats_trends if custom_prompts else None, custom_temperatures.stats_trends if custom_temperatures else None, custom_top_ps.stats_trends if custom_top_ps else None)
-        news_task = news_weighins_agent(card, agent_models.news_weighins if agent_models else None, card.use_serper, api_keys, custom_prompts.news_weighins if custom_prompts else None, custom_temperatures.news_weighins if custom_temperatures else None, custom_top_ps.news_weighins if custom_top_ps else None)
-        style_task = style_matchup_agent(card, agent_models.style_matchup if agent_models else None, card.use_serper, api_keys, custom_prompts.style_matchup if custom_prompts else None, custom_temperatures.style_matchup if custom_temperatures else None, custom_top_ps.style_matchup if custom_top_ps else None)
-        market_task = market_odds_agent(card, agent_models.market_odds if agent_models else None, card.use_serper, api_keys, custom_prompts.market_odds if custom_prompts else None, custom_temperatures.market_odds if custom_temperatures else None, custom_top_ps.market_odds if custom_top_ps else None)
-
-        tape, stats, news, style, market = await asyncio.gather(
-            tape_task, stats_task, news_task, style_task, market_task
-        )
-
-        # Judge agent
-        analyses = await judge_agent(card, tape, stats, news, style, market, agent_models.judge if agent_models else None, api_keys, custom_prompts.judge if custom_prompts else None, custom_temperatures.judge if custom_temperatures else None, custom_top_ps.judge if custom_top_ps else None)
-
-        # Post agents
-        analyses = await risk_scorer_agent(analyses, agent_models.risk_scorer if agent_models else None, api_keys, custom_prompts.risk_scorer if custom_prompts else None, custom_temperatures.risk_scorer if custom_temperatures else None, custom_top_ps.risk_scorer if custom_top_ps else None)
-        analyses = await consistency_checker_agent(analyses, agent_models.consistency_checker if agent_models else None, api_keys, custom_prompts.consistency_checker if custom_prompts else None, custom_temperatures.consistency_checker if custom_temperatures else None, custom_top_ps.consistency_checker if custom_top_ps else None)
-
-        return CardAnalysis(analyses=analyses)
+        return await analyze_card_pipeline(card, on_event)
 
     except Exception as e:
         raise Exception(f"Analysis failed: {str(e)}")
 
-def run_direct_analysis(fights_data: List[Dict[str, Any]], use_serper: bool, agent_models: Dict[str, str], api_keys: Dict[str, str] = None, custom_prompts_dict: Dict[str, str] = None, custom_temperatures: AgentTemperatures = None, custom_top_ps: AgentTopPs = None):
+def run_direct_analysis(fights_data: List[Dict[str, Any]], use_serper: bool, agent_models: Dict[str, str], api_keys: Dict[str, str] = None, custom_prompts_dict: Dict[str, str] = None, custom_temperatures: AgentTemperatures = None, custom_top_ps: AgentTopPs = None, shard_by_fight: bool = False, on_event: Optional[EventCallback] = None, research_prefetch: bool = False, judge_quorum: Optional[int] = None, post_processing: str = "sequential", post_review_policy: str = "llm"):
     """Run analysis directly without HTTP requests"""
     # Convert fights data to Card model
     card = Card(
@@ -572,7 +561,12 @@ def run_direct_analysis(fights_data: List[Dict[str, Any]], use_serper: bool, age
         api_keys=api_keys,
         custom_prompts=custom_prompts_dict,
         custom_temperatures=custom_temperatures,
-        custom_top_ps=custom_top_ps
+        custom_top_ps=custom_top_ps,
+        shard_by_fight=shard_by_fight,
+        research_prefetch=use_serper and research_prefetch,
+        judge_quorum=judge_quorum,
+        post_processing=post_processing,
+        post_review_policy=post_review_policy
     )
 
     # Run analysis in new event loop
@@ -580,12 +574,41 @@ def run_direct_analysis(fights_data: List[Dict[str, Any]], use_serper: bool, age
         # Create new event loop for async execution
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(analyze_card_direct(card))
-        loop.close()
+        install_sync_executor(loop)
+        try:
+            result = loop.run_until_complete(analyze_card_direct(card, on_event))
+        finally:
+            loop.run_until_complete(close_llm_registry())
+            loop.run_until_complete(close_search_client())
+            loop.run_until_complete(close_redis())
+            loop.close()
         return result
     except Exception as e:
         raise Exception(f"Analysis failed: {str(e)}")
 
+def describe_event(event: PipelineEvent) -> Optional[str]:
+    """Render a pipeline stage event as a one-line progress message"""
+    scope = f" ({event.fight_id})" if event.fight_id else ""
+    if event.event == "agent_started":
+        return f"⏳ {event.agent}{scope} started"
+    if event.event == "agent_finished":
+        return f"✅ {event.agent}{scope} finished — {event.elapsed}s"
+    if event.event == "agent_failed":
+        return f"⚠️ {event.agent}{scope} failed — {event.detail}"
+    if event.event == "agent_reused":
+        return f"♻️ {event.agent}{scope} reused from the last run"
+    if event.event == "fight_reused":
+        return f"♻️ {event.fight_id}: unchanged, reusing the last analysis"
+    if event.event == "review_skipped":
+        return f"⚡ {event.fight_id}: LLM review skipped — {event.detail}"
+    if event.event == "judge_result" and event.analysis:
+        return f"⚖️ Judge pick for {event.fight_id}: **{event.analysis.pick}** ({event.analysis.confidence}%)"
+    if event.event == "fight_result" and event.analysis:
+        return f"🥊 Final pick for {event.fight_id}: **{event.analysis.pick}** ({event.analysis.confidence}%) — {event.elapsed}s"
+    if event.event == "fight_failed":
+        return f"❌ {event.fight_id} failed: {event.detail}"
+    return None
+
 def display_analysis_results(results: Dict[str, Any]):
     """Display the analysis results in a beautiful format"""
     if not results or 'analyses' not in results:
@@ -748,12 +771,24 @@ if validation_errors:
 
 if not analysis_blocked:
     if st.button("🔥 Analyze Fight Card", type="primary"):
-        with st.spinner("🤖 AI Agents analyzing fight card... This may take several minutes."):
+        card_analysis = None
+        with st.status("🤖 AI Agents analyzing fight card... This may take several minutes.", expanded=True) as status:
+
+            def show_progress(event: PipelineEvent):
+                message = describe_event(event)
+                if message:
+                    status.write(message)
 
             try:
                 # Run direct analysis (no HTTP request)
-                card_analysis = run_direct_analysis(fights_data, use_serper, agent_models, api_keys, custom_prompts_dict, custom_temperatures, custom_top_ps)
+                card_analysis = run_direct_analysis(fights_data, use_serper, agent_models, api_keys, custom_prompts_dict, custom_temperatures, custom_top_ps, shard_by_fight, show_progress, research_prefetch, EARLY_JUDGE_QUORUM if judge_early else None, post_processing, post_review_policy)
+                status.update(label="Agents finished", state="complete", expanded=False)
+            except Exception as e:
+                status.update(label="Agents failed", state="error")
+                st.error(f"Analysis failed: {str(e)}")
 
+        if card_analysis is not None:
+            try:
                 # Convert CardAnalysis to expected dict format with fighter info
                 analyses_with_fighters = []
                 for analysis in card_analysis.analyses: